@@ -0,0 +1,275 @@
+"""
+像素化引擎基准测试脚本。
+
+用法（在 backend 目录下运行）：
+    python benchmark.py remap
+    python benchmark.py lut
+    python benchmark.py quantizers
+    python benchmark.py lab
+    python benchmark.py metric
+"""
+import argparse
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from utils.color_diff import METRICS, delta_e, nearest_colors
+from utils.color_space import rgb_to_lab, rgb_to_lab_reference
+from utils.palette_lut import get_lut
+from utils.palette_registry import palette_registry
+from utils.pixel_converter import load_palette, map_colors_to_palette, process_image_to_beads
+from utils.quantizers import QUANTIZERS
+
+
+GRID_SIZES = [32, 64, 128, 256]
+
+
+def _timeit(fn: Callable[[], object], repeat: int = 5) -> float:
+    """返回 repeat 次运行中的最短耗时（毫秒）。"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000.0
+
+
+def make_corpus() -> Dict[str, Image.Image]:
+    """
+    固定的合成测试图集（不依赖外部文件，结果可复现）：
+    flat     —— 类似 /generate 输出的扁平插画：白底、黑描边、少量纯色块
+    gradient —— 双向渐变
+    photo    —— 平滑色场叠加噪声，近似照片
+    """
+    rng = np.random.default_rng(42)
+    corpus = {}
+
+    flat = Image.new("RGB", (1024, 1024), (255, 255, 255))
+    draw = ImageDraw.Draw(flat)
+    draw.ellipse((212, 112, 812, 712), fill=(255, 182, 193), outline=(0, 0, 0), width=14)
+    draw.ellipse((362, 312, 442, 412), fill=(30, 30, 30))
+    draw.ellipse((582, 312, 662, 412), fill=(30, 30, 30))
+    draw.rectangle((312, 662, 712, 962), fill=(135, 206, 235), outline=(0, 0, 0), width=14)
+    draw.ellipse((450, 480, 574, 560), fill=(255, 127, 80))
+    draw.rectangle((240, 740, 320, 900), fill=(255, 223, 0), outline=(0, 0, 0), width=10)
+    corpus["flat"] = flat
+
+    x = np.linspace(0, 1, 800)
+    y = np.linspace(0, 1, 600)[:, None]
+    grad = np.stack([255 * x + 0 * y, 255 * y + 0 * x, 128 + 127 * np.sin(6 * x) * np.cos(4 * y)], -1)
+    corpus["gradient"] = Image.fromarray(np.clip(grad, 0, 255).astype(np.uint8))
+
+    field = np.stack([
+        128 + 100 * np.sin(3 * x + 2 * y + c) * np.cos(5 * y - x + 2 * c) for c in range(3)
+    ], -1)
+    field = field + rng.normal(0, 12, field.shape)
+    corpus["photo"] = Image.fromarray(np.clip(field, 0, 255).astype(np.uint8))
+    return corpus
+
+
+def mean_delta_e(image: Image.Image, result: Dict) -> float:
+    """输出图案与 BOX 缩放后原图之间的平均 ΔE (CIE76)。"""
+    palette = palette_registry.current()
+    id_to_index = {pid: i for i, pid in enumerate(palette.ids)}
+    indices = np.vectorize(id_to_index.get)(np.array(result["grid_data"], dtype=object))
+    small = np.array(image.convert("RGB").resize((result["width"], result["height"]),
+                                                 Image.Resampling.BOX))
+    return float(np.linalg.norm(palette.lab[indices] - rgb_to_lab(small), axis=-1).mean())
+
+
+def _print_table(headers: List[str], rows: List[List[str]]) -> None:
+    widths = [max(len(str(c)) for c in col) for col in zip(headers, *rows)]
+    fmt = "  ".join(f"{{:>{w}}}" for w in widths)
+    print(fmt.format(*headers))
+    for row in rows:
+        print(fmt.format(*row))
+
+
+def bench_remap(args) -> None:
+    """
+    对比第 6/7 步（逐像素重映射 + 网格 ID 输出）的 Python 循环实现与数组查表实现。
+    """
+    palette_data = load_palette()
+    num_palette = len(palette_data)
+    palette_ids = np.array([p["id"] for p in palette_data], dtype=object)
+    rng = np.random.default_rng(0)
+
+    rows = []
+    for size in GRID_SIZES:
+        n = size * size
+        n_clusters = 14
+        cluster_indices = rng.integers(0, n_clusters, n)
+        flat_bg_mask = rng.random(n) < 0.4
+        cluster_to_palette = {i: int(rng.integers(0, num_palette)) for i in range(n_clusters)}
+        bg_palette_idx = 0
+
+        def loop_version():
+            result_flat = np.empty(n, dtype=np.int32)
+            for i in range(n):
+                if flat_bg_mask[i]:
+                    result_flat[i] = bg_palette_idx
+                else:
+                    result_flat[i] = cluster_to_palette[cluster_indices[i]]
+            grid_ids = []
+            used = set()
+            for row in result_flat.reshape(size, size):
+                grid_row = []
+                for idx in row:
+                    safe_idx = int(idx) if int(idx) < num_palette else 0
+                    grid_row.append(palette_data[safe_idx]["id"])
+                    used.add(safe_idx)
+                grid_ids.append(grid_row)
+            return grid_ids, sorted(used)
+
+        def vector_version():
+            lookup = np.array([cluster_to_palette[i] for i in range(n_clusters)], dtype=np.int32)
+            result = np.where(flat_bg_mask, bg_palette_idx, lookup[cluster_indices]).astype(np.int32)
+            result = result.reshape(size, size)
+            safe = np.where(result < num_palette, result, 0)
+            return palette_ids[safe].tolist(), np.unique(safe).tolist()
+
+        assert loop_version() == vector_version()
+        t_loop = _timeit(loop_version, args.repeat)
+        t_vec = _timeit(vector_version, args.repeat)
+        rows.append([f"{size}x{size}", f"{t_loop:.2f}", f"{t_vec:.2f}", f"{t_loop / t_vec:.1f}x"])
+
+    _print_table(["grid", "loop ms", "vectorized ms", "speedup"], rows)
+
+
+def bench_lut(args) -> None:
+    """
+    对比查找表引擎与精确 KDTree 路径：一致率、平均 / 最大 ΔE 损失和映射耗时。
+    8 位表必须与 KDTree 结果完全一致。
+    """
+    palette = palette_registry.current()
+    rng = np.random.default_rng(0)
+    colors = rng.integers(0, 256, (args.samples, 3), dtype=np.uint8)
+    lab = rgb_to_lab(colors.reshape(-1, 1, 3)).reshape(-1, 3)
+
+    exact = palette.nearest(lab)
+    t_exact = _timeit(lambda: palette.nearest(rgb_to_lab(colors.reshape(-1, 1, 3)).reshape(-1, 3)),
+                      args.repeat)
+    exact_de = np.linalg.norm(lab - palette.lab[exact], axis=1)
+
+    rows = [["kdtree", "-", "100.00%", "0.000", "0.000", f"{t_exact:.2f}"]]
+    for bits in (8, 6, 5):
+        lut = get_lut(palette, bits)
+        approx = lut.lookup(colors)
+        t_lut = _timeit(lambda: lut.lookup(colors), args.repeat)
+        de_loss = np.linalg.norm(lab - palette.lab[approx], axis=1) - exact_de
+        agree = np.mean(approx == exact) * 100.0
+        if bits == 8:
+            assert np.array_equal(approx, exact), "8 位查找表与 KDTree 结果不一致"
+        rows.append([f"lut{bits}", f"{lut.table.nbytes // 1024} KB", f"{agree:.2f}%",
+                     f"{de_loss.mean():.3f}", f"{de_loss.max():.3f}", f"{t_lut:.2f}"])
+
+    print(f"{args.samples} 个随机 RGB 颜色，调色板 {len(palette)} 色")
+    _print_table(["engine", "table", "agree", "mean dE loss", "max dE loss", "ms"], rows)
+
+
+def bench_quantizers(args) -> None:
+    """各颜色量化器在固定图集上的端到端耗时和平均 ΔE。"""
+    corpus = make_corpus()
+    rows = []
+    for name in QUANTIZERS:
+        for img_name, image in corpus.items():
+            run = lambda: process_image_to_beads(image, grid_size=args.grid_size,
+                                                 max_colors=args.max_colors, quantizer=name)
+            result = run()
+            rows.append([name, img_name, f"{_timeit(run, args.repeat):.1f}",
+                         f"{mean_delta_e(image, result):.2f}", str(len(result["used_palette"]))])
+
+    print(f"grid_size={args.grid_size}, max_colors={args.max_colors}")
+    _print_table(["quantizer", "image", "ms", "mean dE", "colors"], rows)
+
+
+def bench_lab(args) -> None:
+    """
+    rgb_to_lab（float32 查表 + 矩阵乘法）与 float64 参考实现的耗时对比，
+    并在全部 256³ 种颜色上检查精度（最大误差必须小于 1e-3）。
+    """
+    max_err = 0.0
+    step = 1 << 20
+    for start in range(0, 1 << 24, step):
+        keys = np.arange(start, start + step, dtype=np.uint32)
+        colors = np.stack([keys >> 16, (keys >> 8) & 0xFF, keys & 0xFF], axis=1).astype(np.uint8)
+        err = np.abs(rgb_to_lab(colors).astype(np.float64) - rgb_to_lab_reference(colors)).max()
+        max_err = max(max_err, float(err))
+    assert max_err < 1e-3, f"rgb_to_lab 误差过大: {max_err}"
+    print(f"全部 256³ 种颜色的最大误差: {max_err:.2e}")
+
+    rng = np.random.default_rng(0)
+    rows = []
+    for size in (64, 256, 1024):
+        image = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+        out = np.empty(image.shape, dtype=np.float32)
+        t_ref = _timeit(lambda: rgb_to_lab_reference(image), args.repeat)
+        t_fast = _timeit(lambda: rgb_to_lab(image), args.repeat)
+        t_out = _timeit(lambda: rgb_to_lab(image, out=out), args.repeat)
+        rows.append([f"{size}x{size}", f"{t_ref:.2f}", f"{t_fast:.2f}", f"{t_out:.2f}",
+                     f"{t_ref / t_fast:.1f}x"])
+    _print_table(["pixels", "float64 ms", "float32 ms", "out= ms", "speedup"], rows)
+
+
+def bench_metric(args) -> None:
+    """
+    各色差公式在 256×256 个随机颜色上的匹配耗时（完整比较 vs CIE76 预筛选），
+    预筛选相对完整比较的误配率和 ΔE 损失，以及与 CIE76 选择不同的比例。
+    最后一列为像素化流程中实际的映射量（15 个代表色）的耗时。
+    """
+    palette = palette_registry.current()
+    rng = np.random.default_rng(0)
+    colors = rng.integers(0, 256, (256 * 256, 3), dtype=np.uint8)
+    lab = rgb_to_lab(colors)
+    reps = colors[:15]
+    cie76 = palette.nearest(lab)
+
+    rows = []
+    for metric in METRICS:
+        exact = nearest_colors(lab, palette.lab, metric, candidates=0)
+        pruned = nearest_colors(lab, palette.lab, metric, candidates=args.candidates)
+        if metric == "cie94":
+            assert np.array_equal(pruned, exact), "CIE94 预筛选结果与完整比较不一致"
+        t_exact = _timeit(lambda: nearest_colors(lab, palette.lab, metric, candidates=0),
+                          args.repeat)
+        t_pruned = _timeit(lambda: nearest_colors(lab, palette.lab, metric,
+                                                  candidates=args.candidates), args.repeat)
+        t_reps = _timeit(lambda: map_colors_to_palette(reps, palette, "kdtree", metric),
+                         args.repeat)
+        loss = (delta_e(lab, palette.lab[pruned], metric)
+                - delta_e(lab, palette.lab[exact], metric))
+        rows.append([metric, f"{t_exact:.1f}", f"{t_pruned:.1f}",
+                     f"{np.mean(pruned != exact) * 100:.3f}%", f"{loss.mean():.4f}",
+                     f"{loss.max():.3f}", f"{np.mean(exact != cie76) * 100:.2f}%",
+                     f"{t_reps:.3f}"])
+
+    print(f"256x256 个随机颜色，调色板 {len(palette)} 色，预筛选候选数 {args.candidates}")
+    _print_table(["metric", "full ms", "pruned ms", "pruned mismatch", "mean dE loss",
+                  "max dE loss", "differs from cie76", "15 reps ms"], rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="像素化引擎基准测试")
+    parser.add_argument("--repeat", type=int, default=5, help="每项重复次数，取最短耗时")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("remap", help="逐像素重映射循环 vs 数组查表").set_defaults(func=bench_remap)
+    lut_parser = sub.add_parser("lut", help="查找表引擎 vs 精确 KDTree")
+    lut_parser.add_argument("--samples", type=int, default=256 * 256)
+    lut_parser.set_defaults(func=bench_lut)
+    q_parser = sub.add_parser("quantizers", help="各颜色量化器的耗时和平均 ΔE")
+    q_parser.add_argument("--grid-size", type=int, default=64)
+    q_parser.add_argument("--max-colors", type=int, default=15)
+    q_parser.set_defaults(func=bench_quantizers)
+    sub.add_parser("lab", help="rgb_to_lab 耗时和精度").set_defaults(func=bench_lab)
+    m_parser = sub.add_parser("metric", help="CIE76 / CIE94 / CIEDE2000 匹配耗时和误配率")
+    m_parser.add_argument("--candidates", type=int, default=16)
+    m_parser.set_defaults(func=bench_metric)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""
+图像生成上游客户端的本地检查脚本：启动一个假的 ARK 服务（HTTP/1.1 keep-alive），
+不需要 ARK_API_KEY，也不会产生计费调用。
+
+用法（在 backend 目录下运行）：
+    python check_upstream.py pool
+    python check_upstream.py retry
+    python check_upstream.py deadline
+    python check_upstream.py breaker
+    python check_upstream.py concurrency
+"""
+import argparse
+import asyncio
+import base64
+import json
+import socket
+import time
+from typing import Dict, List, Optional, Tuple
+
+from utils.nanobanana_client import NanobananaClient, create_http_client
+from utils.upstream import CircuitBreaker, UpstreamError, UpstreamGuard, UpstreamUnavailableError
+
+# 1x1 白色 PNG，作为生成结果返回
+_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1PeAAAADElEQVR4nGP4//8/AAX+Av4N70a4AAAAAElFTkSuQmCC"
+)
+
+
+class FakeArkServer:
+    """
+    本地假 ARK 服务。按 script 中的顺序处理请求（用完后都返回成功），每项为：
+        ("ok",)            返回 200 和 b64_json 图像
+        ("status", code)   返回该状态码
+        ("delay", 秒)      等待后返回 200（模拟生成很慢）
+        ("drop",)          收到完整请求后不响应直接断开（模拟请求已送达后连接中断）
+    记录每个请求所用连接的客户端端口，以及当前打开的连接数。
+    """
+
+    def __init__(self, script: Optional[List[Tuple]] = None):
+        self.script = list(script or [])
+        self.request_ports: List[int] = []
+        self.open_connections = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Dict[asyncio.Task, asyncio.StreamWriter] = {}
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}/api/v3/images/generations"
+
+    async def __aenter__(self) -> "FakeArkServer":
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self._server.close()
+        # 关闭剩余的连接，各连接的处理协程读到 EOF 后自行结束
+        for writer in self._connections.values():
+            writer.close()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        port = writer.get_extra_info("peername")[1]
+        self._connections[asyncio.current_task()] = writer
+        self.open_connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                length = 0
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    if name.strip().lower() == "content-length":
+                        length = int(value)
+                await reader.readexactly(length)
+                self.request_ports.append(port)
+
+                action = self.script.pop(0) if self.script else ("ok",)
+                if action[0] == "drop":
+                    break
+                if action[0] == "delay":
+                    try:
+                        # 客户端放弃请求、断开连接时提前结束
+                        await asyncio.wait_for(reader.read(), timeout=action[1])
+                        break
+                    except asyncio.TimeoutError:
+                        pass
+                status = action[1] if action[0] == "status" else 200
+                if status == 200:
+                    body = {"data": [{"b64_json": base64.b64encode(_PNG).decode("ascii")}]}
+                else:
+                    body = {"error": {"message": f"fake status {status}"}}
+                payload = json.dumps(body).encode("utf-8")
+                writer.write(
+                    f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\nConnection: keep-alive\r\n\r\n"
+                    .encode("latin-1") + payload
+                )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.open_connections -= 1
+            self._connections.pop(asyncio.current_task(), None)
+            writer.close()
+
+
+def _print_table(headers: List[str], rows: List[List[str]]) -> None:
+    widths = [max(len(str(c)) for c in col) for col in zip(headers, *rows)]
+    fmt = "  ".join(f"{{:>{w}}}" for w in widths)
+    print(fmt.format(*headers))
+    for row in rows:
+        print(fmt.format(*row))
+
+
+def _client(url: str, guard: Optional[UpstreamGuard] = None) -> NanobananaClient:
+    return NanobananaClient(api_url=url, api_key="test", http_client=create_http_client(),
+                            guard=guard or UpstreamGuard())
+
+
+async def check_pool(args) -> None:
+    """共享客户端：顺序调用复用同一个 keep-alive 连接，aclose() 后连接关闭。"""
+    rows = []
+    async with FakeArkServer() as server:
+        client = _client(server.url)
+        for _ in range(args.calls):
+            await client.generate_q_version()
+        shared_ports = set(server.request_ports)
+        http = client.http
+        await client.aclose()
+        await asyncio.sleep(0.05)  # 等服务端读到 EOF
+        rows.append(["shared client", args.calls, len(shared_ports), server.open_connections,
+                     "yes" if http.is_closed else "no"])
+        assert len(shared_ports) == 1, f"共享客户端用了 {len(shared_ports)} 个连接"
+        assert http.is_closed and server.open_connections == 0, "aclose() 后仍有打开的连接"
+
+    async with FakeArkServer() as server:
+        for _ in range(args.calls):
+            client = _client(server.url)
+            await client.generate_q_version()
+            await client.aclose()
+        await asyncio.sleep(0.05)
+        rows.append(["client per call", args.calls, len(set(server.request_ports)),
+                     server.open_connections, "yes"])
+
+    _print_table(["mode", "calls", "connections", "open after close", "client closed"], rows)
+
+
+def _unused_url() -> str:
+    """一个没有服务监听的本地地址，连接会被拒绝（请求一定没有发出）。"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}/api/v3/images/generations"
+
+
+async def _call(client: NanobananaClient) -> Tuple[str, float]:
+    """调用一次生成，返回 (结果, 耗时秒数)，不关闭客户端。"""
+    started = time.perf_counter()
+    try:
+        await client.generate_q_version()
+        outcome = "ok"
+    except UpstreamError as e:
+        outcome = f"UpstreamError {e.status_code or ''}".strip()
+    except UpstreamUnavailableError:
+        outcome = "UpstreamUnavailableError"
+    return outcome, time.perf_counter() - started
+
+
+async def _generate(client: NanobananaClient) -> Tuple[str, float]:
+    try:
+        return await _call(client)
+    finally:
+        await client.aclose()
+
+
+async def check_retry(args) -> None:
+    """计费的生成请求只在 429 / 5xx 和请求未发出时重试，请求已送达后断开不重试。"""
+    cases = [
+        ("503 then ok", [("status", 503)], "ok", 2),
+        ("429 x3", [("status", 429)] * 3, "UpstreamError 429", 3),
+        ("dropped after send", [("drop",)], "UpstreamError", 1),
+    ]
+    rows = []
+    for name, script, expected, expected_requests in cases:
+        async with FakeArkServer(script) as server:
+            guard = UpstreamGuard(max_attempts=3, backoff_base=0.05)
+            outcome, elapsed = await _generate(_client(server.url, guard))
+            rows.append([name, len(server.request_ports), guard.retries, outcome, f"{elapsed:.2f}"])
+            assert outcome == expected and len(server.request_ports) == expected_requests, rows[-1]
+
+    guard = UpstreamGuard(max_attempts=3, backoff_base=0.05)
+    outcome, elapsed = await _generate(_client(_unused_url(), guard))
+    rows.append(["connection refused", 0, guard.retries, outcome, f"{elapsed:.2f}"])
+    assert guard.retries == 2, rows[-1]
+
+    _print_table(["scenario", "requests received", "retries", "outcome", "seconds"], rows)
+
+
+async def check_deadline(args) -> None:
+    """上游迟迟不响应时，调用在 deadline 秒内失败，而不是等到 ARK_TIMEOUT 读超时。"""
+    async with FakeArkServer([("delay", args.delay)]) as server:
+        guard = UpstreamGuard(deadline=args.deadline)
+        outcome, elapsed = await _generate(_client(server.url, guard))
+    _print_table(["deadline", "upstream delay", "outcome", "seconds"],
+                 [[f"{args.deadline:.1f}", f"{args.delay:.1f}", outcome, f"{elapsed:.2f}"]])
+    assert outcome.startswith("UpstreamError") and elapsed < args.deadline + 0.5
+
+
+async def check_breaker(args) -> None:
+    """连续失败后熔断并快速失败；恢复时间过后只放行一个探测请求，成功后关闭。"""
+    reset = 0.3
+    script = [("status", 503), ("status", 503), ("delay", 0.2)]
+    async with FakeArkServer(script) as server:
+        guard = UpstreamGuard(max_attempts=1,
+                              breaker=CircuitBreaker(failure_threshold=2, reset_timeout=reset))
+        client = _client(server.url, guard)
+        rows = []
+
+        def step(name: str, outcome: str) -> None:
+            breaker = guard.breaker.metrics()
+            rows.append([name, outcome, len(server.request_ports), breaker["state"],
+                         breaker["short_circuited"]])
+
+        for i in range(2):
+            step(f"503 #{i + 1}", (await _call(client))[0])
+        assert guard.breaker.state == CircuitBreaker.OPEN
+        step("while open", (await _call(client))[0])
+        assert rows[-1][1] == "UpstreamUnavailableError" and rows[-1][2] == 2, "熔断时不应访问上游"
+
+        await asyncio.sleep(reset)
+        # 半开：第一个请求成为探测请求（上游 0.2 秒后成功），同时到达的第二个请求被拒绝
+        probe, second = await asyncio.gather(_call(client), _call(client))
+        step("half-open probe", probe[0])
+        rows.insert(-1, ["during probe", second[0], len(server.request_ports) - 1, "half_open",
+                         guard.breaker.short_circuited])
+        await client.aclose()
+
+    _print_table(["step", "outcome", "requests received", "breaker", "short circuited"], rows)
+    metrics = guard.metrics()["breaker"]
+    assert probe[0] == "ok" and second[0] == "UpstreamUnavailableError", rows
+    assert metrics["state"] == CircuitBreaker.CLOSED and metrics["consecutive_failures"] == 0
+    assert metrics["times_opened"] == 1 and metrics["short_circuited"] == 2, metrics
+
+
+async def check_concurrency(args) -> None:
+    """并发上限内的请求排队等待名额；排队超过 queue_timeout 的请求快速失败，不访问上游。"""
+    rows = []
+    for name, queue_timeout, expected_ok in (("queue fits", 1.0, args.calls),
+                                             ("queue times out", 0.1, args.limit)):
+        async with FakeArkServer([("delay", 0.3)] * args.calls) as server:
+            guard = UpstreamGuard(max_concurrency=args.limit, queue_timeout=queue_timeout)
+            client = _client(server.url, guard)
+            started = time.perf_counter()
+            results = await asyncio.gather(*(_call(client) for _ in range(args.calls)))
+            elapsed = time.perf_counter() - started
+            await client.aclose()
+        metrics = guard.metrics()
+        ok = sum(outcome == "ok" for outcome, _ in results)
+        rows.append([name, args.calls, args.limit, ok, len(server.request_ports),
+                     metrics["queue_timeouts"], metrics["queue_wait_ms"]["max"], f"{elapsed:.2f}"])
+        assert ok == expected_ok and len(server.request_ports) == expected_ok, rows[-1]
+        assert metrics["queue_timeouts"] == args.calls - expected_ok, metrics
+        assert metrics["active"] == 0 and metrics["waiting"] == 0, metrics
+        # 排队超时是本地拒绝，不计入熔断
+        assert metrics["breaker"]["state"] == CircuitBreaker.CLOSED, metrics
+
+    _print_table(["scenario", "calls", "limit", "ok", "requests received", "queue timeouts",
+                  "max wait ms", "seconds"], rows)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="图像生成上游客户端检查（本地假服务）")
+    sub = parser.add_subparsers(dest="command", required=True)
+    pool_parser = sub.add_parser("pool", help="连接池复用和关闭")
+    pool_parser.add_argument("--calls", type=int, default=5)
+    pool_parser.set_defaults(func=check_pool)
+    sub.add_parser("retry", help="哪些失败会重试").set_defaults(func=check_retry)
+    deadline_parser = sub.add_parser("deadline", help="总时限包括请求本身")
+    deadline_parser.add_argument("--deadline", type=float, default=1.0)
+    deadline_parser.add_argument("--delay", type=float, default=5.0)
+    deadline_parser.set_defaults(func=check_deadline)
+    sub.add_parser("breaker", help="熔断、快速失败和半开探测").set_defaults(func=check_breaker)
+    c_parser = sub.add_parser("concurrency", help="并发上限和排队超时")
+    c_parser.add_argument("--calls", type=int, default=6)
+    c_parser.add_argument("--limit", type=int, default=2)
+    c_parser.set_defaults(func=check_concurrency)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
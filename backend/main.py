@@ -1,13 +1,33 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from typing import Optional
-import io
+from fastapi.responses import JSONResponse, Response
+from typing import Dict, List, Optional, Tuple
+import asyncio
 import base64
-from PIL import Image
+import json
+import threading
+import time
 
-from utils.pixel_converter import process_image_to_beads
-from utils.nanobanana_client import NanobananaClient
+from utils.pixel_converter import (
+    CLUSTER_INIT, LUT_ENGINE_BITS, PALETTE_MATCH_ENGINE, PALETTE_MATCH_METRIC, PREVIEW_MODES,
+    encode_display_image, encode_preview, expand_grid, grid_dimensions, pixelate_image_bytes,
+    pixelate_level, prepare_image_bytes, prepare_palette_lut, select_level
+)
+from utils.disk_cache import disk_cache_from_env
+from utils.image_decode import (
+    DecodeMetrics, DecodeStats, ImageRejectedError, ImageSource, inspect_image
+)
+from utils.image_store import StoredImage, store_from_env
+from utils import grid_codec
+from utils.palette_registry import Palette, palette_registry
+from utils.result_cache import cache_from_env, content_hash
+from utils.single_flight import SingleFlight
+from utils.upload import SpooledUpload, UploadSizeLimitMiddleware, spooled_upload
+from utils.quantizers import DEFAULT_QUANTIZER, QUANTIZERS
+from utils.worker_pool import PoolFullError, pool_from_env
+from utils.nanobanana_client import NanobananaClient, create_http_client
+from utils.upstream import UpstreamError, UpstreamUnavailableError
 
 import logging
 
@@ -15,7 +35,80 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+# 像素化是 CPU 密集任务，放到独立的进程池中执行，避免阻塞事件循环
+pixel_pool = pool_from_env(preload=["utils.pixel_converter"])
+
+# 像素化结果缓存：键为 (图像内容哈希, 参数, 调色板版本, 引擎)，按字节数限制容量
+result_cache = cache_from_env("RESULT_CACHE_MB", 64)
+
+# 图像会话：上传一次，之后按 image_id 反复像素化
+image_store = store_from_env()
+
+# 会话图像按网格尺寸缓存的颜色分析（缩放结果的唯一颜色、Lab 值和背景遮罩）
+analysis_cache = cache_from_env("ANALYSIS_CACHE_MB", 64)
+
+# 上传图像的解码耗时和每次解码的内存峰值增量
+decode_metrics = DecodeMetrics()
+
+# 按需生成的预览图 PNG，键为 (result_id, 预览模式)
+preview_cache = cache_from_env("PREVIEW_CACHE_MB", 16)
+
+
+# AI 生成图像的磁盘缓存，键为 (输入图像哈希, 提示词, 模型, 尺寸)；重复提交同一张图不再调用远程模型
+generation_cache = disk_cache_from_env()
+
+# 合并相同输入的并发 /generate 请求（双击、多个标签页），只调用一次远程模型
+generation_flights = SingleFlight()
+
+# 图像生成 API 客户端，整个应用共享一个带连接池的 HTTP 客户端（在 lifespan 中创建和关闭）
+ark_client: Optional[NanobananaClient] = None
+
+
+# 已开始构建查找表的调色板版本（使用查找表引擎时）
+lut_builds = set()
+
+
+def _build_palette_lut(palette: Palette) -> None:
+    started = time.perf_counter()
+    try:
+        prepare_palette_lut(palette)
+    except Exception as e:
+        logger.error(f"调色板查找表构建失败，继续使用精确匹配: {e}")
+        return
+    logger.info(f"调色板查找表就绪 ({PALETTE_MATCH_ENGINE}, {PALETTE_MATCH_METRIC}, "
+                f"版本 {palette.version})，耗时 {time.perf_counter() - started:.1f}s")
+
+
+def _current_palette() -> Palette:
+    """
+    返回当前调色板。使用查找表引擎时，每个调色板版本的查找表只在主进程的后台线程中
+    构建一次并写入磁盘，工作进程在它就绪后以 mmap 打开，就绪前退化为精确匹配。
+    """
+    palette = palette_registry.current()
+    if PALETTE_MATCH_ENGINE in LUT_ENGINE_BITS and palette.version not in lut_builds:
+        lut_builds.add(palette.version)
+        # 守护线程：构建 ciede2000 的 8 位表需要数分钟，不阻塞启动和退出
+        threading.Thread(target=_build_palette_lut, args=(palette,), daemon=True).start()
+    return palette
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global ark_client
+    _current_palette()
+    await pixel_pool.warm_up()
+    logger.info(f"像素化进程池已启动: {pixel_pool.workers} 个进程")
+    ark_client = NanobananaClient(http_client=create_http_client())
+    yield
+    await ark_client.aclose()
+    pixel_pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# 上传大小限制在接收请求体时生效（先于 Starlette 把 multipart 请求体落盘）；
+# 放在 CORS 之内，413 响应同样带跨域头
+app.add_middleware(UploadSizeLimitMiddleware)
 
 # 允许前端跨域
 app.add_middleware(
@@ -32,79 +125,519 @@ async def health_check():
     return {"status": "ok"}
 
 
+@app.get("/metrics")
+async def metrics():
+    return {
+        "pixel_pool": pixel_pool.metrics(),
+        "result_cache": result_cache.metrics(),
+        "image_store": image_store.metrics(),
+        "analysis_cache": analysis_cache.metrics(),
+        "preview_cache": preview_cache.metrics(),
+        "decode": decode_metrics.metrics(),
+        "generation_cache": generation_cache.metrics(),
+        "generation_flights": generation_flights.metrics(),
+        "upstream": ark_client.guard.metrics() if ark_client is not None else None,
+    }
+
+
+async def _generate_cached(contents: bytes, cache_key: str) -> Tuple[bytes, str]:
+    """先查磁盘缓存，未命中时调用远程模型并写入缓存。返回 (图像字节, "HIT" / "MISS")。"""
+    generated_bytes = await asyncio.to_thread(generation_cache.get, cache_key)
+    if generated_bytes is not None:
+        return generated_bytes, "HIT"
+    generated_bytes = await ark_client.generate_q_version(contents)
+    await asyncio.to_thread(generation_cache.put, cache_key, generated_bytes)
+    return generated_bytes, "MISS"
+
+
 @app.post("/generate")
 async def generate_image(
     file: Optional[UploadFile] = File(None),
-    api_url: Optional[str] = Form(None)
+    api_url: Optional[str] = Form(None),
+    pixelate: bool = Form(False),
+    grid_size: int = Form(64),
+    max_colors: int = Form(15),
+    quantizer: str = Form(DEFAULT_QUANTIZER),
+    preview: str = Form("none"),
+    include_image: bool = Form(False)
 ):
     """
-    使用豆包 Seedream 模型生成适合拼豆像素化的图像
+    使用豆包 Seedream 模型生成适合拼豆像素化的图像。
+
+    生成的图像保存为服务端图像会话，返回 image_id 和用于显示的 image_url，
+    之后 /pixelate 直接传 image_id，大图不必在浏览器和服务端之间往返。
+
+    参数:
+        file: 可选的输入图像（图生图）
+        pixelate: 为 true 时立即按 grid_size / max_colors / quantizer / preview 像素化，
+                  结果放在 pixelation 字段（格式同 /pixelate 的 JSON 响应）
+        include_image: 为 true 时额外返回完整尺寸的生成图（base64 data URL），用于下载
     """
-    try:
-        client = NanobananaClient()
+    if quantizer not in QUANTIZERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"未知的颜色量化器: {quantizer}，可选: {', '.join(QUANTIZERS)}"
+        )
+    _check_preview_mode(preview)
 
+    try:
         contents = None
+        cache_key = None
         if file:
-            contents = await file.read()
+            async with spooled_upload(file) as upload:
+                contents = upload.read_bytes()
+                inspect_image(contents)
+                cache_key = ark_client.cache_key(upload.digest)
 
         logger.info("收到图片生成请求")
 
-        generated_bytes = await client.generate_q_version(contents)
+        # 只缓存和合并图生图：没有输入图像时每次生成都应该不同
+        if cache_key is None:
+            generated_bytes = await ark_client.generate_q_version(contents)
+            cache_status = "MISS"
+        else:
+            (generated_bytes, cache_status), shared = await generation_flights.do(
+                cache_key, lambda: _generate_cached(contents, cache_key)
+            )
+            if shared:
+                cache_status = "COALESCED"
+
+        stored = await _store_image(content_hash(generated_bytes), generated_bytes)
+        content = {
+            "image_id": stored.image_id,
+            "image_url": f"/images/{stored.image_id}/image",
+            "width": stored.source_size[0],
+            "height": stored.source_size[1],
+            "expires_in": int(image_store.ttl_seconds),
+        }
+        if pixelate:
+            palette = _current_palette()
+            result, _ = await _pixelate_stored(stored, grid_size, max_colors, quantizer, palette)
+            content["pixelation"] = _pixelation_payload(result, palette, preview)
+        if include_image:
+            b64_img = base64.b64encode(generated_bytes).decode('utf-8')
+            content["image"] = f"data:image/png;base64,{b64_img}"
 
-        b64_img = base64.b64encode(generated_bytes).decode('utf-8')
-        return JSONResponse(content={"image": f"data:image/png;base64,{b64_img}"})
+        return JSONResponse(content=content, headers={"X-Cache": cache_status})
 
+    except ImageRejectedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except UpstreamUnavailableError as e:
+        logger.warning(f"/generate 快速失败: {e}")
+        raise HTTPException(status_code=503, detail=str(e),
+                            headers={"Retry-After": str(max(1, round(e.retry_after)))})
+    except UpstreamError as e:
+        logger.error(f"/generate 上游错误: {e}")
+        raise HTTPException(status_code=502, detail=str(e))
+    except PoolFullError as e:
+        logger.warning(f"/generate 拒绝请求: {e}")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
         logger.error(f"/generate 接口错误: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _result_key(source: Tuple[str, str], size, max_colors: int, quantizer: str,
+                palette: Palette) -> str:
+    """
+    像素化结果的内容寻址 ID：由图像来源、参数、调色板版本、聚类初始化方式（只影响会话图像）、
+    匹配引擎和色差公式决定，同时作为结果缓存的键和预览图 URL 的一部分。
+    """
+    key = (source, size, max_colors, palette.version, quantizer, CLUSTER_INIT,
+           PALETTE_MATCH_ENGINE, PALETTE_MATCH_METRIC)
+    return content_hash(repr(key).encode("utf-8"))
+
+
+def _preview_url(result: Dict, preview: str) -> Optional[str]:
+    if preview == "none":
+        return None
+    return f"/pixelate/{result['result_id']}/preview?mode={preview}"
+
+
+def _check_preview_mode(preview: str) -> None:
+    if preview not in PREVIEW_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"未知的预览模式: {preview}，可选: {', '.join(PREVIEW_MODES)}"
+        )
+
+
+def _pixelation_payload(result: Dict, palette: Palette, preview: str = "none") -> Dict:
+    """把紧凑的像素化结果展开为接口返回的 JSON 结构。"""
+    grid_ids, used_palette = expand_grid(
+        result["grid_indices"], result["used_indices"], palette
+    )
+
+    return {
+        "result_id": result["result_id"],
+        "preview_url": _preview_url(result, preview),  # 预览图单独通过 GET 获取，可被缓存
+        "grid_data": grid_ids,            # 二维调色板 ID 数组
+        "used_palette": used_palette,     # 实际使用的颜色列表
+        "width": result["width"],
+        "height": result["height"]
+    }
+
+
+async def _pixelate_stored(stored: StoredImage, grid_size: int, max_colors: int,
+                           quantizer: str, palette: Palette) -> Tuple[Dict, str]:
+    """
+    像素化服务端保存的图像，依次查询结果缓存和颜色分析缓存。
+    返回 (紧凑结果, "HIT" / "MISS")。
+    """
+    base = stored.array
+    target_size = grid_dimensions(base.shape[1], base.shape[0], grid_size)
+    cache_key = _result_key(("image", stored.image_id), target_size, max_colors,
+                            quantizer, palette)
+    result = result_cache.get(cache_key)
+    if result is not None:
+        return result, "HIT"
+
+    # 同一网格尺寸的颜色分析可以跨 max_colors / 量化器复用，其中还保存了各量化器的参考聚类中心，
+    # 调整 max_colors 时从参考中心热启动聚类
+    analysis_key = (stored.image_id, target_size)
+    analysis = analysis_cache.get(analysis_key)
+    level = None if analysis is not None else select_level(stored.levels, *target_size)
+    result, analysis = await pixel_pool.run(
+        pixelate_level, level, target_size, max_colors, quantizer, analysis
+    )
+    analysis_cache.put(analysis_key, analysis)
+    result["result_id"] = cache_key
+    result_cache.put(cache_key, result)
+    return result, "MISS"
+
+
+def _log_decode(stats: DecodeStats) -> None:
+    logger.info(
+        f"解码 {stats.format} {stats.source_size[0]}x{stats.source_size[1]} -> "
+        f"{stats.decoded_size[0]}x{stats.decoded_size[1]}（1/{stats.scale}），"
+        f"耗时 {stats.decode_ms} ms，内存峰值增量 {stats.peak_mem_mb} MB"
+    )
+
+
+async def _store_image(image_id: str, source: ImageSource) -> StoredImage:
+    """解码图像并保存为服务端图像会话；相同内容（image_id）直接复用已有会话。"""
+    item = image_store.get(image_id)
+    if item is None:
+        inspect_image(source)
+        levels, source_size, stats = await pixel_pool.run(prepare_image_bytes, source)
+        decode_metrics.record(stats)
+        _log_decode(stats)
+        item = image_store.put(StoredImage(image_id, levels, source_size))
+        logger.info(
+            f"保存图像会话 {image_id}: 原图 {source_size[0]}x{source_size[1]}，"
+            f"金字塔 {' / '.join(f'{lv.shape[1]}x{lv.shape[0]}' for lv in levels)}"
+        )
+    return item
+
+
+async def _store_upload(upload: SpooledUpload) -> StoredImage:
+    return await _store_image(upload.digest, upload.source)
+
+
+@app.post("/images")
+async def upload_image(file: UploadFile = File(...)):
+    """
+    上传图像并保存在服务端，返回 image_id。
+    之后调整网格和颜色参数时，/pixelate 只需传 image_id，无需重复上传和解码。
+    """
+    try:
+        async with spooled_upload(file) as upload:
+            item = await _store_upload(upload)
+
+        return {
+            "image_id": item.image_id,
+            "width": item.source_size[0],
+            "height": item.source_size[1],
+            "expires_in": int(image_store.ttl_seconds),
+        }
+
+    except ImageRejectedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except PoolFullError as e:
+        logger.warning(f"/images 拒绝请求: {e}")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except Exception as e:
+        logger.error(f"/images 接口错误: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/images/{image_id}/image")
+async def get_image(image_id: str, request: Request):
+    """
+    返回服务端保存的图像（预缩小后的第 0 层，最长边不超过 1024）用于显示，JPEG 格式。
+    image_id 是图像内容哈希，响应可以被长期缓存。
+    """
+    etag = f'"{image_id}"'
+    cache_headers = {"Cache-Control": "public, max-age=86400, immutable", "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cache_headers)
+
+    jpeg = preview_cache.get(("image", image_id))
+    if jpeg is None:
+        stored = image_store.get(image_id)
+        if stored is None:
+            raise HTTPException(status_code=404, detail="图像不存在或已过期")
+        jpeg = await asyncio.to_thread(encode_display_image, stored.array)
+        preview_cache.put(("image", image_id), jpeg)
+    return Response(content=jpeg, media_type="image/jpeg", headers=cache_headers)
+
+
+@app.delete("/images/{image_id}")
+async def delete_image(image_id: str):
+    if not image_store.delete(image_id):
+        raise HTTPException(status_code=404, detail="图像不存在或已过期")
+    return {"status": "ok"}
+
+
 @app.post("/pixelate")
 async def pixelate_image(
-    file: UploadFile = File(...),
+    request: Request,
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
     grid_size: int = Form(64),
-    max_colors: int = Form(15)
+    max_colors: int = Form(15),
+    quantizer: str = Form(DEFAULT_QUANTIZER),
+    format: Optional[str] = Form(None),
+    rle: bool = Form(False),
+    preview: str = Form("none")
 ):
     """
     将上传的图像转换为拼豆像素图案。
 
     参数:
-        file: 图像文件
+        file: 图像文件（与 image_id 二选一）
+        image_id: 通过 /images 上传得到的图像 ID
         grid_size: 网格宽度（像素/格子数）
         max_colors: 最大使用的拼豆颜色数量（默认15）
+        quantizer: 颜色量化器 (kmeans / minibatch / lab_kmeans / median_cut / octree / wu)
+        format: 响应格式 json / binary / msgpack；不传时按 Accept 头协商，默认 json
+        rle: 二进制 / msgpack 格式下网格是否使用游程编码
+        preview: 预览图模式 none / native / scaled；非 none 时返回 preview_url，
+                 预览图通过 GET /pixelate/{result_id}/preview 按需生成
     """
     try:
-        contents = await file.read()
-        logger.info(
-            f"收到像素化请求。文件大小: {len(contents)} 字节。"
-            f"网格: {grid_size}。最大颜色数: {max_colors}"
+        response_format = grid_codec.negotiate_format(format, request.headers.get("accept"))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if response_format == "msgpack" and grid_codec.msgpack is None:
+        raise HTTPException(status_code=406, detail="服务端未安装 msgpack，请使用 json 或 binary 格式")
+    _check_preview_mode(preview)
+
+    if quantizer not in QUANTIZERS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"未知的颜色量化器: {quantizer}，可选: {', '.join(QUANTIZERS)}"
         )
+    if file is None and not image_id:
+        raise HTTPException(status_code=400, detail="需要提供 file 或 image_id")
 
-        if len(contents) == 0:
-            raise ValueError("接收到空文件")
+    stored = None
+    if image_id and file is None:
+        stored = image_store.get(image_id)
+        if stored is None:
+            raise HTTPException(status_code=404, detail="图像不存在或已过期，请重新上传")
 
-        image = Image.open(io.BytesIO(contents)).convert("RGB")
+    try:
+        palette = _current_palette()
 
-        result = process_image_to_beads(image, grid_size=grid_size, max_colors=max_colors)
+        if stored is not None:
+            logger.info(
+                f"收到像素化请求。图像 ID: {image_id}。"
+                f"网格: {grid_size}。最大颜色数: {max_colors}。量化器: {quantizer}"
+            )
+            result, cache_status = await _pixelate_stored(
+                stored, grid_size, max_colors, quantizer, palette
+            )
+        else:
+            async with spooled_upload(file) as upload:
+                logger.info(
+                    f"收到像素化请求。文件大小: {upload.size} 字节。"
+                    f"网格: {grid_size}。最大颜色数: {max_colors}。量化器: {quantizer}"
+                )
 
-        # 将预览图转为 base64
-        buffered = io.BytesIO()
-        result["quantized_image"].save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
+                cache_key = _result_key(("upload", upload.digest), grid_size, max_colors,
+                                        quantizer, palette)
+                result = result_cache.get(cache_key)
+                cache_status = "HIT" if result is not None else "MISS"
+                if result is None:
+                    # 在主进程只读文件头，超限的图像不进入进程池
+                    source = upload.source
+                    inspect_image(source)
+                    result, stats = await pixel_pool.run(
+                        pixelate_image_bytes, source, grid_size, max_colors, quantizer
+                    )
+                    decode_metrics.record(stats)
+                    _log_decode(stats)
+                    result["result_id"] = cache_key
+                    result_cache.put(cache_key, result)
 
-        return JSONResponse(content={
-            "preview": f"data:image/png;base64,{img_str}",
-            "grid_data": result["grid_data"],        # 二维调色板 ID 数组
-            "used_palette": result["used_palette"],   # 实际使用的颜色列表
-            "width": result["width"],
-            "height": result["height"]
-        })
+        headers = {"X-Cache": cache_status, "Vary": "Accept"}
+        if response_format == "binary":
+            return Response(
+                content=grid_codec.encode_binary(result, palette, rle=rle),
+                media_type=grid_codec.MEDIA_BINARY, headers=headers
+            )
+        if response_format == "msgpack":
+            return Response(
+                content=grid_codec.encode_msgpack(
+                    result, palette, rle=rle, preview_url=_preview_url(result, preview)
+                ),
+                media_type=grid_codec.MEDIA_MSGPACK, headers=headers
+            )
+        return JSONResponse(content=_pixelation_payload(result, palette, preview), headers=headers)
 
+    except ImageRejectedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except PoolFullError as e:
+        logger.warning(f"/pixelate 拒绝请求: {e}")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
         logger.error(f"/pixelate 接口错误: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/pixelate/{result_id}/preview")
+async def pixelate_preview(result_id: str, request: Request, mode: str = Query("native")):
+    """
+    按需生成像素化结果的预览图（"P" 模式 PNG）。
+    result_id 由参数和调色板版本决定，内容不会变化，响应可以被浏览器和 CDN 长期缓存。
+    结果已被缓存淘汰或调色板已更新时返回 404，需要重新请求 /pixelate。
+    """
+    if mode not in ("native", "scaled"):
+        raise HTTPException(status_code=400, detail=f"未知的预览模式: {mode}，可选: native, scaled")
+
+    etag = f'"{result_id}-{mode}"'
+    cache_headers = {"Cache-Control": "public, max-age=86400, immutable", "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cache_headers)
+
+    png = preview_cache.get((result_id, mode))
+    if png is None:
+        result = result_cache.get(result_id)
+        palette = _current_palette()
+        if result is None or result["palette_version"] != palette.version:
+            raise HTTPException(status_code=404, detail="像素化结果不存在或已过期，请重新像素化")
+        png = await asyncio.to_thread(
+            encode_preview, result["grid_indices"], result["used_indices"], mode, palette
+        )
+        preview_cache.put((result_id, mode), png)
+    return Response(content=png, media_type="image/png", headers=cache_headers)
+
+
+# 单次批量请求允许的最大参数组合数
+MAX_BATCH_VARIANTS = 32
+
+
+def _parse_variants(raw: str) -> List[Dict]:
+    """解析并校验批量像素化的参数组合列表。"""
+    try:
+        variants = json.loads(raw)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"variants 不是合法的 JSON: {e}")
+    if not isinstance(variants, list) or not variants:
+        raise HTTPException(status_code=400, detail="variants 必须是非空数组")
+    if len(variants) > MAX_BATCH_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"variants 最多 {MAX_BATCH_VARIANTS} 组")
+
+    parsed = []
+    for v in variants:
+        try:
+            item = {
+                "grid_size": int(v.get("grid_size", 64)),
+                "max_colors": int(v.get("max_colors", 15)),
+                "quantizer": str(v.get("quantizer", DEFAULT_QUANTIZER)),
+            }
+        except (AttributeError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail=f"无效的参数组合: {v}")
+        if item["quantizer"] not in QUANTIZERS:
+            raise HTTPException(status_code=400, detail=f"未知的颜色量化器: {item['quantizer']}")
+        parsed.append(item)
+    return parsed
+
+
+@app.post("/pixelate/batch")
+async def pixelate_batch(
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Form(None),
+    variants: str = Form(...),
+    preview: str = Form("none")
+):
+    """
+    用多组参数批量像素化同一张图。
+
+    参数:
+        file / image_id: 图像文件或已上传的图像 ID（二选一）
+        variants: JSON 数组，例如 [{"grid_size": 32, "max_colors": 10}, ...]，
+                  每项可选 quantizer
+        preview: 预览图模式 none / native / scaled，同 /pixelate
+
+    图像只解码一次并保存为会话（响应中返回 image_id），金字塔、
+    每个网格尺寸的颜色分析和调色板索引在所有组合之间共享；
+    不同网格尺寸并行计算，同一网格尺寸先算一次颜色分析，其余组合再并行量化。
+    """
+    params = _parse_variants(variants)
+    _check_preview_mode(preview)
+    if file is None and not image_id:
+        raise HTTPException(status_code=400, detail="需要提供 file 或 image_id")
+
+    try:
+        if file is not None:
+            async with spooled_upload(file) as upload:
+                stored = await _store_upload(upload)
+        else:
+            stored = image_store.get(image_id)
+            if stored is None:
+                raise HTTPException(status_code=404, detail="图像不存在或已过期，请重新上传")
+
+        logger.info(f"收到批量像素化请求。图像 ID: {stored.image_id}。组合数: {len(params)}")
+        palette = _current_palette()
+
+        # 同一批次内最多占用 workers 个并发任务，避免一次批量请求挤满队列
+        slots = asyncio.Semaphore(pixel_pool.workers)
+
+        async def run_variant(p: Dict) -> Tuple[Dict, str]:
+            async with slots:
+                return await _pixelate_stored(
+                    stored, p["grid_size"], p["max_colors"], p["quantizer"], palette
+                )
+
+        async def run_group(indices: List[int]) -> List[Tuple[int, Dict, str]]:
+            # 第一个组合顺带计算并缓存该网格尺寸的颜色分析，其余组合并行复用
+            first = await run_variant(params[indices[0]])
+            rest = await asyncio.gather(*[run_variant(params[i]) for i in indices[1:]])
+            return [(i, *r) for i, r in zip(indices, [first, *rest])]
+
+        base = stored.array
+        groups: Dict[Tuple[int, int], List[int]] = {}
+        for i, p in enumerate(params):
+            target = grid_dimensions(base.shape[1], base.shape[0], p["grid_size"])
+            groups.setdefault(target, []).append(i)
+
+        outcomes = await asyncio.gather(*[run_group(idx) for idx in groups.values()])
+
+        results: List[Optional[Dict]] = [None] * len(params)
+        for group in outcomes:
+            for i, result, cache_status in group:
+                results[i] = {
+                    **params[i],
+                    **_pixelation_payload(result, palette, preview),
+                    "cache": cache_status,
+                }
+
+        return JSONResponse(content={"image_id": stored.image_id, "results": results})
+
+    except HTTPException:
+        raise
+    except ImageRejectedError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except PoolFullError as e:
+        logger.warning(f"/pixelate/batch 拒绝请求: {e}")
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except Exception as e:
+        logger.error(f"/pixelate/batch 接口错误: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,188 @@
+import os
+from typing import Optional
+
+import numpy as np
+
+# 支持的色差公式
+METRICS = ("cie76", "cie94", "ciede2000")
+
+# 逐块计算 N×P 距离矩阵时每块的颜色数（每块临时数组约 CHUNK_SIZE×P×8 字节）
+CHUNK_SIZE = 4096
+# CIE76 预筛选保留的候选数：先用欧氏距离取最近的 k 个调色板颜色，
+# 只在这些候选上计算昂贵的色差公式；0 表示逐个比较全部调色板颜色（精确）
+PRUNE_CANDIDATES = int(os.environ.get("PALETTE_MATCH_CANDIDATES", 0))
+
+
+def delta_e_cie76(lab1: np.ndarray, lab2: np.ndarray) -> np.ndarray:
+    """CIE76：Lab 空间欧氏距离。lab1 / lab2 shape (..., 3)，可广播。"""
+    diff = np.asarray(lab1, dtype=np.float64) - np.asarray(lab2, dtype=np.float64)
+    return np.sqrt(np.einsum("...i,...i->...", diff, diff))
+
+
+def delta_e_cie94(lab1: np.ndarray, lab2: np.ndarray) -> np.ndarray:
+    """
+    CIE94（印刷参数 kL=1, K1=0.045, K2=0.015）。
+    公式不对称，lab1 为参考色（匹配时为待匹配颜色），S_C / S_H 取其彩度。
+    """
+    lab1 = np.asarray(lab1, dtype=np.float64)
+    lab2 = np.asarray(lab2, dtype=np.float64)
+    L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    C1 = np.hypot(a1, b1)
+    C2 = np.hypot(a2, b2)
+    dL = L1 - L2
+    dC = C1 - C2
+    da = a1 - a2
+    db = b1 - b2
+    # ΔH² = Δa² + Δb² - ΔC²，数值误差可能略小于 0
+    dH2 = np.maximum(da * da + db * db - dC * dC, 0.0)
+
+    sc = 1.0 + 0.045 * C1
+    sh = 1.0 + 0.015 * C1
+    return np.sqrt(dL * dL + (dC / sc) ** 2 + dH2 / (sh * sh))
+
+
+_TWO_PI = 2.0 * np.pi
+_DEG6, _DEG30, _DEG63 = np.radians([6.0, 30.0, 63.0])
+_POW25_7 = 25.0 ** 7
+
+
+def delta_e_ciede2000(lab1: np.ndarray, lab2: np.ndarray) -> np.ndarray:
+    """CIEDE2000（kL=kC=kH=1），按 Sharma 等人 (2005) 的公式逐元素计算。"""
+    lab1 = np.asarray(lab1, dtype=np.float64)
+    lab2 = np.asarray(lab2, dtype=np.float64)
+    L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    # a' 校正
+    c_bar = (np.hypot(a1, b1) + np.hypot(a2, b2)) / 2.0
+    c_bar7 = c_bar ** 7
+    g = 0.5 * (1.0 - np.sqrt(c_bar7 / (c_bar7 + _POW25_7)))
+    a1p = (1.0 + g) * a1
+    a2p = (1.0 + g) * a2
+    c1p = np.hypot(a1p, b1)
+    c2p = np.hypot(a2p, b2)
+    # 色相角用弧度计算，范围 [0, 2π)
+    h1p = np.arctan2(b1, a1p)
+    h1p = np.where(h1p < 0.0, h1p + _TWO_PI, h1p)
+    h2p = np.arctan2(b2, a2p)
+    h2p = np.where(h2p < 0.0, h2p + _TWO_PI, h2p)
+
+    # ΔL' ΔC' ΔH'
+    dLp = L2 - L1
+    dCp = c2p - c1p
+    c_prod = c1p * c2p
+    dhp = h2p - h1p
+    dhp = np.where(dhp > np.pi, dhp - _TWO_PI, dhp)
+    dhp = np.where(dhp < -np.pi, dhp + _TWO_PI, dhp)
+    dhp = np.where(c_prod == 0.0, 0.0, dhp)
+    dHp = 2.0 * np.sqrt(c_prod) * np.sin(dhp / 2.0)
+
+    # 均值
+    Lp_bar = (L1 + L2) / 2.0
+    Cp_bar = (c1p + c2p) / 2.0
+    h_sum = h1p + h2p
+    h_diff = np.abs(h1p - h2p)
+    hp_bar = np.where(h_diff > np.pi,
+                      np.where(h_sum < _TWO_PI, h_sum + _TWO_PI, h_sum - _TWO_PI),
+                      h_sum) / 2.0
+    hp_bar = np.where(c_prod == 0.0, h_sum, hp_bar)
+
+    t = (1.0
+         - 0.17 * np.cos(hp_bar - _DEG30)
+         + 0.24 * np.cos(2.0 * hp_bar)
+         + 0.32 * np.cos(3.0 * hp_bar + _DEG6)
+         - 0.20 * np.cos(4.0 * hp_bar - _DEG63))
+    # Δθ 以度为单位：30·exp(-((h̄' - 275°) / 25°)²)
+    d_theta = 30.0 * np.exp(-(((np.degrees(hp_bar) - 275.0) / 25.0) ** 2))
+    cp_bar7 = Cp_bar ** 7
+    rc = 2.0 * np.sqrt(cp_bar7 / (cp_bar7 + _POW25_7))
+    l50 = (Lp_bar - 50.0) ** 2
+    sl = 1.0 + 0.015 * l50 / np.sqrt(20.0 + l50)
+    sc = 1.0 + 0.045 * Cp_bar
+    sh = 1.0 + 0.015 * Cp_bar * t
+    rt = -np.sin(np.radians(2.0 * d_theta)) * rc
+
+    tl = dLp / sl
+    tc = dCp / sc
+    th = dHp / sh
+    return np.sqrt(tl * tl + tc * tc + th * th + rt * tc * th)
+
+
+_DELTA_E = {
+    "cie76": delta_e_cie76,
+    "cie94": delta_e_cie94,
+    "ciede2000": delta_e_ciede2000,
+}
+
+
+def delta_e(lab1: np.ndarray, lab2: np.ndarray, metric: str = "cie76") -> np.ndarray:
+    """按 metric 计算逐元素色差，lab1 / lab2 shape (..., 3)，可广播。"""
+    try:
+        fn = _DELTA_E[metric]
+    except KeyError:
+        raise ValueError(f"未知的色差公式: {metric}，可选: {', '.join(METRICS)}") from None
+    return fn(lab1, lab2)
+
+
+def _cie94_scale(lab: np.ndarray) -> np.ndarray:
+    """CIE94 的 S_C（以待匹配颜色为参考色）。S_C >= S_H >= 1，故 ΔE94 >= ΔE76 / S_C。"""
+    return 1.0 + 0.045 * np.hypot(lab[:, 1], lab[:, 2])
+
+
+def nearest_colors(lab: np.ndarray, reference_lab: np.ndarray, metric: str = "ciede2000",
+                   chunk_size: int = CHUNK_SIZE,
+                   candidates: Optional[int] = None) -> np.ndarray:
+    """
+    在 reference_lab (P, 3) 中为每个颜色 lab (N, 3) 查找色差最小的索引。
+
+    按 chunk_size 分块计算 N×P 的距离矩阵，内存占用与 N 无关。
+
+    candidates (默认 PRUNE_CANDIDATES) > 0 时启用 CIE76 预筛选：先取欧氏距离最近的
+    k 个候选，只在候选上计算 metric，计算量从 N×P 降到约 N×k。
+    - CIE94 有下界 ΔE94 >= ΔE76 / S_C：若第 k+1 近的颜色按下界也不可能更近，
+      候选中的最小值即为精确结果，否则该颜色回退到完整比较，结果与不筛选完全一致
+    - CIEDE2000 没有实用的下界，筛选是近似的（见 benchmark.py metric 的误配率）
+    """
+    lab = np.asarray(lab, dtype=np.float64).reshape(-1, 3)
+    reference_lab = np.asarray(reference_lab, dtype=np.float64).reshape(-1, 3)
+    delta_e(lab[:0], reference_lab[:0], metric)  # 校验 metric
+    if candidates is None:
+        candidates = PRUNE_CANDIDATES
+    num_ref = reference_lab.shape[0]
+    k = min(candidates, num_ref)
+    prune = metric != "cie76" and 0 < k < num_ref
+
+    out = np.empty(lab.shape[0], dtype=np.int32)
+    # |x - y|² = |x|² - 2x·y + |y|²，CIE76 的距离矩阵用一次矩阵乘法得到
+    ref_sq = np.einsum("ij,ij->i", reference_lab, reference_lab)
+    for start in range(0, lab.shape[0], chunk_size):
+        chunk = lab[start:start + chunk_size]
+        rows = np.arange(chunk.shape[0])
+        if metric == "cie76" or prune:
+            d76_sq = ref_sq - 2.0 * (chunk @ reference_lab.T)  # 每行少加了常数 |x|²
+        if metric == "cie76":
+            out[start:start + chunk.shape[0]] = np.argmin(d76_sq, axis=1)
+            continue
+        if not prune:
+            dist = delta_e(chunk[:, None, :], reference_lab[None, :, :], metric)  # (n, P)
+            out[start:start + chunk.shape[0]] = np.argmin(dist, axis=1)
+            continue
+
+        # 第 k 位放第 k+1 近的颜色，前 k 位为候选（顺序不定）
+        part = np.argpartition(d76_sq, k, axis=1)
+        cand = part[:, :k]
+        dist = delta_e(chunk[:, None, :], reference_lab[cand], metric)  # (n, k)
+        best_pos = np.argmin(dist, axis=1)
+        best = cand[rows, best_pos]
+
+        if metric == "cie94":
+            chunk_sq = np.einsum("ij,ij->i", chunk, chunk)
+            next_d76 = np.sqrt(np.maximum(d76_sq[rows, part[:, k]] + chunk_sq, 0.0))
+            unsure = next_d76 / _cie94_scale(chunk) < dist[rows, best_pos]
+            if unsure.any():
+                full = delta_e(chunk[unsure][:, None, :], reference_lab[None, :, :], metric)
+                best[unsure] = np.argmin(full, axis=1)
+        out[start:start + chunk.shape[0]] = best
+    return out
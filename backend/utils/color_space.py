@@ -0,0 +1,108 @@
+from typing import Optional
+
+import numpy as np
+
+# D65 白点参考值
+_WHITE_D65 = np.array([0.95047, 1.00000, 1.08883])
+
+# 标准的 sRGB -> XYZ 转换矩阵
+_SRGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+])
+
+# XYZ -> Lab 的非线性函数参数
+_EPSILON = 0.008856
+_KAPPA = 903.3
+
+
+def _srgb_to_linear(rgb_norm: np.ndarray) -> np.ndarray:
+    """sRGB gamma 校正 -> 线性 RGB，输入归一化到 [0, 1]。"""
+    return np.where(rgb_norm > 0.04045, ((rgb_norm + 0.055) / 1.055) ** 2.4, rgb_norm / 12.92)
+
+
+# 256 项 sRGB -> 线性 RGB 查找表（uint8 输入直接查表，避免逐像素求幂）
+_LINEAR_LUT = _srgb_to_linear(np.arange(256) / 255.0).astype(np.float32)
+
+# 白点归一化并入矩阵：linear_rgb @ _XYZ_MATRIX_T 直接得到 (X/Xn, Y/Yn, Z/Zn)
+_XYZ_MATRIX_T = np.ascontiguousarray((_SRGB_TO_XYZ / _WHITE_D65[:, None]).T, dtype=np.float32)
+
+
+def rgb_to_lab(rgb: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    将 RGB (0-255) 转换为 CIELAB 色彩空间。
+    使用 D65 白点作为参考。
+    输入: shape (..., 3), dtype uint8 或 float [0,255]
+    输出: shape (..., 3), dtype float32, L [0,100], a/b [-128,127]
+
+    uint8 输入通过 256 项查找表完成 gamma 校正，RGB -> XYZ 为一次矩阵乘法，
+    全程 float32 并尽量原地计算。out 可传入预分配的 float32 缓冲区
+    (shape 与输入相同) 以避免分配结果数组。与 rgb_to_lab_reference 的
+    误差在 1e-3 以内。
+    """
+    rgb = np.asarray(rgb)
+    shape = rgb.shape
+    flat = rgb.reshape(-1, 3)
+
+    # sRGB gamma 校正 -> 线性 RGB
+    if flat.dtype == np.uint8:
+        linear = _LINEAR_LUT[flat]
+    else:
+        linear = _srgb_to_linear(flat.astype(np.float32) / np.float32(255.0)).astype(np.float32)
+
+    # 线性 RGB -> 归一化 XYZ
+    xyz = linear @ _XYZ_MATRIX_T
+
+    # XYZ -> Lab 的非线性函数，结果写回 xyz 缓冲区
+    small = xyz <= _EPSILON
+    small_values = xyz[small]
+    f = np.cbrt(xyz, out=xyz)
+    f[small] = (small_values * np.float32(_KAPPA) + np.float32(16.0)) / np.float32(116.0)
+
+    if out is None:
+        lab = np.empty((flat.shape[0], 3), dtype=np.float32)
+    else:
+        lab = out.reshape(-1, 3)
+    fx, fy, fz = f[:, 0], f[:, 1], f[:, 2]
+    np.multiply(fy, np.float32(116.0), out=lab[:, 0])
+    lab[:, 0] -= np.float32(16.0)
+    np.subtract(fx, fy, out=lab[:, 1])
+    lab[:, 1] *= np.float32(500.0)
+    np.subtract(fy, fz, out=lab[:, 2])
+    lab[:, 2] *= np.float32(200.0)
+
+    return lab.reshape(shape) if out is None else out
+
+
+def rgb_to_lab_reference(rgb: np.ndarray) -> np.ndarray:
+    """
+    float64 的逐项参考实现（原 rgb_to_lab），用于精度对比和基准测试。
+    输出: shape (..., 3), dtype float64
+    """
+    # 归一化到 [0, 1]
+    rgb_norm = rgb.astype(np.float64) / 255.0
+
+    # sRGB gamma 校正 -> 线性 RGB
+    rgb_linear = _srgb_to_linear(rgb_norm)
+
+    # 线性 RGB -> XYZ (D65 白点)
+    r, g, b = rgb_linear[..., 0], rgb_linear[..., 1], rgb_linear[..., 2]
+    x = r * 0.4124564 + g * 0.3575761 + b * 0.1804375
+    y = r * 0.2126729 + g * 0.7151522 + b * 0.0721750
+    z = r * 0.0193339 + g * 0.1191920 + b * 0.9503041
+
+    xn, yn, zn = _WHITE_D65
+    x /= xn
+    y /= yn
+    z /= zn
+
+    fx = np.where(x > _EPSILON, np.cbrt(x), (_KAPPA * x + 16.0) / 116.0)
+    fy = np.where(y > _EPSILON, np.cbrt(y), (_KAPPA * y + 16.0) / 116.0)
+    fz = np.where(z > _EPSILON, np.cbrt(z), (_KAPPA * z + 16.0) / 116.0)
+
+    L = 116.0 * fy - 16.0
+    a = 500.0 * (fx - fy)
+    b_val = 200.0 * (fy - fz)
+
+    return np.stack([L, a, b_val], axis=-1)
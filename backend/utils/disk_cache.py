@@ -0,0 +1,138 @@
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), ".cache", "generated")
+
+
+class DiskCache:
+    """
+    内容寻址的磁盘缓存，每个条目一个文件（文件名为键）。
+
+    条目写入 ttl_seconds 秒后过期；总字节数超过 max_bytes 时按最久未访问的顺序淘汰。
+    启动时扫描目录重建索引，进程重启后缓存仍然有效。写入先写临时文件再原子重命名，
+    读取方不会看到写了一半的文件。
+    """
+
+    SUFFIX = ".bin"
+
+    def __init__(self, directory: str, ttl_seconds: float = 7 * 24 * 3600,
+                 max_bytes: int = 512 * 1024 * 1024):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # key -> (字节数, 写入时间)；按访问顺序排列
+        self._index: "OrderedDict[str, Tuple[int, float]]" = OrderedDict()
+        self.current_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def _load_index(self) -> None:
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, name[:-len(self.SUFFIX)], st.st_size))
+        for mtime, key, size in sorted(entries):
+            self._index[key] = (size, mtime)
+            self.current_bytes += size
+
+    def _remove(self, key: str) -> None:
+        size, _ = self._index.pop(key)
+        self.current_bytes -= size
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is not None and time.time() - entry[1] > self.ttl_seconds:
+                self._remove(key)
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key), "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                # 文件被外部删除
+                self._index.pop(key)
+                self.current_bytes -= entry[0]
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+        with self._lock:
+            if key in self._index:
+                size, _ = self._index.pop(key)
+                self.current_bytes -= size
+            self._index[key] = (len(data), time.time())
+            self.current_bytes += len(data)
+            while self.current_bytes > self.max_bytes and len(self._index) > 1:
+                self._remove(next(iter(self._index)))
+                self.evictions += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "directory": self.directory,
+            "entries": len(self._index),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+def disk_cache_from_env() -> DiskCache:
+    """
+    从环境变量创建生成图像的磁盘缓存：
+        GENERATE_CACHE_DIR          缓存目录（默认 backend/.cache/generated）
+        GENERATE_CACHE_TTL_SECONDS  条目有效期（默认 7 天）
+        GENERATE_CACHE_MB           最大占用磁盘空间（默认 512 MB）
+    """
+    return DiskCache(
+        os.environ.get("GENERATE_CACHE_DIR") or DEFAULT_CACHE_DIR,
+        ttl_seconds=float(os.environ.get("GENERATE_CACHE_TTL_SECONDS", 7 * 24 * 3600)),
+        max_bytes=int(float(os.environ.get("GENERATE_CACHE_MB", 512)) * 1024 * 1024),
+    )
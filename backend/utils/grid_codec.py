@@ -0,0 +1,126 @@
+import struct
+from typing import Dict, List, Optional
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:  # msgpack 为可选依赖，未安装时只支持 JSON 和二进制格式
+    msgpack = None
+
+from utils.palette_registry import Palette
+
+MEDIA_JSON = "application/json"
+MEDIA_BINARY = "application/octet-stream"
+MEDIA_MSGPACK = "application/msgpack"
+
+FORMATS = {"json": MEDIA_JSON, "binary": MEDIA_BINARY, "msgpack": MEDIA_MSGPACK}
+
+# 二进制格式（小端序）：
+#   header   magic "PDG1" | version u8 | flags u8 | width u16 | height u16 | palette_count u16
+#   palette  palette_count 项：r u8 | g u8 | b u8 | id_len u8 | id utf-8 | name_len u8 | name utf-8
+#   grid     flags & FLAG_RLE == 0：width * height 个 u8，值为 palette 表中的下标
+#            flags & FLAG_RLE != 0：若干 (run_length u16, value u8) 三字节游程，按行优先顺序展开
+MAGIC = b"PDG1"
+VERSION = 1
+FLAG_RLE = 0x01
+HEADER = struct.Struct("<4sBBHHH")
+RUN = np.dtype([("length", "<u2"), ("value", "u1")])
+MAX_RUN = 0xFFFF
+
+
+def negotiate_format(format_param: Optional[str], accept: Optional[str]) -> str:
+    """
+    确定响应格式：显式的 format 参数优先，其次看 Accept 头，默认 JSON。
+    返回 FORMATS 中的键；未知的 format 参数抛出 ValueError。
+    """
+    if format_param:
+        if format_param not in FORMATS:
+            raise ValueError(f"未知的响应格式: {format_param}，可选: {', '.join(FORMATS)}")
+        return format_param
+    accept = (accept or "").lower()
+    if MEDIA_BINARY in accept:
+        return "binary"
+    if MEDIA_MSGPACK in accept or "application/x-msgpack" in accept:
+        return "msgpack"
+    return "json"
+
+
+def local_grid(grid_indices: np.ndarray, used_indices: np.ndarray) -> np.ndarray:
+    """把调色板全局索引网格转换为 used_indices 表中的下标（uint8，最多 256 种已用颜色）。"""
+    if used_indices.shape[0] > 256:
+        raise ValueError("已用颜色超过 256 种，无法使用 uint8 网格编码")
+    return np.searchsorted(used_indices, grid_indices).astype(np.uint8)
+
+
+def rle_encode(values: np.ndarray) -> np.ndarray:
+    """行优先的游程编码，返回 RUN 结构化数组；超过 65535 的游程会被拆分。"""
+    flat = values.reshape(-1)
+    if flat.shape[0] == 0:
+        return np.zeros(0, dtype=RUN)
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    lengths = np.diff(np.concatenate((starts, [flat.shape[0]])))
+    run_values = flat[starts]
+
+    # 拆分过长的游程
+    pieces = -(-lengths // MAX_RUN)
+    if np.any(pieces > 1):
+        run_values = np.repeat(run_values, pieces)
+        first = np.repeat(np.cumsum(pieces) - pieces, pieces)
+        offsets = np.arange(run_values.shape[0]) - first
+        total = np.repeat(lengths, pieces)
+        lengths = np.minimum(MAX_RUN, total - offsets * MAX_RUN)
+
+    runs = np.empty(run_values.shape[0], dtype=RUN)
+    runs["length"] = lengths
+    runs["value"] = run_values
+    return runs
+
+
+def rle_decode(runs: np.ndarray) -> np.ndarray:
+    return np.repeat(runs["value"], runs["length"].astype(np.int64))
+
+
+def _palette_table(used_indices: np.ndarray, palette: Palette) -> bytes:
+    parts: List[bytes] = []
+    for i in used_indices.tolist():
+        entry = palette.entries[i]
+        pid = str(entry["id"]).encode("utf-8")[:255]
+        name = str(entry.get("name", "")).encode("utf-8")[:255]
+        parts.append(bytes(palette.rgb[i].tolist()))
+        parts.append(bytes([len(pid)]) + pid)
+        parts.append(bytes([len(name)]) + name)
+    return b"".join(parts)
+
+
+def encode_binary(result: Dict, palette: Palette, rle: bool = False) -> bytes:
+    """把紧凑像素化结果编码为 PDG1 二进制格式。"""
+    used = result["used_indices"]
+    grid = local_grid(result["grid_indices"], used)
+    body = rle_encode(grid).tobytes() if rle else grid.tobytes()
+    header = HEADER.pack(MAGIC, VERSION, FLAG_RLE if rle else 0,
+                         result["width"], result["height"], used.shape[0])
+    return header + _palette_table(used, palette) + body
+
+
+def encode_msgpack(result: Dict, palette: Palette, rle: bool = False,
+                   preview_url: Optional[str] = None) -> bytes:
+    """
+    msgpack 格式：与 JSON 结构类似，但网格为 uint8 字节串（used_palette 下标，
+    可选游程编码，格式同二进制），避免数万个字符串。
+    """
+    if msgpack is None:
+        raise RuntimeError("服务端未安装 msgpack")
+    used = result["used_indices"]
+    grid = local_grid(result["grid_indices"], used)
+    payload = {
+        "result_id": result.get("result_id"),
+        "width": result["width"],
+        "height": result["height"],
+        "used_palette": [palette.entries[i] for i in used.tolist()],
+        "grid": rle_encode(grid).tobytes() if rle else grid.tobytes(),
+        "rle": rle,
+    }
+    if preview_url is not None:
+        payload["preview_url"] = preview_url
+    return msgpack.packb(payload, use_bin_type=True)
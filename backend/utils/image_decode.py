@@ -0,0 +1,233 @@
+import io
+import os
+import sys
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple, Union
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+try:
+    import resource
+except ImportError:  # Windows 上没有 resource 模块，不统计内存峰值
+    resource = None
+
+_PROC_STATUS = "/proc/self/status"
+_PROC_CLEAR_REFS = "/proc/self/clear_refs"
+
+# 解码尺寸相对网格尺寸的倍数：BOX 面积采样需要每个格子覆盖若干源像素
+DECODE_QUALITY_FACTOR = float(os.environ.get("DECODE_QUALITY_FACTOR", 4))
+
+# 允许的最大像素数（宽 × 高），在解码前根据文件头检查，防止解压炸弹
+MAX_IMAGE_PIXELS = int(os.environ.get("MAX_IMAGE_PIXELS", 50_000_000))
+# Pillow 自带的解压炸弹检查作为兜底（超过 2 倍时抛出 DecompressionBombError）
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# 只启用常见图片格式的解码器
+ALLOWED_FORMATS = ("JPEG", "PNG", "WEBP", "GIF", "BMP", "TIFF")
+
+# EXIF Orientation 为 5-8 时图像需要旋转 90 度，宽高互换
+_ORIENTATION_TAG = 0x0112
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+class ImageRejectedError(ValueError):
+    """上传的图像不可接受；status_code 为对应的 HTTP 状态码。"""
+    status_code = 400
+
+
+class ImageTooLargeError(ImageRejectedError):
+    status_code = 413
+
+
+class UnsupportedImageError(ImageRejectedError):
+    status_code = 415
+
+
+# 图像来源：文件字节或文件路径
+ImageSource = Union[bytes, str]
+
+
+@dataclass
+class DecodeStats:
+    """一次解码的统计信息。"""
+    format: Optional[str]
+    source_size: Tuple[int, int]     # 原图尺寸 (w, h)，已按 EXIF 方向校正
+    decoded_size: Tuple[int, int]    # 实际解码得到的尺寸 (w, h)
+    scale: int                       # 缩小倍数（JPEG DCT 缩放或 reduce）
+    decode_ms: float
+    peak_mem_mb: float               # 解码过程中进程内存峰值相对解码前的增量
+
+
+def _max_rss_mb() -> float:
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位为 KB，macOS 上为字节
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _proc_status_mb(field: str) -> float:
+    with open(_PROC_STATUS) as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024  # 单位 kB
+    raise OSError(f"{_PROC_STATUS} 中没有 {field}")
+
+
+def _memory_mark() -> Tuple[bool, float]:
+    """
+    开始统计一次解码的内存峰值。Linux 上重置进程的 RSS 高水位 (VmHWM) 并记下当前 RSS；
+    其他平台只能记下进程生命周期内的最大 RSS，之后的增量只在创下新高时才大于 0（下界）。
+    高水位是进程级的，同一进程内多个线程并发解码时互相叠加，只有工作进程（一次一个任务）的统计准确。
+    """
+    try:
+        with open(_PROC_CLEAR_REFS, "w") as f:
+            f.write("5")
+        return True, _proc_status_mb("VmRSS")
+    except OSError:
+        return False, _max_rss_mb()
+
+
+def _peak_delta_mb(mark: Tuple[bool, float]) -> float:
+    """从 _memory_mark 起到现在的内存峰值增量 (MB)。"""
+    exact, base = mark
+    try:
+        peak = _proc_status_mb("VmHWM") if exact else _max_rss_mb()
+    except OSError:
+        return 0.0
+    return max(0.0, peak - base)
+
+
+def open_image(source: ImageSource) -> Image.Image:
+    """
+    打开图像并只读取文件头：检查格式和像素数，不解码像素数据。
+    不支持的格式抛出 UnsupportedImageError，像素数超限抛出 ImageTooLargeError。
+    """
+    fp = io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source
+    try:
+        image = Image.open(fp, formats=ALLOWED_FORMATS)
+    except UnidentifiedImageError:
+        raise UnsupportedImageError(f"无法识别的图像格式，支持: {', '.join(ALLOWED_FORMATS)}")
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e))
+
+    w, h = image.size
+    if w * h > MAX_IMAGE_PIXELS:
+        image.close()
+        raise ImageTooLargeError(
+            f"图像像素数过大: {w}x{h}，最多 {MAX_IMAGE_PIXELS // 1_000_000} 百万像素"
+        )
+    return image
+
+
+def inspect_image(source: ImageSource) -> Tuple[str, Tuple[int, int]]:
+    """只读取文件头，返回 (格式, 按 EXIF 方向校正后的尺寸)。"""
+    with open_image(source) as image:
+        return image.format, oriented_size(image)
+
+
+def oriented_size(image: Image.Image) -> Tuple[int, int]:
+    """读取文件头得到的尺寸，按 EXIF 方向校正为显示时的 (w, h)，不解码像素。"""
+    w, h = image.size
+    if image.getexif().get(_ORIENTATION_TAG) in _TRANSPOSED_ORIENTATIONS:
+        return h, w
+    return w, h
+
+
+def decode_image(source: ImageSource,
+                 min_size: Optional[Tuple[int, int]] = None,
+                 background: Optional[Tuple[int, int, int]] = None) -> Tuple[Image.Image, DecodeStats]:
+    """
+    解码上传的图像（文件字节或路径）为 RGB，并按 EXIF 方向旋转。
+    解码前先经过 open_image 的格式和像素数检查。
+    指定 background 时，带透明通道的图像先合成到该背景色上，否则直接丢弃透明通道。
+
+    指定 min_size (w, h, 按显示方向) 时按需缩小解码：JPEG 使用 draft 模式，
+    在 DCT 阶段直接解码为不小于 min_size 的最小 1/2、1/4、1/8 尺寸，
+    避免完整解码几千万像素的手机照片；其他格式解码后用 reduce 做整数倍面积缩小。
+    """
+    started = time.perf_counter()
+    memory_mark = _memory_mark()
+    image = open_image(source)
+    image_format = image.format
+    source_size = oriented_size(image)
+    stored_w, stored_h = image.size
+
+    if min_size is not None and image_format == "JPEG":
+        # draft 的尺寸按文件中存储的方向计算
+        draft_w, draft_h = min_size
+        if source_size != (stored_w, stored_h):
+            draft_w, draft_h = draft_h, draft_w
+        image.draft("RGB", (draft_w, draft_h))
+
+    image = ImageOps.exif_transpose(image)
+    if background is not None and (image.mode in ("RGBA", "LA", "PA")
+                                   or "transparency" in image.info):
+        rgba = image.convert("RGBA")
+        image = Image.new("RGB", rgba.size, background)
+        image.paste(rgba, mask=rgba.split()[3])
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    if min_size is not None:
+        factor = min(image.size[0] // max(1, min_size[0]), image.size[1] // max(1, min_size[1]))
+        if factor >= 2:
+            image = image.reduce(factor)
+
+    stats = DecodeStats(
+        format=image_format,
+        source_size=source_size,
+        decoded_size=image.size,
+        scale=max(1, round(max(stored_w, stored_h) / max(image.size))),
+        decode_ms=round((time.perf_counter() - started) * 1000.0, 2),
+        peak_mem_mb=round(_peak_delta_mb(memory_mark), 1),
+    )
+    return image, stats
+
+
+class DecodeMetrics:
+    """汇总各工作进程返回的解码统计，用于 /metrics。"""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._decode_ms = deque(maxlen=window)
+        self._peak_mem_mb = deque(maxlen=window)
+        self.decoded = 0
+        self.reduced = 0
+        self.source_pixels = 0
+        self.decoded_pixels = 0
+
+    def record(self, stats: DecodeStats) -> None:
+        with self._lock:
+            self.decoded += 1
+            if stats.scale > 1:
+                self.reduced += 1
+            self.source_pixels += stats.source_size[0] * stats.source_size[1]
+            self.decoded_pixels += stats.decoded_size[0] * stats.decoded_size[1]
+            self._decode_ms.append(stats.decode_ms)
+            self._peak_mem_mb.append(stats.peak_mem_mb)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            ordered = sorted(self._decode_ms)
+            n = len(ordered)
+            mem = sorted(self._peak_mem_mb)
+            return {
+                "decoded": self.decoded,
+                "reduced": self.reduced,
+                "source_megapixels": round(self.source_pixels / 1e6, 2),
+                "decoded_megapixels": round(self.decoded_pixels / 1e6, 2),
+                "decode_ms": {
+                    "avg": round(sum(ordered) / n, 2) if n else 0.0,
+                    "p95": ordered[min(n - 1, int(n * 0.95))] if n else 0.0,
+                    "max": ordered[-1] if n else 0.0,
+                },
+                "peak_mem_mb": {
+                    "avg": round(sum(mem) / n, 1) if n else 0.0,
+                    "p95": mem[min(n - 1, int(n * 0.95))] if n else 0.0,
+                    "max": mem[-1] if n else 0.0,
+                },
+            }
@@ -0,0 +1,124 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+@dataclass
+class StoredImage:
+    """服务端保存的已解码图像及其分辨率金字塔。"""
+    image_id: str
+    levels: List[np.ndarray]         # 金字塔各层 (H, W, 3) uint8，第 0 层为预缩小后的原图
+    source_size: tuple               # 原图尺寸 (w, h)
+    created_at: float = field(default_factory=time.monotonic)
+    last_access: float = field(default_factory=time.monotonic)
+
+    @property
+    def array(self) -> np.ndarray:
+        return self.levels[0]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(level.nbytes for level in self.levels)
+
+
+class ImageStore:
+    """
+    上传一次、多次像素化的图像会话存储。
+
+    以图像内容哈希作为 image_id（同一张图重复上传得到同一个 id），
+    条目在最后一次访问 ttl_seconds 秒后过期；总字节数超过 max_bytes 时
+    按最久未访问的顺序淘汰。存储位于当前进程内存中。
+    """
+
+    def __init__(self, ttl_seconds: float = 1800, max_bytes: int = 256 * 1024 * 1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._items: "OrderedDict[str, StoredImage]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+
+        self.stored = 0
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def _remove(self, image_id: str) -> None:
+        item = self._items.pop(image_id)
+        self.current_bytes -= item.nbytes
+
+    def _purge_expired(self, now: float) -> None:
+        # 条目按访问时间排序，只需从头部检查
+        while self._items:
+            image_id, item = next(iter(self._items.items()))
+            if now - item.last_access <= self.ttl_seconds:
+                break
+            self._remove(image_id)
+            self.expired += 1
+
+    def put(self, item: StoredImage) -> StoredImage:
+        now = time.monotonic()
+        with self._lock:
+            self._purge_expired(now)
+            if item.image_id in self._items:
+                self._remove(item.image_id)
+            item.last_access = now
+            self._items[item.image_id] = item
+            self.current_bytes += item.nbytes
+            self.stored += 1
+            while self.current_bytes > self.max_bytes and len(self._items) > 1:
+                self._remove(next(iter(self._items)))
+                self.evictions += 1
+        return item
+
+    def get(self, image_id: str) -> Optional[StoredImage]:
+        now = time.monotonic()
+        with self._lock:
+            self._purge_expired(now)
+            item = self._items.get(image_id)
+            if item is None:
+                self.misses += 1
+                return None
+            item.last_access = now
+            self._items.move_to_end(image_id)
+            self.hits += 1
+            return item
+
+    def delete(self, image_id: str) -> bool:
+        with self._lock:
+            if image_id not in self._items:
+                return False
+            self._remove(image_id)
+            return True
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            self._purge_expired(time.monotonic())
+            return {
+                "entries": len(self._items),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "stored": self.stored,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evictions": self.evictions,
+            }
+
+
+def store_from_env() -> ImageStore:
+    """
+    从环境变量创建图像存储：
+        IMAGE_STORE_TTL_SECONDS  会话过期时间（默认 1800 秒）
+        IMAGE_STORE_MB           最大占用内存（默认 256 MB）
+    """
+    return ImageStore(
+        ttl_seconds=float(os.environ.get("IMAGE_STORE_TTL_SECONDS", 1800)),
+        max_bytes=int(float(os.environ.get("IMAGE_STORE_MB", 256)) * 1024 * 1024),
+    )
@@ -1,16 +1,193 @@
 import os
 import json
+import asyncio
 import base64
+import hashlib
+import importlib.util
+import io
+import time
 import httpx
-from typing import Optional
+from typing import Optional, Tuple
+
+from PIL import Image
+
+from utils.image_decode import ImageSource, decode_image, inspect_image, open_image
+from utils.upstream import UpstreamError, UpstreamGuard, guard_from_env
 
 PALETTE_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'perler_palette.json')
 
+DEFAULT_API_URL = "https://ark.cn-beijing.volces.com/api/v3/images/generations"
+
+# 上传给模型前的输入图像规范化：最长边、目标字节数和 JPEG 质量搜索范围。
+# 模型输出为 2K，之后还会被像素化到 256 格以内，输入图无需保留原始分辨率
+INPUT_MAX_SIDE = int(os.environ.get("ARK_INPUT_MAX_SIDE", 1024))
+INPUT_TARGET_BYTES = int(float(os.environ.get("ARK_INPUT_TARGET_KB", 300)) * 1024)
+INPUT_MIN_QUALITY = int(os.environ.get("ARK_INPUT_MIN_QUALITY", 60))
+INPUT_MAX_QUALITY = int(os.environ.get("ARK_INPUT_MAX_QUALITY", 92))
+
+# 无损去除元数据时丢弃的 JPEG 段：APP1-APP15（EXIF、XMP、ICC、IPTC 等，保留解码需要的 APP14 Adobe）和 COM
+_JPEG_METADATA_MARKERS = frozenset(range(0xE1, 0xF0)) - {0xEE} | {0xFE}
+_EXIF_ORIENTATION = 0x0112
+
+
+def _encode_jpeg(image: Image.Image, quality: int) -> bytes:
+    output = io.BytesIO()
+    # 不传 exif / icc_profile，输出不带任何元数据
+    image.save(output, format="JPEG", quality=quality, optimize=False)
+    return output.getvalue()
+
+
+def _strip_jpeg_metadata(data: bytes) -> Optional[bytes]:
+    """
+    不重新编码，直接删除 JPEG 中的元数据段，图像数据原样保留。
+    文件结构不符合预期时返回 None。
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    out = bytearray(data[:2])
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # 段之间的填充字节
+            pos += 1
+            continue
+        if marker == 0xDA:  # SOS 之后是熵编码数据，原样复制到文件末尾
+            out += data[pos:]
+            return bytes(out)
+        length = int.from_bytes(data[pos + 2:pos + 4], "big")
+        end = pos + 2 + length
+        if length < 2 or end > len(data):
+            return None
+        if marker not in _JPEG_METADATA_MARKERS:
+            out += data[pos:end]
+        pos = end
+    return None
+
+
+def _passthrough_jpeg(source: ImageSource, size: int) -> Optional[bytes]:
+    """
+    输入已经是满足要求的 JPEG（RGB、无需旋转、最长边和字节数都不超限）时，
+    只去掉元数据直接上传；重新编码只会让文件变大或损失画质。否则返回 None。
+    """
+    if size > INPUT_TARGET_BYTES:
+        return None
+    with open_image(source) as image:
+        if (image.format != "JPEG" or image.mode != "RGB"
+                or max(image.size) > INPUT_MAX_SIDE
+                or image.getexif().get(_EXIF_ORIENTATION, 1) != 1):
+            return None
+    if not isinstance(source, (bytes, bytearray)):
+        with open(source, "rb") as f:
+            source = f.read()
+    return _strip_jpeg_metadata(bytes(source))
+
+
+def normalize_input_image(source: ImageSource) -> Tuple[bytes, Optional[int]]:
+    """
+    把用户上传的图像规范化为适合上传给模型的 JPEG：
+    按 EXIF 方向旋转、透明区域合成到白色背景、缩小到最长边不超过 INPUT_MAX_SIDE、
+    去掉所有元数据，并二分搜索不超过 INPUT_TARGET_BYTES 和原文件大小的最高 JPEG 质量
+    （最低 INPUT_MIN_QUALITY 仍超出时使用最低质量）。
+    已经满足要求的 JPEG 不重新编码，只去掉元数据。
+    返回 (JPEG 字节, 使用的质量；未重新编码时为 None)。
+    """
+    size = len(source) if isinstance(source, (bytes, bytearray)) else os.path.getsize(source)
+    passthrough = _passthrough_jpeg(source, size)
+    if passthrough is not None:
+        return passthrough, None
+
+    _, (w, h) = inspect_image(source)
+    scale = min(1.0, INPUT_MAX_SIDE / max(w, h))
+    target = (max(1, round(w * scale)), max(1, round(h * scale)))
+    image, _ = decode_image(source, target if scale < 1 else None, background=(255, 255, 255))
+    if image.size != target:
+        image = image.resize(target, Image.Resampling.LANCZOS)
+
+    # 不超过原文件大小：小图重新编码为高质量 JPEG 反而会增加上传字节数
+    limit = min(INPUT_TARGET_BYTES, size)
+    lo, hi = INPUT_MIN_QUALITY, INPUT_MAX_QUALITY
+    best, best_quality = None, INPUT_MIN_QUALITY
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        encoded = _encode_jpeg(image, mid)
+        if len(encoded) <= limit:
+            best, best_quality = encoded, mid
+            lo = mid + 1
+        else:
+            hi = mid - 1
+    if best is None:
+        best = _encode_jpeg(image, INPUT_MIN_QUALITY)
+    return best, best_quality
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """
+    创建带连接池和 keep-alive 的 HTTP 客户端，在整个应用生命周期内复用，
+    避免每次生成都重新建立 TCP + TLS 连接。通过环境变量配置：
+        ARK_HTTP2                 是否启用 HTTP/2（需要安装 h2，默认关闭）
+        ARK_MAX_CONNECTIONS       最大连接数（默认 20）
+        ARK_MAX_KEEPALIVE         最大空闲 keep-alive 连接数（默认 10）
+        ARK_KEEPALIVE_EXPIRY      空闲连接保留秒数（默认 30）
+        ARK_CONNECT_TIMEOUT       连接超时秒数（默认 10）
+        ARK_TIMEOUT               读取超时秒数，图像生成较慢（默认 60）
+    """
+    http2 = os.environ.get("ARK_HTTP2", "").lower() in ("1", "true", "yes")
+    if http2 and importlib.util.find_spec("h2") is None:
+        print("未安装 h2，ARK_HTTP2 无效，使用 HTTP/1.1")
+        http2 = False
+
+    connect_timeout = float(os.environ.get("ARK_CONNECT_TIMEOUT", 10))
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=int(os.environ.get("ARK_MAX_CONNECTIONS", 20)),
+            max_keepalive_connections=int(os.environ.get("ARK_MAX_KEEPALIVE", 10)),
+            keepalive_expiry=float(os.environ.get("ARK_KEEPALIVE_EXPIRY", 30)),
+        ),
+        timeout=httpx.Timeout(
+            float(os.environ.get("ARK_TIMEOUT", 60)),
+            connect=connect_timeout,
+            pool=connect_timeout,
+        ),
+    )
+
 
 class NanobananaClient:
-    def __init__(self, api_url: str = None, api_key: Optional[str] = None):
-        self.api_url = "https://ark.cn-beijing.volces.com/api/v3/images/generations"
+    MODEL = "doubao-seedream-4-5-251128"
+    SIZE = "2K"
+
+    def __init__(self, api_url: str = None, api_key: Optional[str] = None,
+                 http_client: Optional[httpx.AsyncClient] = None,
+                 guard: Optional[UpstreamGuard] = None):
+        self.api_url = api_url or os.environ.get("ARK_API_URL", DEFAULT_API_URL)
         self.api_key = api_key or os.environ.get("ARK_API_KEY")
+        self._http = http_client
+        # 并发上限、重试和熔断
+        self.guard = guard or guard_from_env()
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        """共享的 HTTP 客户端，首次使用时创建。"""
+        if self._http is None:
+            self._http = create_http_client()
+        return self._http
+
+    def cache_key(self, image_digest: str) -> str:
+        """生成结果的缓存键：由输入图像哈希、提示词、模型和输出尺寸决定。"""
+        h = hashlib.blake2b(digest_size=16)
+        normalization = (f"{INPUT_MAX_SIDE}/{INPUT_TARGET_BYTES}/{INPUT_MIN_QUALITY}-{INPUT_MAX_QUALITY}"
+                         "/passthrough")
+        for part in (image_digest, self._build_prompt(), self.MODEL, self.SIZE, normalization):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    async def aclose(self) -> None:
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
 
     @staticmethod
     def _build_prompt() -> str:
@@ -66,79 +243,59 @@ class NanobananaClient:
         full_prompt = self._build_prompt()
 
         payload = {
-            "model": "doubao-seedream-4-5-251128",
+            "model": self.MODEL,
             "prompt": full_prompt,
             "sequential_image_generation": "disabled",
             "response_format": "b64_json",
-            "size": "2K",
+            "size": self.SIZE,
             "stream": False,
             "watermark": False
         }
 
         # 如果提供了图片，使用图生图模式
         if image_bytes:
-            b64_str = base64.b64encode(image_bytes).decode('utf-8')
-            data_uri = f"data:image/png;base64,{b64_str}"
-
-            # 如果图片过大（>10MB base64），进行压缩
-            try:
-                import io
-                from PIL import Image
-
-                if len(b64_str) > 10 * 1024 * 1024:
-                    print("图片过大，正在压缩...")
-                    img = Image.open(io.BytesIO(image_bytes))
-                    if img.mode != 'RGB':
-                        img = img.convert('RGB')
-
-                    max_dim = 1024
-                    if max(img.size) > max_dim:
-                        img.thumbnail((max_dim, max_dim), Image.Resampling.LANCZOS)
-
-                    output = io.BytesIO()
-                    img.save(output, format='JPEG', quality=85)
-                    compressed_bytes = output.getvalue()
-                    b64_str = base64.b64encode(compressed_bytes).decode('utf-8')
-                    data_uri = f"data:image/jpeg;base64,{b64_str}"
-            except Exception as e:
-                print(f"压缩图片时出错: {e}")
-
-            payload["image"] = data_uri
-            print(f"使用图生图模式 (base64 长度约: {len(b64_str)})")
+            # 上传前统一缩小并重新编码（已满足要求的 JPEG 只去元数据），CPU 密集，放到线程中执行
+            started = time.perf_counter()
+            jpeg_bytes, quality = await asyncio.to_thread(normalize_input_image, image_bytes)
+            b64_str = base64.b64encode(jpeg_bytes).decode('utf-8')
+            payload["image"] = f"data:image/jpeg;base64,{b64_str}"
+            encoding = "原图去元数据" if quality is None else f"质量 {quality}"
+            print(
+                f"使用图生图模式：输入图 {len(image_bytes)} 字节 -> JPEG {len(jpeg_bytes)} 字节 "
+                f"({encoding}，base64 {len(b64_str)} 字节)，"
+                f"耗时 {(time.perf_counter() - started) * 1000:.1f} ms"
+            )
 
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    self.api_url,
-                    json=payload,
-                    headers=headers,
-                    timeout=60.0
-                )
-
-                if response.status_code != 200:
-                    raise Exception(f"API 请求失败: {response.text}")
-
-                result = response.json()
-
-                if "data" in result and len(result["data"]) > 0:
-                    data_item = result["data"][0]
-
-                    # 优先尝试 b64_json
-                    b64_data = data_item.get("b64_json") or data_item.get("binary_data")
-                    if b64_data:
-                        return base64.b64decode(b64_data)
-
-                    # 回退尝试 URL
-                    url = data_item.get("url") or data_item.get("image_url")
-                    if url:
-                        async with httpx.AsyncClient() as dl_client:
-                            img_response = await dl_client.get(url, timeout=60.0)
-                            if img_response.status_code == 200:
-                                return img_response.content
-                            else:
-                                raise Exception(f"下载图片失败: {img_response.status_code}")
-
-                raise Exception("API 响应中未找到有效的图片数据")
+            response = await self.guard.request(
+                lambda: self.http.post(self.api_url, json=payload, headers=headers)
+            )
+
+            if response.status_code != 200:
+                raise UpstreamError(f"API 请求失败: {response.text}", response.status_code)
+
+            result = response.json()
+
+            if "data" in result and len(result["data"]) > 0:
+                data_item = result["data"][0]
+
+                # 优先尝试 b64_json
+                b64_data = data_item.get("b64_json") or data_item.get("binary_data")
+                if b64_data:
+                    return base64.b64decode(b64_data)
+
+                # 回退尝试 URL
+                url = data_item.get("url") or data_item.get("image_url")
+                if url:
+                    img_response = await self.guard.request(lambda: self.http.get(url),
+                                                            idempotent=True)
+                    if img_response.status_code == 200:
+                        return img_response.content
+                    else:
+                        raise UpstreamError(f"下载图片失败: {img_response.status_code}",
+                                            img_response.status_code)
+
+            raise Exception("API 响应中未找到有效的图片数据")
 
         except Exception as e:
             print(f"调用 ARK API 出错: {e}")
@@ -0,0 +1,162 @@
+import os
+import threading
+import uuid
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from utils.color_space import rgb_to_lab
+from utils.palette_registry import Palette, palette_registry
+
+# 支持的精度：8 位为完整 256³ 表 (16 MB)，6 位 (256 KB) 和 5 位 (32 KB) 用于低内存部署
+SUPPORTED_BITS = (8, 6, 5)
+
+
+def lut_path(palette_path: str, palette: Palette, bits: int, metric: str = "cie76") -> str:
+    """查找表文件与 perler_palette.json 放在同一目录，文件名包含调色板版本和色差公式。"""
+    base, _ = os.path.splitext(palette_path)
+    suffix = "" if metric == "cie76" else f".{metric}"
+    return f"{base}.lut{bits}{suffix}.{palette.version}.npy"
+
+
+def build_lut(palette: Palette, bits: int = 8, out: np.ndarray = None,
+              metric: str = "cie76") -> np.ndarray:
+    """
+    计算 RGB -> 调色板索引 的查找表。
+    表的形状为 (2^bits, 2^bits, 2^bits)，每个格子存放该格中心颜色按 metric
+    色差最小的调色板索引。按 R 通道分块计算，避免一次性生成 16M 个 Lab 值。
+    """
+    if bits not in SUPPORTED_BITS:
+        raise ValueError(f"不支持的查找表精度: {bits} 位")
+    if len(palette) > 256:
+        raise ValueError("调色板超过 256 色，无法使用 uint8 查找表")
+
+    n = 1 << bits
+    shift = 8 - bits
+    # 每个量化格的中心值
+    levels = (np.arange(n, dtype=np.int32) << shift) + ((1 << shift) >> 1)
+    levels = levels.astype(np.uint8)
+
+    if out is None:
+        out = np.empty((n, n, n), dtype=np.uint8)
+
+    gg, bb = np.meshgrid(levels, levels, indexing="ij")
+    plane = np.empty((n, n, 3), dtype=np.uint8)
+    plane[..., 1] = gg
+    plane[..., 2] = bb
+    for r_idx in range(n):
+        plane[..., 0] = levels[r_idx]
+        lab = rgb_to_lab(plane).reshape(-1, 3)
+        if metric == "cie76":
+            _, idx = palette.tree.query(lab, workers=-1)
+        else:
+            idx = palette.nearest(lab, metric)
+        out[r_idx] = np.asarray(idx, dtype=np.uint8).reshape(n, n)
+    return out
+
+
+class PaletteLUT:
+    """
+    基于查找表的调色板匹配引擎。
+
+    调色板固定时，Lab 最近邻只取决于 8 位 RGB 三元组，
+    因此可以预先计算好整张表，映射一幅图只需一次花式索引。
+    表持久化为 .npy 并以只读 mmap 打开，同一台机器上的多个 worker 共享页缓存中的同一份数据。
+    """
+
+    def __init__(self, table: np.ndarray, bits: int, version: str, metric: str = "cie76"):
+        self.table = table
+        self.bits = bits
+        self.shift = 8 - bits
+        self.version = version
+        self.metric = metric
+
+    def lookup(self, rgb: np.ndarray) -> np.ndarray:
+        """rgb: shape (..., 3) uint8，返回 shape (...) 的调色板索引。"""
+        rgb = np.asarray(rgb, dtype=np.uint8)
+        if self.shift:
+            rgb = rgb >> self.shift
+        return self.table[rgb[..., 0], rgb[..., 1], rgb[..., 2]]
+
+    @classmethod
+    def load_or_build(cls, palette: Palette, bits: int = 8,
+                      palette_path: str = None, metric: str = "cie76") -> "PaletteLUT":
+        """
+        优先以 mmap 方式加载磁盘上的查找表；不存在时计算并原子地写入磁盘。
+        目录不可写时退化为仅在内存中保存。
+        """
+        path = lut_path(palette_path or palette_registry.path, palette, bits, metric)
+        if os.path.exists(path):
+            return cls(np.load(path, mmap_mode="r"), bits, palette.version, metric)
+
+        n = 1 << bits
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            table = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8,
+                                              shape=(n, n, n))
+        except OSError:
+            return cls(build_lut(palette, bits, metric=metric), bits, palette.version, metric)
+
+        try:
+            build_lut(palette, bits, out=table, metric=metric)
+            table.flush()
+            del table
+            # 多个 worker 同时构建时结果完全相同，后写入者覆盖即可
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return cls(np.load(path, mmap_mode="r"), bits, palette.version, metric)
+
+
+_luts: Dict[Tuple[str, int, str], PaletteLUT] = {}
+_luts_lock = threading.Lock()
+
+
+def get_lut(palette: Palette, bits: int = 8, metric: str = "cie76") -> PaletteLUT:
+    """返回给定调色板版本、精度和色差公式的查找表（进程内缓存）。"""
+    key = (palette.version, bits, metric)
+    lut = _luts.get(key)
+    if lut is None:
+        with _luts_lock:
+            lut = _luts.get(key)
+            if lut is None:
+                lut = PaletteLUT.load_or_build(palette, bits, metric=metric)
+                _luts[key] = lut
+    return lut
+
+
+def load_lut(palette: Palette, bits: int = 8, metric: str = "cie76",
+             palette_path: str = None) -> Optional[PaletteLUT]:
+    """
+    只加载已经就绪的查找表（进程内缓存或磁盘上的 .npy，以 mmap 打开），从不构建；
+    尚未生成时返回 None。工作进程使用这个函数，查找表由主进程启动时用 get_lut 构建。
+    """
+    key = (palette.version, bits, metric)
+    lut = _luts.get(key)
+    if lut is not None:
+        return lut
+    path = lut_path(palette_path or palette_registry.path, palette, bits, metric)
+    # 文件通过原子重命名写入，存在即完整
+    if not os.path.exists(path):
+        return None
+    with _luts_lock:
+        lut = _luts.get(key)
+        if lut is None:
+            lut = PaletteLUT(np.load(path, mmap_mode="r"), bits, palette.version, metric)
+            _luts[key] = lut
+    return lut
+
+
+if __name__ == "__main__":
+    # 预先生成查找表，例如在构建镜像时运行: python -m utils.palette_lut 8 6 5
+    # 色差公式取 PALETTE_MATCH_METRIC 环境变量（默认 cie76）
+    import sys
+    import time
+
+    metric = os.environ.get("PALETTE_MATCH_METRIC", "cie76")
+    for arg in sys.argv[1:] or ["8"]:
+        start = time.perf_counter()
+        lut = get_lut(palette_registry.current(), int(arg), metric)
+        print(f"{arg} 位查找表就绪: shape={lut.table.shape}, "
+              f"耗时 {time.perf_counter() - start:.2f}s")
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from scipy.spatial import KDTree
+
+from utils.color_diff import nearest_colors
+from utils.color_space import rgb_to_lab
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PALETTE_PATH = os.path.join(BASE_DIR, "perler_palette.json")
+
+
+@dataclass(frozen=True)
+class Palette:
+    """
+    某一版本调色板的只读快照。
+    所有数组都是预先计算好的，可以被并发请求安全共享。
+    """
+    entries: List[Dict]   # 原始 JSON 条目 (id / name / rgb)
+    rgb: np.ndarray       # (P, 3) uint8，C 连续
+    lab: np.ndarray       # (P, 3) float32
+    ids: np.ndarray       # (P,) object，调色板 ID 字符串
+    tree: KDTree          # Lab 空间最近邻索引
+    version: str          # JSON 内容的哈希，用于缓存键
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def nearest(self, lab: np.ndarray, metric: str = "cie76") -> np.ndarray:
+        """
+        为每个颜色查找色差最小的调色板索引。输入 shape (N, 3)。
+        metric 为 cie76 时用 KDTree，cie94 / ciede2000 分块向量化计算（见 color_diff）。
+        """
+        if metric != "cie76":
+            return nearest_colors(lab, self.lab, metric)
+        _, indices = self.tree.query(lab)
+        return np.asarray(indices, dtype=np.int32)
+
+
+def build_palette(raw: bytes) -> Palette:
+    entries = json.loads(raw)
+    rgb = np.ascontiguousarray([p["rgb"] for p in entries], dtype=np.uint8)
+    lab = rgb_to_lab(rgb.reshape(-1, 1, 3)).reshape(-1, 3)
+    ids = np.array([p["id"] for p in entries], dtype=object)
+    return Palette(
+        entries=entries,
+        rgb=rgb,
+        lab=lab,
+        ids=ids,
+        tree=KDTree(lab),
+        version=hashlib.sha1(raw).hexdigest()[:12],
+    )
+
+
+class PaletteRegistry:
+    """
+    进程级调色板注册表。
+
+    启动时解析一次 perler_palette.json 并预计算 RGB / Lab / ID 数组和 KDTree，
+    之后所有请求共享同一份快照。current() 只做一次 os.stat，
+    当文件的 mtime 或大小变化时才重新加载，重新加载通过替换快照引用完成，
+    正在进行中的请求仍使用旧快照，不会读到不一致的数据。
+    """
+
+    def __init__(self, path: str = PALETTE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._palette: Optional[Palette] = None
+        self.reload()
+
+    def _file_stamp(self) -> Tuple[int, int]:
+        st = os.stat(self.path)
+        return st.st_mtime_ns, st.st_size
+
+    def reload(self) -> Palette:
+        """无条件从磁盘重新加载调色板。"""
+        with self._lock:
+            stamp = self._file_stamp()
+            with open(self.path, "rb") as f:
+                raw = f.read()
+            self._palette = build_palette(raw)
+            self._stamp = stamp
+            return self._palette
+
+    def current(self) -> Palette:
+        """返回当前调色板快照；文件在磁盘上变化时自动重新加载。"""
+        try:
+            if self._file_stamp() != self._stamp:
+                return self.reload()
+        except OSError:
+            # 文件暂时不可读（例如正在被替换）时继续使用旧快照
+            pass
+        return self._palette
+
+
+palette_registry = PaletteRegistry()
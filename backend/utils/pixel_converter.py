@@ -1,61 +1,41 @@
-import json
+import io
+import os
+from dataclasses import dataclass, field
 import numpy as np
 from PIL import Image
 from typing import List, Dict, Tuple, Optional
-from sklearn.cluster import KMeans
 from scipy.spatial import KDTree
-import os
 
-# Load palette
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-PALETTE_PATH = os.path.join(BASE_DIR, "perler_palette.json")
+from utils.color_diff import METRICS
+from utils.color_space import rgb_to_lab
+from utils.image_decode import (
+    DECODE_QUALITY_FACTOR, DecodeStats, ImageSource, decode_image, inspect_image
+)
+from utils.palette_registry import Palette, palette_registry
+from utils.palette_lut import PaletteLUT, get_lut, load_lut
+from utils.quantizers import (
+    DEFAULT_QUANTIZER, WARM_START_QUANTIZERS, reduce_colors, reduce_colors_kmeans
+)
+
+# 调色板匹配引擎："kdtree" 为精确的 Lab 最近邻；
+# "lut" / "lut6" / "lut5" 为 8/6/5 位 RGB 查找表（后两者用于低内存部署）
+PALETTE_MATCH_ENGINE = os.environ.get("PALETTE_MATCH_ENGINE", "kdtree")
+LUT_ENGINE_BITS = {"lut": 8, "lut8": 8, "lut6": 6, "lut5": 5}
+# 调色板匹配使用的色差公式：cie76（Lab 欧氏距离）/ cie94 / ciede2000，
+# 查找表引擎按同一公式预计算
+PALETTE_MATCH_METRIC = os.environ.get("PALETTE_MATCH_METRIC", "cie76")
+# 会话图像（按 image_id 像素化，颜色分析被缓存）在同一网格尺寸下从参考聚类中心热启动
+# （调整 max_colors 滑块时只需少量迭代）；一次性上传不缓存分析，始终按目标颜色数冷启动。
+# 参考中心是按固定颜色数 CLUSTER_WARM_START_REFERENCE 冷启动聚类一次的结果，计算后不再覆盖，
+# 所以同一 (图像, 网格, 颜色数, 量化器) 的结果与请求顺序无关；默认与接口的默认 max_colors 相同
+CLUSTER_WARM_START = os.environ.get("CLUSTER_WARM_START", "1").lower() not in ("0", "false", "no")
+CLUSTER_WARM_START_REFERENCE = int(os.environ.get("CLUSTER_WARM_START_REFERENCE", 15))
+# 聚类初始化方式，计入像素化结果 ID
+CLUSTER_INIT = f"warm{CLUSTER_WARM_START_REFERENCE}" if CLUSTER_WARM_START else "cold"
 
 
 def load_palette() -> List[Dict]:
-    with open(PALETTE_PATH, "r") as f:
-        return json.load(f)
-
-
-def rgb_to_lab(rgb: np.ndarray) -> np.ndarray:
-    """
-    将 RGB (0-255) 转换为 CIELAB 色彩空间。
-    使用 D65 白点作为参考。
-    输入: shape (..., 3), dtype uint8 或 float [0,255]
-    输出: shape (..., 3), dtype float64, L [0,100], a/b [-128,127]
-    """
-    # 归一化到 [0, 1]
-    rgb_norm = rgb.astype(np.float64) / 255.0
-
-    # sRGB gamma 校正 -> 线性 RGB
-    mask = rgb_norm > 0.04045
-    rgb_linear = np.where(mask, ((rgb_norm + 0.055) / 1.055) ** 2.4, rgb_norm / 12.92)
-
-    # 线性 RGB -> XYZ (D65 白点)
-    # 使用标准的 sRGB -> XYZ 转换矩阵
-    r, g, b = rgb_linear[..., 0], rgb_linear[..., 1], rgb_linear[..., 2]
-    x = r * 0.4124564 + g * 0.3575761 + b * 0.1804375
-    y = r * 0.2126729 + g * 0.7151522 + b * 0.0721750
-    z = r * 0.0193339 + g * 0.1191920 + b * 0.9503041
-
-    # D65 白点参考值
-    xn, yn, zn = 0.95047, 1.00000, 1.08883
-    x /= xn
-    y /= yn
-    z /= zn
-
-    # XYZ -> Lab 的非线性函数
-    epsilon = 0.008856
-    kappa = 903.3
-
-    fx = np.where(x > epsilon, np.cbrt(x), (kappa * x + 16.0) / 116.0)
-    fy = np.where(y > epsilon, np.cbrt(y), (kappa * y + 16.0) / 116.0)
-    fz = np.where(z > epsilon, np.cbrt(z), (kappa * z + 16.0) / 116.0)
-
-    L = 116.0 * fy - 16.0
-    a = 500.0 * (fx - fy)
-    b_val = 200.0 * (fy - fz)
-
-    return np.stack([L, a, b_val], axis=-1)
+    return palette_registry.current().entries
 
 
 def detect_background_color(image: Image.Image) -> Tuple[int, int, int]:
@@ -86,6 +66,40 @@ def detect_background_color(image: Image.Image) -> Tuple[int, int, int]:
     return tuple(bg_color.tolist())
 
 
+def compress_colors(pixels: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    将像素折叠为唯一颜色。
+    pixels: shape (..., 3), uint8 RGB
+    返回: (unique_rgb (U, 3) uint8, inverse (N,) 每个像素对应的唯一颜色索引, counts (U,) 出现次数)
+    AI 生成的扁平插画缩放后往往只有几十到几百种颜色，
+    后续的 Lab 转换、背景判断和最近邻查询只需在唯一颜色上进行，再通过 inverse 散射回像素。
+    """
+    flat = np.asarray(pixels, dtype=np.uint8).reshape(-1, 3)
+    # 打包为 24 位整数后做一维 unique，比 np.unique(axis=0) 快得多
+    keys = (flat[:, 0].astype(np.uint32) << 16) | (flat[:, 1].astype(np.uint32) << 8) | flat[:, 2]
+    unique_keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    unique_rgb = np.empty((unique_keys.shape[0], 3), dtype=np.uint8)
+    unique_rgb[:, 0] = unique_keys >> 16
+    unique_rgb[:, 1] = (unique_keys >> 8) & 0xFF
+    unique_rgb[:, 2] = unique_keys & 0xFF
+    return unique_rgb, inverse.reshape(-1), counts
+
+
+def background_mask_for_colors(colors_lab: np.ndarray, bg_color: Tuple[int, int, int],
+                               tolerance: float = 30.0) -> np.ndarray:
+    """
+    判断一组 Lab 颜色是否为背景色。
+    colors_lab: shape (..., 3)
+    返回 bool 数组，True == 背景色。
+    """
+    bg_lab = rgb_to_lab(np.array(bg_color, dtype=np.uint8).reshape(1, 1, 3)).reshape(3)
+
+    # 计算每个颜色与背景色的 Delta E (简单欧式距离)
+    delta_e = np.sqrt(np.sum((colors_lab - bg_lab) ** 2, axis=-1))
+
+    return delta_e < tolerance
+
+
 def create_background_mask(image: Image.Image, bg_color: Tuple[int, int, int],
                            tolerance: float = 30.0) -> np.ndarray:
     """
@@ -94,68 +108,276 @@ def create_background_mask(image: Image.Image, bg_color: Tuple[int, int, int],
     tolerance: Lab 空间中的色差阈值 (Delta E)。
     """
     img_array = np.array(image)[..., :3]  # 取 RGB 通道
-    img_lab = rgb_to_lab(img_array)
-    bg_lab = rgb_to_lab(np.array(bg_color, dtype=np.uint8).reshape(1, 1, 3)).reshape(3)
-
-    # 计算每个像素与背景色的 Delta E (简单欧式距离)
-    delta_e = np.sqrt(np.sum((img_lab - bg_lab) ** 2, axis=-1))
+    unique_rgb, inverse, _ = compress_colors(img_array)
+    unique_lab = rgb_to_lab(unique_rgb.reshape(-1, 1, 3)).reshape(-1, 3)
+    unique_bg = background_mask_for_colors(unique_lab, bg_color, tolerance)
 
-    return delta_e < tolerance
+    return unique_bg[inverse].reshape(img_array.shape[:2])
 
 
-def reduce_colors_kmeans(pixels: np.ndarray, max_colors: int) -> np.ndarray:
+def map_colors_to_palette(representative_colors: np.ndarray,
+                          palette: Optional[Palette] = None,
+                          engine: Optional[str] = None,
+                          metric: Optional[str] = None) -> Dict[int, int]:
     """
-    使用 K-means 聚类将像素颜色减少到 max_colors 个代表色。
-    pixels: shape (N, 3), RGB 值
-    返回: shape (max_colors, 3), 聚类中心的 RGB 值
+    在 CIELAB 空间中，将每个代表色映射到色差最小的拼豆调色板颜色。
+    palette: 调色板快照，默认使用注册表中的当前调色板（Lab 值和 KDTree 已预计算）。
+    engine: 匹配引擎，默认取 PALETTE_MATCH_ENGINE 环境变量。
+    metric: 色差公式，默认取 PALETTE_MATCH_METRIC 环境变量。
+    返回: {代表色索引: 调色板索引} 的映射。
     """
-    n_pixels = pixels.shape[0]
-    if n_pixels == 0:
-        return np.array([[255, 255, 255]])
-
-    # 对于像素数较多的情况，随机抽样以加速 K-means
-    sample_size = min(n_pixels, 10000)
-    if n_pixels > sample_size:
-        indices = np.random.choice(n_pixels, sample_size, replace=False)
-        sample = pixels[indices]
+    if palette is None:
+        palette = palette_registry.current()
+    engine = engine or PALETTE_MATCH_ENGINE
+    metric = metric or PALETTE_MATCH_METRIC
+    if metric not in METRICS:
+        raise ValueError(f"未知的色差公式: {metric}")
+
+    rgb = np.asarray(representative_colors).reshape(-1, 3)
+    lut = None
+    if engine in LUT_ENGINE_BITS:
+        # 查找表由主进程启动时构建（见 prepare_palette_lut），就绪前退化为精确匹配
+        lut = load_lut(palette, LUT_ENGINE_BITS[engine], metric)
+    elif engine != "kdtree":
+        raise ValueError(f"未知的调色板匹配引擎: {engine}")
+
+    if lut is not None:
+        indices = lut.lookup(rgb.astype(np.uint8))
     else:
-        sample = pixels
+        rep_lab = rgb_to_lab(rgb.reshape(-1, 1, 3)).reshape(-1, 3)
+        indices = palette.nearest(rep_lab, metric)
 
-    actual_k = min(max_colors, len(np.unique(sample, axis=0)))
-    if actual_k <= 1:
-        return np.mean(pixels, axis=0, keepdims=True).astype(np.uint8)
+    mapping = {}
+    for i, palette_idx in enumerate(indices):
+        mapping[i] = int(palette_idx)
+
+    return mapping
 
-    kmeans = KMeans(n_clusters=actual_k, random_state=42, n_init=10, max_iter=100)
-    kmeans.fit(sample.astype(np.float64))
-    centers = kmeans.cluster_centers_.astype(np.uint8)
 
-    return centers
+def prepare_palette_lut(palette: Optional[Palette] = None) -> Optional[PaletteLUT]:
+    """
+    配置了查找表引擎时加载或构建当前调色板的查找表并写入磁盘（cie76 的 8 位表约 5 秒，
+    ciede2000 可达数分钟）。由主进程在启动时于后台线程调用，工作进程之后只需 mmap 打开。
+    """
+    if PALETTE_MATCH_ENGINE not in LUT_ENGINE_BITS:
+        return None
+    return get_lut(palette or palette_registry.current(), LUT_ENGINE_BITS[PALETTE_MATCH_ENGINE],
+                   PALETTE_MATCH_METRIC)
 
 
-def map_colors_to_palette(representative_colors: np.ndarray,
-                          palette_data: List[Dict]) -> Dict[int, int]:
+def expand_grid(grid_indices: np.ndarray, used_indices: np.ndarray,
+                palette: Palette) -> Tuple[List[List[str]], List[Dict]]:
     """
-    在 CIELAB 空间中，将每个代表色映射到最接近的拼豆调色板颜色。
-    返回: {代表色索引: 调色板索引} 的映射。
+    将紧凑的调色板索引网格展开为接口输出格式：
+    调色板 ID 字符串的二维列表，以及实际使用的调色板条目列表。
     """
-    palette_rgb = np.array([p["rgb"] for p in palette_data], dtype=np.uint8)
-    palette_lab = rgb_to_lab(palette_rgb.reshape(-1, 1, 3)).reshape(-1, 3)
+    grid_ids = palette.ids[grid_indices].tolist()
+    used_palette = [palette.entries[i] for i in used_indices.tolist()]
+    return grid_ids, used_palette
 
-    rep_lab = rgb_to_lab(representative_colors.reshape(-1, 1, 3)).reshape(-1, 3)
 
-    # 用 KDTree 在 Lab 空间快速查找最近邻
-    tree = KDTree(palette_lab)
-    _, indices = tree.query(rep_lab)
+# 网格的最大边长（格子数）
+MAX_GRID_SIZE = 256
 
-    mapping = {}
-    for i, palette_idx in enumerate(indices):
-        mapping[i] = int(palette_idx)
 
-    return mapping
+def grid_dimensions(width: int, height: int, grid_size: int) -> Tuple[int, int]:
+    """根据原图宽高比计算网格尺寸 (target_w, target_h)，两边都限制在 MAX_GRID_SIZE 以内。"""
+    if width <= 0 or height <= 0:
+        raise ValueError(f"无效的图像尺寸: {width}x{height}")
+
+    aspect = height / width
+    target_w = grid_size
+    target_h = max(1, int(grid_size * aspect))
+
+    # 限制最大尺寸
+    target_w = max(1, min(target_w, MAX_GRID_SIZE))
+    target_h = max(1, min(target_h, MAX_GRID_SIZE))
+    return target_w, target_h
+
+
+@dataclass
+class GridAnalysis:
+    """
+    缩放到网格尺寸后的颜色分析结果（第 1-3 步），与 max_colors / 量化器无关，
+    同一张图在相同网格尺寸下可以复用。
+    """
+    width: int
+    height: int
+    unique_rgb: np.ndarray    # (U, 3) uint8 唯一颜色
+    inverse: np.ndarray       # (H*W,) 每个格子对应的唯一颜色索引
+    counts: np.ndarray        # (U,) 每个唯一颜色的格子数
+    unique_lab: np.ndarray    # (U, 3) 唯一颜色的 Lab 值
+    bg_color: Tuple[int, int, int]
+    unique_bg: np.ndarray     # (U,) bool，True == 背景色
+    # 各量化器热启动的参考代表色 (k, 3) uint8，首次量化时计算，之后不再覆盖
+    warm_centers: Dict[str, np.ndarray] = field(default_factory=dict)
+
+    @property
+    def nbytes(self) -> int:
+        return (self.unique_rgb.nbytes + self.inverse.nbytes + self.counts.nbytes
+                + self.unique_lab.nbytes + self.unique_bg.nbytes
+                + sum(c.nbytes for c in self.warm_centers.values()))
+
+
+def analyze_grid(image: Image.Image, grid_size: int = 64,
+                 target_size: Optional[Tuple[int, int]] = None) -> GridAnalysis:
+    """
+    像素化的前半段：处理透明度、BOX 缩放到网格尺寸、折叠唯一颜色并检测背景。
+    target_size: 指定网格尺寸 (w, h)；默认按 image 的宽高比和 grid_size 计算。
+    """
+    # ======================================================================
+    # 1. 处理透明度，合成到白色背景上
+    # ======================================================================
+    if image.mode == 'RGBA':
+        alpha = np.array(image.split()[3])
+        has_transparency = np.any(alpha < 250)
+
+        if has_transparency:
+            # 合成到白色背景
+            bg = Image.new('RGBA', image.size, (255, 255, 255, 255))
+            bg.paste(image, mask=image.split()[3])
+            image = bg.convert('RGB')
+        else:
+            image = image.convert('RGB')
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    # ======================================================================
+    # 2. 高质量缩放到目标网格大小
+    # ======================================================================
+    if target_size is None:
+        target_size = grid_dimensions(image.size[0], image.size[1], grid_size)
+    target_w, target_h = target_size
+
+    # 使用 BOX 采样 —— 这是同等于面积平均采样，在缩小图像时效果最好
+    # 会将原图中每个对应区域的所有像素取平均值，避免锯齿和噪点
+    img_small = image.resize((target_w, target_h), Image.Resampling.BOX)
+
+    small_array = np.array(img_small)  # (H, W, 3)
+
+    # 折叠为唯一颜色：后续所有颜色计算都只在唯一颜色集合上进行
+    unique_rgb, inverse, counts = compress_colors(small_array)
+    unique_lab = rgb_to_lab(unique_rgb.reshape(-1, 1, 3)).reshape(-1, 3)
+
+    # ======================================================================
+    # 3. 检测背景色 & 创建背景遮罩
+    # ======================================================================
+    bg_color = detect_background_color(img_small)
+    unique_bg = background_mask_for_colors(unique_lab, bg_color, tolerance=25.0)
+
+    return GridAnalysis(
+        width=target_w,
+        height=target_h,
+        unique_rgb=unique_rgb,
+        inverse=inverse,
+        counts=counts,
+        unique_lab=unique_lab,
+        bg_color=bg_color,
+        unique_bg=unique_bg,
+    )
+
+
+def quantize_grid(analysis: GridAnalysis, max_colors: int = 15,
+                  quantizer: str = DEFAULT_QUANTIZER,
+                  palette: Optional[Palette] = None, warm_start: bool = False) -> Dict:
+    """
+    像素化的后半段：颜色量化、映射到拼豆调色板并生成输出数据。
+    warm_start 且 CLUSTER_WARM_START 开启时从 analysis.warm_centers 中同一量化器的参考代表色热启动，
+    没有参考代表色时先计算一次并写入 analysis。只有会缓存 analysis 的调用方才应传 warm_start，
+    否则参考聚类算完即丢弃，反而比直接按目标颜色数冷启动多聚类一次。
+    """
+    if palette is None:
+        palette = palette_registry.current()
+    num_palette = len(palette)
+    target_w, target_h = analysis.width, analysis.height
+    unique_bg = analysis.unique_bg
+
+    # 判定背景色最接近哪个拼豆颜色
+    bg_rgb_arr = np.array(analysis.bg_color, dtype=np.uint8).reshape(1, 3)
+    bg_to_palette = map_colors_to_palette(bg_rgb_arr, palette)
+    bg_palette_idx = bg_to_palette[0]
+
+    # ======================================================================
+    # 4. 提取前景颜色并量化减少颜色数量
+    # ======================================================================
+    foreground_colors = analysis.unique_rgb[~unique_bg]  # (U_fg, 3)
+    foreground_counts = analysis.counts[~unique_bg]
+
+    if foreground_colors.shape[0] == 0:
+        # 如果全是背景，整个图就填充背景色
+        result_indices = np.full((target_h, target_w), bg_palette_idx, dtype=np.int32)
+    else:
+        # 颜色量化得到代表色，像素计数作为样本权重
+        actual_max_colors = max(2, max_colors - 1)  # 预留 1 个给背景色
+        reference_colors = max(2, CLUSTER_WARM_START_REFERENCE - 1)
+        if warm_start and CLUSTER_WARM_START and quantizer in WARM_START_QUANTIZERS:
+            reference = analysis.warm_centers.get(quantizer)
+            if reference is None:
+                reference = reduce_colors(foreground_colors, reference_colors,
+                                          sample_weight=foreground_counts, quantizer=quantizer)
+                analysis.warm_centers[quantizer] = reference
+            if actual_max_colors == reference_colors:
+                representative_colors = reference
+            else:
+                representative_colors = reduce_colors(
+                    foreground_colors, actual_max_colors,
+                    sample_weight=foreground_counts, quantizer=quantizer, init=reference
+                )
+        else:
+            representative_colors = reduce_colors(
+                foreground_colors, actual_max_colors,
+                sample_weight=foreground_counts, quantizer=quantizer
+            )
+
+        # ======================================================================
+        # 5. 在 CIELAB 空间将聚类中心映射到拼豆调色板
+        # ======================================================================
+        cluster_to_palette = map_colors_to_palette(representative_colors, palette)
+
+        # ======================================================================
+        # 6. 逐像素重新映射
+        # ======================================================================
+        # 先为每个唯一颜色找到最近的聚类中心
+        rep_lab = rgb_to_lab(representative_colors.reshape(-1, 1, 3)).reshape(-1, 3)
+        rep_tree = KDTree(rep_lab)
+        _, cluster_indices = rep_tree.query(analysis.unique_lab)
+
+        # 构建唯一颜色的调色板索引：聚类索引 -> 调色板索引 的数组查表，
+        # 背景颜色直接用 np.where 覆盖为背景色，再通过 inverse 散射回每个像素
+        cluster_lookup = np.array(
+            [cluster_to_palette[i] for i in range(len(representative_colors))],
+            dtype=np.int32
+        )
+        unique_result = np.where(
+            unique_bg, bg_palette_idx, cluster_lookup[cluster_indices]
+        ).astype(np.int32)
+
+        result_indices = unique_result[analysis.inverse].reshape(target_h, target_w)
+
+    # ======================================================================
+    # 7. 生成输出数据（预览图按需由 render_preview 生成）
+    # ======================================================================
+    # 提取网格数据：紧凑的调色板索引数组（调色板不超过 256 色时为 uint8）
+    safe_indices = np.where(result_indices < num_palette, result_indices, 0)
+    index_dtype = np.uint8 if num_palette <= 256 else np.uint16
+    grid_indices = safe_indices.astype(index_dtype)
+    used_indices = np.unique(grid_indices)
+    grid_ids, used_palette = expand_grid(grid_indices, used_indices, palette)
+
+    return {
+        "grid_data": grid_ids,
+        "used_palette": used_palette,
+        "grid_indices": grid_indices,
+        "used_indices": used_indices,
+        "palette_version": palette.version,
+        "width": target_w,
+        "height": target_h
+    }
 
 
 def process_image_to_beads(image: Image.Image, grid_size: int = 64,
-                           max_colors: int = 15) -> Dict:
+                           max_colors: int = 15,
+                           quantizer: str = DEFAULT_QUANTIZER) -> Dict:
     """
     将 PIL Image 转换为拼豆图案。
 
@@ -163,153 +385,153 @@ def process_image_to_beads(image: Image.Image, grid_size: int = 64,
     1. 处理透明度 & 检测背景
     2. 高质量缩放 (BOX 采样)
     3. 分离背景和前景像素
-    4. K-means 聚类减少前景颜色数量
+    4. 颜色量化（默认 K-means）减少前景颜色数量
     5. 在 CIELAB 色彩空间中将聚类中心映射到拼豆调色板
     6. 逐像素重新映射生成最终图案
 
+    第 1-3 步由 analyze_grid 完成，第 4-7 步由 quantize_grid 完成。
+
     参数:
         image: 输入的 PIL Image 对象
         grid_size: 拼豆画的宽度格子数 (默认 64)
         max_colors: 最大使用的拼豆颜色数 (默认 15)
+        quantizer: 颜色量化器名称，见 quantizers.QUANTIZERS (默认 kmeans，未安装 scikit-learn 时为 lab_kmeans)
     """
     try:
-        palette_data = load_palette()
-        palette_rgb = np.array([p["rgb"] for p in palette_data], dtype=np.uint8)
-        num_palette = len(palette_data)
+        analysis = analyze_grid(image, grid_size)
+        result = quantize_grid(analysis, max_colors, quantizer)
+        result["quantized_image"] = render_preview(
+            result["grid_indices"], result["used_indices"], "scaled"
+        )
+        return result
 
-        # ======================================================================
-        # 1. 处理透明度，合成到白色背景上
-        # ======================================================================
-        if image.mode == 'RGBA':
-            alpha = np.array(image.split()[3])
-            has_transparency = np.any(alpha < 250)
-
-            if has_transparency:
-                # 合成到白色背景
-                bg = Image.new('RGBA', image.size, (255, 255, 255, 255))
-                bg.paste(image, mask=image.split()[3])
-                image = bg.convert('RGB')
-            else:
-                image = image.convert('RGB')
-        elif image.mode != 'RGB':
-            image = image.convert('RGB')
+    except Exception as e:
+        print(f"process_image_to_beads 错误: {e}")
+        import traceback
+        traceback.print_exc()
+        raise e
 
-        # ======================================================================
-        # 2. 高质量缩放到目标网格大小
-        # ======================================================================
-        w, h = image.size
-        if w <= 0 or h <= 0:
-            raise ValueError(f"无效的图像尺寸: {w}x{h}")
 
-        aspect = h / w
-        target_w = grid_size
-        target_h = max(1, int(grid_size * aspect))
+# 预览图模式：none 不生成；native 每颗拼豆 1 像素；scaled 最近邻放大到约 PREVIEW_SIDE 像素
+PREVIEW_MODES = ("none", "native", "scaled")
+PREVIEW_SIDE = 512
+# 预览图是 "P" 模式（调色板）PNG，数据量很小，使用低压缩级别换取编码速度
+PREVIEW_COMPRESS_LEVEL = 1
 
-        # 限制最大尺寸
-        target_w = max(1, min(target_w, 256))
-        target_h = max(1, min(target_h, 256))
 
-        # 使用 BOX 采样 —— 这是同等于面积平均采样，在缩小图像时效果最好
-        # 会将原图中每个对应区域的所有像素取平均值，避免锯齿和噪点
-        img_small = image.resize((target_w, target_h), Image.Resampling.BOX)
+def render_preview(grid_indices: np.ndarray, used_indices: np.ndarray, mode: str = "native",
+                   palette: Optional[Palette] = None) -> Image.Image:
+    """
+    用调色板颜色生成 "P" 模式预览图：像素值为 used_indices 表中的下标，
+    图像调色板只包含实际使用的颜色。scaled 模式用最近邻放大，保持 "P" 模式。
+    """
+    if mode not in ("native", "scaled"):
+        raise ValueError(f"未知的预览模式: {mode}，可选: native, scaled")
+    if palette is None:
+        palette = palette_registry.current()
+    height, width = grid_indices.shape
+    local = np.searchsorted(used_indices, grid_indices).astype(np.uint8)
+    preview_img = Image.fromarray(local, "P")
+    preview_img.putpalette(palette.rgb[used_indices].reshape(-1).tolist())
 
-        small_array = np.array(img_small)  # (H, W, 3)
+    scale = max(1, PREVIEW_SIDE // max(width, height))
+    if mode == "scaled" and scale > 1:
+        preview_img = preview_img.resize((width * scale, height * scale),
+                                         Image.Resampling.NEAREST)
+    return preview_img
 
-        # ======================================================================
-        # 3. 检测背景色 & 创建背景遮罩
-        # ======================================================================
-        bg_color = detect_background_color(img_small)
-        bg_mask = create_background_mask(img_small, bg_color, tolerance=25.0)
 
-        # 判定背景色最接近哪个拼豆颜色
-        bg_rgb_arr = np.array(bg_color, dtype=np.uint8).reshape(1, 3)
-        bg_to_palette = map_colors_to_palette(bg_rgb_arr, palette_data)
-        bg_palette_idx = bg_to_palette[0]
+def encode_preview(grid_indices: np.ndarray, used_indices: np.ndarray, mode: str = "native",
+                   palette: Optional[Palette] = None) -> bytes:
+    """生成预览图并编码为 PNG 字节。"""
+    buffered = io.BytesIO()
+    render_preview(grid_indices, used_indices, mode, palette).save(
+        buffered, format="PNG", compress_level=PREVIEW_COMPRESS_LEVEL
+    )
+    return buffered.getvalue()
 
-        # ======================================================================
-        # 4. 提取前景像素并用 K-means 减少颜色数量
-        # ======================================================================
-        foreground_mask = ~bg_mask
-        foreground_pixels = small_array[foreground_mask]  # (N, 3)
 
-        if foreground_pixels.shape[0] == 0:
-            # 如果全是背景，整个图就填充背景色
-            result_indices = np.full((target_h, target_w), bg_palette_idx, dtype=np.int32)
-        else:
-            # K-means 聚类得到代表色
-            actual_max_colors = max(2, max_colors - 1)  # 预留 1 个给背景色
-            representative_colors = reduce_colors_kmeans(foreground_pixels, actual_max_colors)
+def encode_display_image(array: np.ndarray, quality: int = 90) -> bytes:
+    """把会话图像编码为用于页面显示的 JPEG。"""
+    buffered = io.BytesIO()
+    Image.fromarray(array, "RGB").save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
 
-            # ======================================================================
-            # 5. 在 CIELAB 空间将聚类中心映射到拼豆调色板
-            # ======================================================================
-            cluster_to_palette = map_colors_to_palette(representative_colors, palette_data)
 
-            # ======================================================================
-            # 6. 逐像素重新映射
-            # ======================================================================
-            # 先为每个像素找到最近的聚类中心
-            rep_lab = rgb_to_lab(representative_colors.reshape(-1, 1, 3)).reshape(-1, 3)
-            rep_tree = KDTree(rep_lab)
+# 会话图像预缩小后的最长边。网格最大 256 格，保留 4 倍余量用于 BOX 面积采样
+PREPARED_MAX_SIDE = 1024
 
-            img_lab = rgb_to_lab(small_array)  # (H, W, 3)
-            flat_lab = img_lab.reshape(-1, 3)
-            flat_bg_mask = bg_mask.reshape(-1)
 
-            # 查询所有像素的最近聚类中心
-            _, cluster_indices = rep_tree.query(flat_lab)
+def _encode_compact(result: Dict) -> Dict:
+    """把像素化结果转成可跨进程传递的紧凑形式（见 pixelate_image_bytes）。"""
+    del result["grid_data"], result["used_palette"]
+    return result
 
-            # 构建最终的调色板索引数组
-            result_flat = np.empty(flat_lab.shape[0], dtype=np.int32)
 
-            for i in range(len(result_flat)):
-                if flat_bg_mask[i]:
-                    result_flat[i] = bg_palette_idx
-                else:
-                    cluster_idx = cluster_indices[i]
-                    result_flat[i] = cluster_to_palette[cluster_idx]
+def pixelate_image_bytes(source: ImageSource, grid_size: int = 64, max_colors: int = 15,
+                         quantizer: str = DEFAULT_QUANTIZER) -> Tuple[Dict, DecodeStats]:
+    """
+    从图像文件（字节或临时文件路径）完成解码和像素化。
+    供进程池调用：参数和返回值都可以被 pickle。返回 (紧凑结果, 解码统计)：
+    网格只保留 grid_indices / used_indices，由调用方通过 expand_grid 展开，
+    避免在进程间传递大量字符串；预览图不在这里生成，见 encode_preview。
 
-            result_indices = result_flat.reshape(target_h, target_w)
+    图像只解码到网格尺寸的 DECODE_QUALITY_FACTOR 倍（JPEG 使用 DCT 缩放），
+    网格尺寸按原图宽高比计算，与完整解码时一致。
+    """
+    _, source_size = inspect_image(source)
+    target_size = grid_dimensions(*source_size, grid_size)
+    min_size = tuple(int(side * DECODE_QUALITY_FACTOR) for side in target_size)
+    image, stats = decode_image(source, min_size)
+    analysis = analyze_grid(image, target_size=target_size)
+    return _encode_compact(quantize_grid(analysis, max_colors, quantizer)), stats
 
-        # ======================================================================
-        # 7. 生成预览图和输出数据
-        # ======================================================================
-        # 用调色板颜色生成预览图
-        preview_array = palette_rgb[result_indices]  # (H, W, 3)
-        preview_img = Image.fromarray(preview_array.astype(np.uint8), 'RGB')
-
-        # 放大预览图使其更清晰
-        preview_scale = max(1, 512 // max(target_w, target_h))
-        if preview_scale > 1:
-            preview_img = preview_img.resize(
-                (target_w * preview_scale, target_h * preview_scale),
-                Image.Resampling.NEAREST
-            )
 
-        # 提取网格数据
-        grid_ids = []
-        used_indices = set()
+def build_pyramid(image: Image.Image) -> List[np.ndarray]:
+    """
+    面积平均的分辨率金字塔：每层边长减半，直到最长边低于 2 * MAX_GRID_SIZE。
+    任意网格尺寸都可以从不小于它的最近一层 BOX 缩放得到，而不必每次从大图开始。
+    """
+    levels = [np.asarray(image)]
+    while max(image.size) // 2 >= MAX_GRID_SIZE:
+        image = image.reduce(2)
+        levels.append(np.asarray(image))
+    return levels
 
-        for row in result_indices:
-            grid_row = []
-            for idx in row:
-                safe_idx = int(idx) if int(idx) < num_palette else 0
-                grid_row.append(palette_data[safe_idx]["id"])
-                used_indices.add(safe_idx)
-            grid_ids.append(grid_row)
 
-        used_palette = [palette_data[i] for i in sorted(list(used_indices))]
+def select_level(levels: List[np.ndarray], target_w: int, target_h: int) -> np.ndarray:
+    """选出宽高都不小于目标网格的最小一层；都不满足时返回最大的一层。"""
+    for level in reversed(levels):
+        if level.shape[1] >= target_w and level.shape[0] >= target_h:
+            return level
+    return levels[0]
 
-        return {
-            "quantized_image": preview_img,
-            "grid_data": grid_ids,
-            "used_palette": used_palette,
-            "width": target_w,
-            "height": target_h
-        }
 
-    except Exception as e:
-        print(f"process_image_to_beads 错误: {e}")
-        import traceback
-        traceback.print_exc()
-        raise e
+def prepare_image_bytes(source: ImageSource) -> Tuple[List[np.ndarray], Tuple[int, int], DecodeStats]:
+    """
+    解码上传的图像（字节或临时文件路径），预缩小到最长边不超过 PREPARED_MAX_SIDE（BOX 面积采样），
+    并构建分辨率金字塔，用于服务端图像会话。大图只解码到不小于 PREPARED_MAX_SIDE 的尺寸。
+    返回 (金字塔各层 (H, W, 3) uint8 数组，第 0 层最大, 原图尺寸 (w, h), 解码统计)。
+    """
+    _, (w, h) = inspect_image(source)
+    scale = PREPARED_MAX_SIDE / max(w, h)
+    min_size = (max(1, round(w * scale)), max(1, round(h * scale))) if scale < 1 else None
+    image, stats = decode_image(source, min_size)
+    if min_size is not None and image.size != min_size:
+        image = image.resize(min_size, Image.Resampling.BOX)
+    return build_pyramid(image), stats.source_size, stats
+
+
+def pixelate_level(level: Optional[np.ndarray], target_size: Tuple[int, int],
+                   max_colors: int = 15, quantizer: str = DEFAULT_QUANTIZER,
+                   analysis: Optional[GridAnalysis] = None) -> Tuple[Dict, GridAnalysis]:
+    """
+    会话图像的像素化任务（供进程池调用）。
+    传入缓存的 analysis 时跳过缩放 / Lab 转换 / 背景检测，level 可以为 None，
+    否则从金字塔的某一层计算 analysis。聚类从 analysis 中保存的参考中心热启动。
+    返回 (紧凑结果, 保存了参考中心的 analysis) 以便调用方缓存。
+    """
+    if analysis is None:
+        analysis = analyze_grid(Image.fromarray(level, "RGB"), target_size=target_size)
+    result = quantize_grid(analysis, max_colors, quantizer, warm_start=True)
+    return _encode_compact(result), analysis
@@ -0,0 +1,548 @@
+import importlib.util
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from utils.color_space import rgb_to_lab
+
+# scikit-learn 为可选依赖：只有 kmeans / minibatch 量化器需要，且在首次使用时才导入
+# （导入约需 1 秒，会拖慢每个工作进程的启动）
+SKLEARN_AVAILABLE = importlib.util.find_spec("sklearn") is not None
+
+# 所有量化器的统一签名：
+#   (colors (U, 3) uint8 唯一颜色, weights (U,) 像素计数或 None, k 最大颜色数) -> (k', 3) uint8 代表色
+Quantizer = Callable[[np.ndarray, Optional[np.ndarray], int], np.ndarray]
+
+# 聚类前颜色直方图的每通道位数：5 位 = 32³ 个格子
+HISTOGRAM_BITS = 5
+# K-means 系量化器的默认随机种子：相同输入总是得到相同的代表色，结果可缓存
+DEFAULT_SEED = 42
+# lab_kmeans 的参数：初始化次数、最大迭代次数、中心移动量（ΔE）小于 tol 时提前停止
+LAB_KMEANS_N_INIT = 3
+LAB_KMEANS_MAX_ITER = 50
+LAB_KMEANS_TOL = 0.05
+
+
+def _weights_or_ones(colors: np.ndarray, weights: Optional[np.ndarray]) -> np.ndarray:
+    if weights is None:
+        return np.ones(colors.shape[0], dtype=np.float64)
+    return np.asarray(weights, dtype=np.float64)
+
+
+def _weighted_means(colors: np.ndarray, weights: np.ndarray, labels: np.ndarray,
+                    n_groups: int) -> np.ndarray:
+    """按分组标签计算加权平均色，返回 (n_groups, 3) uint8。"""
+    w_sum = np.bincount(labels, weights=weights, minlength=n_groups)
+    centers = np.empty((n_groups, 3), dtype=np.float64)
+    for c in range(3):
+        centers[:, c] = np.bincount(labels, weights=weights * colors[:, c], minlength=n_groups)
+    centers /= np.maximum(w_sum, 1e-12)[:, None]
+    return np.clip(np.rint(centers), 0, 255).astype(np.uint8)
+
+
+def color_histogram(colors: np.ndarray, weights: Optional[np.ndarray] = None,
+                    bits: int = HISTOGRAM_BITS) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    把颜色按每通道 bits 位分格，返回 (格内加权平均色 (B, 3) float64, 格的总权重 (B,))。
+    格子按编号排序，输出与输入顺序无关。
+    """
+    weights = _weights_or_ones(colors, weights)
+    shift = 8 - bits
+    q = colors.astype(np.int64) >> shift
+    keys = (q[:, 0] << (2 * bits)) | (q[:, 1] << bits) | q[:, 2]
+    _, labels = np.unique(keys, return_inverse=True)
+    labels = labels.reshape(-1)
+    n_bins = int(labels.max()) + 1
+    bin_weights = np.bincount(labels, weights=weights, minlength=n_bins)
+    means = np.empty((n_bins, 3), dtype=np.float64)
+    for c in range(3):
+        means[:, c] = np.bincount(labels, weights=weights * colors[:, c], minlength=n_bins)
+    means /= np.maximum(bin_weights, 1e-12)[:, None]
+    return means, bin_weights
+
+
+def _histogram_input(colors: np.ndarray, weights: np.ndarray,
+                     max_colors: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    K-means 系量化器的聚类输入。颜色数不超过 max_colors 时直接使用原色（无需聚类），
+    否则聚类在颜色直方图上进行：输入从数千个颜色降到几百个带权重的格子。
+    """
+    if colors.shape[0] <= max_colors:
+        return colors.astype(np.float64), weights
+    return color_histogram(colors, weights)
+
+
+def reduce_colors_kmeans(pixels: np.ndarray, max_colors: int,
+                         sample_weight: Optional[np.ndarray] = None,
+                         seed: int = DEFAULT_SEED,
+                         init: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    使用 K-means 聚类将颜色减少到 max_colors 个代表色。
+    pixels: shape (N, 3), RGB 值（通常为唯一颜色）
+    sample_weight: shape (N,), 可选的样本权重（像素计数）
+    seed: 初始化的随机种子，相同输入和种子总是得到相同的结果
+    init: 热启动的初始中心 (k', 3) RGB，通常为同一图像上一次的代表色；
+          k' 与目标颜色数不同时先拆分 / 合并（见 _resize_centers），只做一次初始化
+    返回: shape (k, 3) uint8, 聚类中心的 RGB 值
+
+    聚类在 5 位/通道的加权颜色直方图上进行，每个格子以格内加权平均色为样本、
+    总像素数为权重，而不是随机抽样像素。
+    """
+    if pixels.shape[0] == 0:
+        return np.array([[255, 255, 255]], dtype=np.uint8)
+    weights = _weights_or_ones(pixels, sample_weight)
+    samples, sample_weights = _histogram_input(pixels, weights, max_colors)
+
+    actual_k = min(max_colors, samples.shape[0])
+    if actual_k <= 1:
+        return np.average(pixels, axis=0, weights=weights).reshape(1, 3).astype(np.uint8)
+    if actual_k == samples.shape[0]:
+        return np.clip(np.rint(samples), 0, 255).astype(np.uint8)
+
+    from sklearn.cluster import KMeans
+
+    if init is not None:
+        centers = _resize_centers(samples, sample_weights, init, actual_k)
+        kmeans = KMeans(n_clusters=centers.shape[0], init=centers, n_init=1, max_iter=100)
+    else:
+        kmeans = KMeans(n_clusters=actual_k, random_state=seed, n_init=10, max_iter=100)
+    kmeans.fit(samples, sample_weight=sample_weights)
+    return np.clip(np.rint(kmeans.cluster_centers_), 0, 255).astype(np.uint8)
+
+
+def reduce_colors_minibatch(colors: np.ndarray, max_colors: int,
+                            sample_weight: Optional[np.ndarray] = None,
+                            seed: int = DEFAULT_SEED,
+                            init: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    MiniBatchKMeans：每次迭代只用一小批样本更新中心，
+    精度略低于完整 K-means，但耗时稳定且远低于 n_init=10 的 KMeans。
+    与 reduce_colors_kmeans 一样在加权颜色直方图上聚类，init 同样用于热启动。
+    """
+    if colors.shape[0] == 0:
+        return np.array([[255, 255, 255]], dtype=np.uint8)
+    weights = _weights_or_ones(colors, sample_weight)
+    samples, sample_weights = _histogram_input(colors, weights, max_colors)
+
+    actual_k = min(max_colors, samples.shape[0])
+    if actual_k <= 1:
+        return np.average(colors, axis=0, weights=weights).reshape(1, 3).astype(np.uint8)
+    if actual_k == samples.shape[0]:
+        return np.clip(np.rint(samples), 0, 255).astype(np.uint8)
+
+    from sklearn.cluster import MiniBatchKMeans
+
+    if init is not None:
+        centers = _resize_centers(samples, sample_weights, init, actual_k)
+        kmeans = MiniBatchKMeans(n_clusters=centers.shape[0], init=centers, n_init=1,
+                                 random_state=seed, batch_size=1024, max_iter=100)
+    else:
+        kmeans = MiniBatchKMeans(n_clusters=actual_k, random_state=seed, n_init=3,
+                                 batch_size=1024, max_iter=100)
+    kmeans.fit(samples, sample_weight=sample_weights)
+    return np.clip(np.rint(kmeans.cluster_centers_), 0, 255).astype(np.uint8)
+
+
+def _squared_distances(points: np.ndarray, centers: np.ndarray,
+                       points_sq: np.ndarray) -> np.ndarray:
+    """(N, K) 的平方欧氏距离矩阵：|x|² - 2x·c + |c|²，一次矩阵乘法完成。"""
+    d = points_sq[:, None] - 2.0 * (points @ centers.T) + np.einsum("ij,ij->i", centers, centers)
+    return np.maximum(d, 0.0, out=d)
+
+
+def _kmeans_plus_plus(points: np.ndarray, weights: np.ndarray, k: int,
+                      rng: np.random.Generator, points_sq: np.ndarray) -> np.ndarray:
+    """加权 k-means++ 初始化：每个新中心按 权重 × 到最近已选中心的距离² 的概率抽取。"""
+    centers = np.empty((k, points.shape[1]), dtype=points.dtype)
+    centers[0] = points[rng.choice(points.shape[0], p=weights / weights.sum())]
+    closest = _squared_distances(points, centers[:1], points_sq)[:, 0]
+    for i in range(1, k):
+        prob = weights * closest
+        total = prob.sum()
+        if total <= 0:
+            # 剩余样本都与已选中心重合
+            centers[i:] = centers[0]
+            break
+        centers[i] = points[rng.choice(points.shape[0], p=prob / total)]
+        np.minimum(closest, _squared_distances(points, centers[i:i + 1], points_sq)[:, 0],
+                   out=closest)
+    return centers
+
+
+def _resize_centers(points: np.ndarray, weights: np.ndarray, centers: np.ndarray,
+                    k: int, points_sq: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    把热启动的中心调整为 k 个（points 与 centers 在同一颜色空间）：
+    - 多于 k 个时，反复合并 Ward 代价 w_i·w_j / (w_i + w_j) · |c_i - c_j|² 最小的一对，
+      合并后的中心为两者的加权平均（没有样本的中心直接丢弃）
+    - 少于 k 个时，反复拆分加权误差平方和最大的簇：新中心放在该簇中
+      权重 × 距离² 最大的样本上
+    结果是确定的，不使用随机数。
+    """
+    centers = np.array(centers, dtype=points.dtype).reshape(-1, points.shape[1])
+    if points_sq is None:
+        points_sq = np.einsum("ij,ij->i", points, points)
+
+    if centers.shape[0] > k:
+        labels = np.argmin(_squared_distances(points, centers, points_sq), axis=1)
+        w = np.bincount(labels, weights=weights, minlength=centers.shape[0])
+        centers, w = centers[w > 0], w[w > 0]
+        while centers.shape[0] > k:
+            d2 = np.sum((centers[:, None, :] - centers[None, :, :]) ** 2, axis=-1)
+            cost = (w[:, None] * w[None, :]) / (w[:, None] + w[None, :]) * d2
+            np.fill_diagonal(cost, np.inf)
+            i, j = np.unravel_index(int(np.argmin(cost)), cost.shape)
+            centers[i] = (w[i] * centers[i] + w[j] * centers[j]) / (w[i] + w[j])
+            w[i] += w[j]
+            centers = np.delete(centers, j, axis=0)
+            w = np.delete(w, j)
+
+    while centers.shape[0] < k:
+        dist = _squared_distances(points, centers, points_sq)
+        labels = np.argmin(dist, axis=1)
+        cost = weights * dist[np.arange(points.shape[0]), labels]
+        sse = np.bincount(labels, weights=cost, minlength=centers.shape[0])
+        worst = int(np.argmax(sse))
+        if sse[worst] <= 0:
+            # 每个样本都已与某个中心重合，无法再拆分
+            break
+        members = np.flatnonzero(labels == worst)
+        centers = np.vstack([centers, points[members[np.argmax(cost[members])]]])
+    return centers
+
+
+def _lloyd(points: np.ndarray, weights: np.ndarray, centers: np.ndarray, points_sq: np.ndarray,
+           max_iter: int, tol: float) -> Tuple[np.ndarray, np.ndarray, float]:
+    """加权 Lloyd 迭代，返回 (中心, 标签, 加权误差平方和)。空簇保留原中心。"""
+    k = centers.shape[0]
+    w_sum = np.zeros(k)
+    for _ in range(max_iter):
+        labels = np.argmin(_squared_distances(points, centers, points_sq), axis=1)
+        w_sum = np.bincount(labels, weights=weights, minlength=k)
+        new_centers = centers.copy()
+        nonempty = w_sum > 0
+        for c in range(points.shape[1]):
+            sums = np.bincount(labels, weights=weights * points[:, c], minlength=k)
+            new_centers[nonempty, c] = sums[nonempty] / w_sum[nonempty]
+        shift = float(np.max(np.sum((new_centers - centers) ** 2, axis=1)))
+        centers = new_centers
+        if shift <= tol * tol:
+            break
+
+    dist = _squared_distances(points, centers, points_sq)
+    labels = np.argmin(dist, axis=1)
+    inertia = float(np.dot(weights, dist[np.arange(points.shape[0]), labels]))
+    return centers, labels, inertia
+
+
+def reduce_colors_lab_kmeans(colors: np.ndarray, max_colors: int,
+                             sample_weight: Optional[np.ndarray] = None,
+                             seed: int = DEFAULT_SEED,
+                             init: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    内置的加权 k-means++ / Lloyd 聚类，在 Lab 空间中进行（与调色板匹配使用同一空间）。
+    纯 numpy 实现，不依赖 scikit-learn：float32 向量化距离矩阵，
+    中心移动量小于 LAB_KMEANS_TOL 时提前停止，取 LAB_KMEANS_N_INIT 次初始化中误差最小的结果。
+    代表色为每个簇内原始 RGB 颜色的加权平均，无需 Lab -> RGB 反变换。
+    init: 热启动的初始中心 (k', 3) RGB，转换到 Lab 并拆分 / 合并为目标颜色数后只迭代一次初始化。
+    """
+    if colors.shape[0] == 0:
+        return np.array([[255, 255, 255]], dtype=np.uint8)
+    weights = _weights_or_ones(colors, sample_weight)
+    samples, sample_weights = _histogram_input(colors, weights, max_colors)
+
+    actual_k = min(max_colors, samples.shape[0])
+    if actual_k <= 1:
+        return np.average(colors, axis=0, weights=weights).reshape(1, 3).astype(np.uint8)
+    if actual_k == samples.shape[0]:
+        return np.clip(np.rint(samples), 0, 255).astype(np.uint8)
+
+    lab = rgb_to_lab(samples)
+    lab_sq = np.einsum("ij,ij->i", lab, lab)
+    w = sample_weights.astype(np.float32)
+    rng = np.random.default_rng(seed)
+
+    if init is not None:
+        starts = [_resize_centers(lab, w, rgb_to_lab(np.asarray(init)),
+                                  actual_k, lab_sq)]
+    else:
+        starts = (_kmeans_plus_plus(lab, w, actual_k, rng, lab_sq)
+                  for _ in range(LAB_KMEANS_N_INIT))
+
+    best_labels, best_inertia = None, np.inf
+    for start in starts:
+        _, labels, inertia = _lloyd(lab, w, start, lab_sq, LAB_KMEANS_MAX_ITER, LAB_KMEANS_TOL)
+        if inertia < best_inertia:
+            best_labels, best_inertia = labels, inertia
+
+    # 去掉空簇后按簇求原始 RGB 的加权平均
+    _, labels = np.unique(best_labels, return_inverse=True)
+    labels = labels.reshape(-1)
+    return _weighted_means(samples, sample_weights, labels, int(labels.max()) + 1)
+
+
+def reduce_colors_median_cut(colors: np.ndarray, max_colors: int,
+                             sample_weight: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    加权中位切分 (Median Cut)。
+    每轮选取“最长边 × 像素数”最大的盒子，沿最长的通道在加权中位数处切成两半，
+    直到得到 max_colors 个盒子；代表色为盒内颜色的加权平均。
+    """
+    if colors.shape[0] == 0:
+        return np.array([[255, 255, 255]], dtype=np.uint8)
+    weights = _weights_or_ones(colors, sample_weight)
+    colors = colors.astype(np.int32)
+
+    boxes = [np.arange(colors.shape[0])]
+    while len(boxes) < max_colors:
+        # 计算每个盒子的切分优先级
+        best, best_score, best_axis = -1, 0.0, 0
+        for i, idx in enumerate(boxes):
+            if idx.shape[0] < 2:
+                continue
+            box = colors[idx]
+            ranges = box.max(axis=0) - box.min(axis=0)
+            axis = int(np.argmax(ranges))
+            score = float(ranges[axis]) * float(weights[idx].sum())
+            if score > best_score:
+                best, best_score, best_axis = i, score, axis
+        if best < 0:
+            break
+
+        idx = boxes.pop(best)
+        order = idx[np.argsort(colors[idx, best_axis], kind="stable")]
+        cum = np.cumsum(weights[order])
+        cut = int(np.searchsorted(cum, cum[-1] / 2.0))
+        cut = min(max(cut, 1), order.shape[0] - 1)
+        # 不把相同的通道值拆到两个盒子里：移到离中位数最近的取值边界
+        values = colors[order, best_axis]
+        if values[cut] == values[cut - 1]:
+            left = int(np.searchsorted(values, values[cut], side="left"))
+            right = int(np.searchsorted(values, values[cut], side="right"))
+            options = [c for c in (left, right) if 0 < c < order.shape[0]]
+            cut = min(options, key=lambda c: abs(c - cut))
+        boxes.append(order[:cut])
+        boxes.append(order[cut:])
+
+    labels = np.empty(colors.shape[0], dtype=np.int64)
+    for i, idx in enumerate(boxes):
+        labels[idx] = i
+    return _weighted_means(colors, weights, labels, len(boxes))
+
+
+def _octree_keys(colors: np.ndarray, depth: int) -> np.ndarray:
+    """八叉树第 depth 层的节点编号：交织 R/G/B 最高 depth 位。"""
+    shift = 8 - depth
+    r = colors[:, 0].astype(np.int64) >> shift
+    g = colors[:, 1].astype(np.int64) >> shift
+    b = colors[:, 2].astype(np.int64) >> shift
+    return (r << (2 * depth)) | (g << depth) | b
+
+
+def reduce_colors_octree(colors: np.ndarray, max_colors: int,
+                         sample_weight: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    八叉树量化。
+    先找到节点数不超过 max_colors 的最深一层，再按像素数从大到小
+    把该层节点中最重的子节点独立出来，直到用完颜色预算；
+    这与经典八叉树“合并像素数最少的叶子”的归约顺序一致。
+    """
+    if colors.shape[0] == 0:
+        return np.array([[255, 255, 255]], dtype=np.uint8)
+    weights = _weights_or_ones(colors, sample_weight)
+
+    depth = 0
+    labels = np.zeros(colors.shape[0], dtype=np.int64)
+    n_nodes = 1
+    for d in range(1, 9):
+        keys = _octree_keys(colors, d)
+        uniq, inv = np.unique(keys, return_inverse=True)
+        if uniq.shape[0] > max_colors:
+            break
+        depth, labels, n_nodes = d, inv.reshape(-1), uniq.shape[0]
+
+    if depth < 8 and n_nodes < max_colors:
+        # 下一层的子节点及其权重
+        child_keys = _octree_keys(colors, depth + 1)
+        _, child_inv = np.unique(child_keys, return_inverse=True)
+        child_inv = child_inv.reshape(-1)
+        n_child = int(child_inv.max()) + 1
+        child_weight = np.bincount(child_inv, weights=weights, minlength=n_child)
+        child_parent = np.zeros(n_child, dtype=np.int64)
+        child_parent[child_inv] = labels
+        parent_weight = np.bincount(labels, weights=weights, minlength=n_nodes)
+
+        # 按父节点权重从大到小分配预算；每个父节点把最重的子节点独立出来，
+        # 剩余（最轻的）子节点仍合并在父节点中
+        budget = max_colors - n_nodes
+        split_child = np.zeros(n_child, dtype=bool)
+        for p in np.argsort(-parent_weight, kind="stable"):
+            if budget <= 0:
+                break
+            children = np.flatnonzero(child_parent == p)
+            if children.shape[0] < 2:
+                continue
+            take = min(children.shape[0] - 1, budget)
+            heaviest = children[np.argsort(-child_weight[children], kind="stable")[:take]]
+            split_child[heaviest] = True
+            budget -= take
+
+        final = np.where(split_child[child_inv], child_inv + n_nodes, labels)
+        _, labels = np.unique(final, return_inverse=True)
+        labels = labels.reshape(-1)
+        n_nodes = int(labels.max()) + 1
+
+    return _weighted_means(colors, weights, labels, n_nodes)
+
+
+class _WuMoments:
+    """Wu 量化器使用的三维累积矩表 (33³, 5 位直方图 + 零填充)。"""
+
+    SIZE = 33
+
+    def __init__(self, colors: np.ndarray, weights: np.ndarray):
+        bins = (colors.astype(np.int64) >> 3) + 1
+        flat = (bins[:, 0] * self.SIZE + bins[:, 1]) * self.SIZE + bins[:, 2]
+        n = self.SIZE ** 3
+        c = colors.astype(np.float64)
+
+        def table(values):
+            t = np.bincount(flat, weights=values, minlength=n).reshape((self.SIZE,) * 3)
+            return t.cumsum(0).cumsum(1).cumsum(2)
+
+        self.wt = table(weights)
+        self.mr = table(weights * c[:, 0])
+        self.mg = table(weights * c[:, 1])
+        self.mb = table(weights * c[:, 2])
+        self.m2 = table(weights * np.sum(c * c, axis=1))
+
+    @staticmethod
+    def volume(m: np.ndarray, box) -> float:
+        r0, r1, g0, g1, b0, b1 = box
+        return (m[r1, g1, b1] - m[r1, g1, b0] - m[r1, g0, b1] + m[r1, g0, b0]
+                - m[r0, g1, b1] + m[r0, g1, b0] + m[r0, g0, b1] - m[r0, g0, b0])
+
+    def sums(self, box):
+        return tuple(self.volume(m, box) for m in (self.wt, self.mr, self.mg, self.mb))
+
+    def variance(self, box) -> float:
+        w, r, g, b = self.sums(box)
+        if w <= 0:
+            return 0.0
+        return self.volume(self.m2, box) - (r * r + g * g + b * b) / w
+
+    def partial_sums(self, box, axis: int, cuts: np.ndarray):
+        """对一组切分位置，向量化计算 (下界, cut] 半盒的 (w, r, g, b)。"""
+        r0, r1, g0, g1, b0, b1 = box
+        out = []
+        for m in (self.wt, self.mr, self.mg, self.mb):
+            if axis == 0:
+                top = m[cuts, g1, b1] - m[cuts, g1, b0] - m[cuts, g0, b1] + m[cuts, g0, b0]
+                base = m[r0, g1, b1] - m[r0, g1, b0] - m[r0, g0, b1] + m[r0, g0, b0]
+            elif axis == 1:
+                top = m[r1, cuts, b1] - m[r1, cuts, b0] - m[r0, cuts, b1] + m[r0, cuts, b0]
+                base = m[r1, g0, b1] - m[r1, g0, b0] - m[r0, g0, b1] + m[r0, g0, b0]
+            else:
+                top = m[r1, g1, cuts] - m[r1, g0, cuts] - m[r0, g1, cuts] + m[r0, g0, cuts]
+                base = m[r1, g1, b0] - m[r1, g0, b0] - m[r0, g1, b0] + m[r0, g0, b0]
+            out.append(top - base)
+        return out
+
+
+def reduce_colors_wu(colors: np.ndarray, max_colors: int,
+                     sample_weight: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Wu 方差最小化量化器 (Xiaolin Wu, 1991)。
+    在 5 位/通道的颜色直方图上建立累积矩表，每轮选取方差最大的盒子，
+    沿使两半盒子加权方差之和最小的轴和位置切开。切分位置的搜索是向量化的。
+    """
+    if colors.shape[0] == 0:
+        return np.array([[255, 255, 255]], dtype=np.uint8)
+    weights = _weights_or_ones(colors, sample_weight)
+    mom = _WuMoments(colors, weights)
+
+    # 盒子用 (r0, r1, g0, g1, b0, b1) 表示，区间为 (x0, x1]
+    boxes = [(0, 32, 0, 32, 0, 32)]
+    variances = [mom.variance(boxes[0])]
+
+    while len(boxes) < max_colors:
+        candidates = [i for i, box in enumerate(boxes)
+                      if variances[i] > 0 and
+                      any(box[2 * a + 1] - box[2 * a] > 1 for a in range(3))]
+        if not candidates:
+            break
+        i = max(candidates, key=lambda j: variances[j])
+        box = boxes[i]
+        whole = mom.sums(box)
+
+        best_score, best_axis, best_cut = -1.0, -1, -1
+        for axis in range(3):
+            lo, hi = box[2 * axis], box[2 * axis + 1]
+            if hi - lo < 2:
+                continue
+            cuts = np.arange(lo + 1, hi)
+            hw, hr, hg, hb = mom.partial_sums(box, axis, cuts)
+            ow, orr, og, ob = (whole[0] - hw, whole[1] - hr, whole[2] - hg, whole[3] - hb)
+            valid = (hw > 0) & (ow > 0)
+            if not np.any(valid):
+                continue
+            with np.errstate(divide="ignore", invalid="ignore"):
+                score = (hr * hr + hg * hg + hb * hb) / hw + (orr * orr + og * og + ob * ob) / ow
+            score = np.where(valid, score, -1.0)
+            j = int(np.argmax(score))
+            if score[j] > best_score:
+                best_score, best_axis, best_cut = float(score[j]), axis, int(cuts[j])
+
+        if best_axis < 0:
+            variances[i] = 0.0
+            continue
+
+        lower = list(box)
+        upper = list(box)
+        lower[2 * best_axis + 1] = best_cut
+        upper[2 * best_axis] = best_cut
+        boxes[i] = tuple(lower)
+        variances[i] = mom.variance(boxes[i])
+        boxes.append(tuple(upper))
+        variances.append(mom.variance(boxes[-1]))
+
+    centers = []
+    for box in boxes:
+        w, r, g, b = mom.sums(box)
+        if w > 0:
+            centers.append((r / w, g / w, b / w))
+    return np.clip(np.rint(np.array(centers)), 0, 255).astype(np.uint8)
+
+
+QUANTIZERS: Dict[str, Quantizer] = {
+    "lab_kmeans": reduce_colors_lab_kmeans,
+    "median_cut": reduce_colors_median_cut,
+    "octree": reduce_colors_octree,
+    "wu": reduce_colors_wu,
+}
+if SKLEARN_AVAILABLE:
+    QUANTIZERS["kmeans"] = reduce_colors_kmeans
+    QUANTIZERS["minibatch"] = reduce_colors_minibatch
+
+# 未安装 scikit-learn 时默认使用内置的 lab_kmeans
+DEFAULT_QUANTIZER = "kmeans" if SKLEARN_AVAILABLE else "lab_kmeans"
+
+# 支持用上一次的代表色热启动的量化器（其余量化器是确定性的切分算法，不需要初始化）
+WARM_START_QUANTIZERS = ("kmeans", "minibatch", "lab_kmeans")
+
+
+def reduce_colors(colors: np.ndarray, max_colors: int,
+                  sample_weight: Optional[np.ndarray] = None,
+                  quantizer: str = DEFAULT_QUANTIZER,
+                  init: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    按名称选择量化器，将颜色减少到最多 max_colors 个代表色。
+    init: 热启动的初始中心，仅对 WARM_START_QUANTIZERS 生效，其余量化器忽略。
+    """
+    try:
+        fn = QUANTIZERS[quantizer]
+    except KeyError:
+        raise ValueError(f"未知的颜色量化器: {quantizer}") from None
+    if init is not None and quantizer in WARM_START_QUANTIZERS:
+        return fn(colors, max_colors, sample_weight, init=init)
+    return fn(colors, max_colors, sample_weight)
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+def content_hash(data: bytes) -> str:
+    """图像内容的哈希，作为缓存键的一部分。"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def estimate_size(value: Any) -> int:
+    """粗略估算缓存值占用的字节数（numpy 数组及带 nbytes 属性的对象、bytes、字符串及其容器）。"""
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(estimate_size(k) + estimate_size(v) for k, v in value.items()) + 64
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(v) for v in value) + 8 * len(value)
+    return 16
+
+
+class ByteLRUCache:
+    """
+    按字节数限制容量的 LRU 缓存。
+
+    插入新条目后，如果总大小超过 max_bytes，则从最久未使用的条目开始淘汰。
+    单个条目超过 max_bytes 时直接不缓存。命中 / 未命中 / 淘汰次数都会计数。
+    """
+
+    def __init__(self, max_bytes: int, sizeof: Callable[[Any], int] = estimate_size):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self.current_bytes -= self._sizes.pop(key)
+                del self._data[key]
+            self._data[key] = value
+            self._sizes[key] = size
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                old_key, _ = self._data.popitem(last=False)
+                self.current_bytes -= self._sizes.pop(old_key)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.current_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def metrics(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+def cache_from_env(var: str, default_mb: int) -> ByteLRUCache:
+    """从环境变量（单位 MB）创建缓存。"""
+    return ByteLRUCache(int(float(os.environ.get(var, default_mb)) * 1024 * 1024))
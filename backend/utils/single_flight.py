@@ -0,0 +1,64 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+@dataclass
+class _Call:
+    task: asyncio.Future
+    waiters: int = 0
+
+
+class SingleFlight:
+    """
+    合并相同键的并发调用：同一时刻只执行一次，其余调用方等待同一个结果。
+
+    - 上游结果或异常会传给所有等待方；调用结束后立即移除，失败不会被记住
+    - 单个等待方被取消（例如客户端断开）不影响其他等待方
+    - 所有等待方都被取消时，取消上游任务
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    def _forget(self, key: Hashable, call: _Call) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        执行 fn()，或等待正在进行的同键调用。
+        返回 (结果, 是否复用了其他请求发起的调用)。
+        """
+        call = self._calls.get(key)
+        shared = call is not None
+        if call is None:
+            call = _Call(asyncio.ensure_future(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+
+        call.waiters += 1
+        try:
+            # shield：等待方被取消时不连带取消共享的上游任务
+            return await asyncio.shield(call.task), shared
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+                # 立即移除，之后的同键请求会重新发起调用而不是等到一个已取消的任务
+                self._forget(key, call)
+                self.cancelled += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+        }
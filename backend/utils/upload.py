@@ -0,0 +1,158 @@
+import hashlib
+import os
+import tempfile
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, List, Optional
+
+from fastapi import UploadFile
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from utils.image_decode import ImageRejectedError, ImageSource, ImageTooLargeError
+
+# 单个上传文件的最大字节数
+MAX_UPLOAD_BYTES = int(float(os.environ.get("MAX_UPLOAD_MB", 25)) * 1024 * 1024)
+# 请求体中除上传文件外 multipart 表单字段和分隔符的余量
+FORM_OVERHEAD_BYTES = 64 * 1024
+# 不超过该大小的上传文件以字节直接交给工作进程，更大的写入有文件名的临时文件，工作进程按路径打开
+UPLOAD_INLINE_BYTES = 1024 * 1024
+# 上传文件落盘的临时目录（默认系统临时目录）
+UPLOAD_TMP_DIR = os.environ.get("UPLOAD_TMP_DIR") or None
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLargeError(ImageTooLargeError):
+    """上传文件超过 MAX_UPLOAD_BYTES。"""
+
+
+@dataclass
+class SpooledUpload:
+    """
+    读取完毕的上传文件：小文件为内存中的 data，大文件为临时文件 path（二者只有一个）。
+    digest 与 result_cache.content_hash 一致。
+    """
+    size: int
+    digest: str
+    data: Optional[bytes] = None
+    path: Optional[str] = None
+
+    @property
+    def source(self) -> ImageSource:
+        """交给解码的图像来源：临时文件路径（工作进程自行打开）或字节。"""
+        return self.path if self.path is not None else self.data
+
+    def read_bytes(self) -> bytes:
+        if self.data is not None:
+            return self.data
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+@asynccontextmanager
+async def spooled_upload(file: UploadFile,
+                         max_bytes: int = MAX_UPLOAD_BYTES) -> AsyncIterator[SpooledUpload]:
+    """
+    按块读取 Starlette 解析出的上传文件，计算内容哈希并检查大小上限，整个文件不会一次性读入内存。
+    Starlette 转存到磁盘的临时文件没有文件名（工作进程无法打开），所以超过 UPLOAD_INLINE_BYTES 时
+    在同一遍读取中写入自己的临时文件；退出上下文时删除。
+    请求体的总字节数已由 UploadSizeLimitMiddleware 在接收时限制。
+    """
+    if file.size is not None and file.size > max_bytes:
+        raise UploadTooLargeError(_too_large_message(max_bytes))
+
+    hasher = hashlib.blake2b(digest_size=16)
+    size = 0
+    chunks: List[bytes] = []
+    out = None
+    path = None
+    try:
+        await file.seek(0)
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLargeError(_too_large_message(max_bytes))
+            hasher.update(chunk)
+            chunks.append(chunk)
+            if out is None and size > UPLOAD_INLINE_BYTES:
+                fd, path = tempfile.mkstemp(prefix="upload-", dir=UPLOAD_TMP_DIR)
+                out = os.fdopen(fd, "wb")
+            if out is not None:
+                out.writelines(chunks)
+                chunks.clear()
+        if out is not None:
+            out.close()
+        if size == 0:
+            raise ImageRejectedError("接收到空文件")
+
+        data = b"".join(chunks) if path is None else None
+        yield SpooledUpload(size=size, digest=hasher.hexdigest(), data=data, path=path)
+    finally:
+        if out is not None:
+            out.close()
+        if path is not None:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def _too_large_message(max_bytes: int) -> str:
+    return f"上传文件过大，最大 {max_bytes / 1024 / 1024:.0f} MB"
+
+
+def content_length_exceeds(header: Optional[str], max_bytes: int = MAX_UPLOAD_BYTES) -> bool:
+    """
+    请求体声明的长度是否明显超过上传上限（留出 multipart 表单字段的余量），
+    用于在读取请求体之前直接拒绝。
+    """
+    try:
+        return header is not None and int(header) > max_bytes + FORM_OVERHEAD_BYTES
+    except ValueError:
+        return False
+
+
+class UploadSizeLimitMiddleware:
+    """
+    ASGI 中间件：限制 POST 请求体的大小，超过 max_bytes（加表单余量）时返回 413。
+
+    Starlette 在调用处理函数之前就会把整个 multipart 请求体写入临时文件，
+    所以限制必须在接收请求体时生效：声明了 Content-Length 的请求在读取前直接拒绝，
+    分块传输 (chunked) 等没有声明长度的请求按 receive() 实际收到的字节数累计，
+    超限时立即中止解析，不再继续接收和落盘。
+    """
+
+    def __init__(self, app: ASGIApp, max_bytes: int = MAX_UPLOAD_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+
+        detail = _too_large_message(self.max_bytes)
+        if content_length_exceeds(Headers(scope=scope).get("content-length"), self.max_bytes):
+            response = JSONResponse(status_code=413, content={"detail": detail})
+            await response(scope, receive, send)
+            return
+
+        limit = self.max_bytes + FORM_OVERHEAD_BYTES
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # 由应用内的异常处理转换为 413 响应
+                    raise HTTPException(status_code=413, detail=detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
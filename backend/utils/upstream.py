@@ -0,0 +1,269 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import httpx
+
+# 可重试的上游状态码：限流和服务端错误
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# 可以安全重试的网络错误：请求一定还没有发出（连接失败、等待连接池超时）。
+# 读写超时和连接中断时上游可能已经收到请求并开始计费的生成，非幂等请求不重试
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class UpstreamError(Exception):
+    """上游返回了错误响应（重试后仍失败或不可重试）。"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class UpstreamUnavailableError(Exception):
+    """快速失败：熔断器打开或等待并发名额超时。retry_after 为建议的重试秒数。"""
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    熔断器：连续失败 failure_threshold 次后打开，reset_timeout 秒内直接拒绝请求；
+    之后进入半开状态，只放行一个探测请求，成功则关闭，失败则重新打开。
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+        self.times_opened = 0
+        self.short_circuited = 0
+
+    def before_call(self) -> None:
+        """请求前检查；熔断时抛出 UpstreamUnavailableError。"""
+        if self.state == self.OPEN:
+            remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+            if remaining > 0:
+                self.short_circuited += 1
+                raise UpstreamUnavailableError("图像生成服务暂时不可用，请稍后重试", remaining)
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self._probing:
+                self.short_circuited += 1
+                raise UpstreamUnavailableError("图像生成服务正在恢复，请稍后重试", 1.0)
+            self._probing = True
+
+    def release_probe(self) -> None:
+        """调用未得到结果（排队超时、被取消）时释放半开状态的探测名额，不计成败。"""
+        self._probing = False
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self) -> None:
+        self._probing = False
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.times_opened += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "times_opened": self.times_opened,
+            "short_circuited": self.short_circuited,
+        }
+
+
+class UpstreamGuard:
+    """
+    上游调用的保护层：
+    - 并发上限：最多 max_concurrency 个请求同时访问上游，其余排队，
+      排队超过 queue_timeout 秒快速失败
+    - 重试：429 / 5xx / 请求未发出的连接错误按带抖动的指数退避重试（full jitter），
+      优先遵循 Retry-After；幂等请求（如下载生成结果）的其他网络错误也重试
+    - 总时限：包括排队、每次请求和重试等待在内不超过 deadline
+    - 熔断：上游持续失败时直接拒绝，避免请求堆积
+    """
+
+    def __init__(self, max_concurrency: int = 4, queue_timeout: float = 10.0,
+                 max_attempts: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 deadline: float = 150.0, breaker: Optional[CircuitBreaker] = None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.queue_timeout = queue_timeout
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.breaker = breaker or CircuitBreaker()
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        self.active = 0
+        self.waiting = 0
+        self.calls = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retries = 0
+        self.queue_timeouts = 0
+        self._wait_ms = deque(maxlen=1000)
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    @staticmethod
+    def _retry_after(response: httpx.Response) -> Optional[float]:
+        try:
+            return float(response.headers["retry-after"])
+        except (KeyError, ValueError):
+            return None
+
+    async def _attempt(self, send: Callable[[], Awaitable[httpx.Response]],
+                       time_left: float) -> httpx.Response:
+        """排队获取并发名额后发送一次请求，排队和请求合计不超过 time_left 秒。"""
+        wait_budget = min(self.queue_timeout, time_left)
+        queued_at = time.monotonic()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=wait_budget)
+        except asyncio.TimeoutError:
+            self.queue_timeouts += 1
+            raise UpstreamUnavailableError("图像生成请求过多，请稍后重试", 1.0)
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - queued_at
+        self._wait_ms.append(waited * 1000.0)
+
+        self.active += 1
+        try:
+            return await asyncio.wait_for(send(), timeout=max(0.0, time_left - waited))
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+
+    async def request(self, send: Callable[[], Awaitable[httpx.Response]],
+                      idempotent: bool = False) -> httpx.Response:
+        """
+        通过保护层发送请求。send 每次调用都发起一次新的 HTTP 请求。
+        idempotent 为 False（如计费的生成请求）时，只重试请求确定未发出的网络错误。
+        返回 2xx / 不可重试的 4xx 响应；重试耗尽、不可重试的错误或超过总时限时抛出 UpstreamError。
+        """
+        self.breaker.before_call()
+        self.calls += 1
+        try:
+            return await self._request(send, idempotent)
+        except UpstreamError:
+            raise
+        except BaseException:
+            self.breaker.release_probe()
+            raise
+
+    async def _request(self, send: Callable[[], Awaitable[httpx.Response]],
+                       idempotent: bool) -> httpx.Response:
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            time_left = self.deadline - (time.monotonic() - started)
+            error: Optional[str] = None
+            status: Optional[int] = None
+            retry_after: Optional[float] = None
+            try:
+                response = await self._attempt(send, time_left)
+            except UpstreamUnavailableError:
+                # 本地排队超时不代表上游故障，不计入熔断
+                self.failed += 1
+                raise
+            except asyncio.TimeoutError:
+                self.failed += 1
+                self.breaker.record_failure()
+                raise UpstreamError(f"图像生成服务请求超时（总时限 {self.deadline:.0f} 秒）")
+            except httpx.TransportError as e:
+                error = f"{type(e).__name__}: {e}"
+                if not (idempotent or isinstance(e, UNSENT_ERRORS)):
+                    # 请求可能已经送达上游，重试会重复生成和计费
+                    self.failed += 1
+                    self.breaker.record_failure()
+                    raise UpstreamError(f"图像生成服务请求失败（请求可能已送达，不重试）: {error}")
+            else:
+                if response.status_code not in RETRYABLE_STATUS:
+                    self.succeeded += 1
+                    self.breaker.record_success()
+                    return response
+                status = response.status_code
+                error = f"HTTP {status}: {response.text[:200]}"
+                retry_after = self._retry_after(response)
+
+            attempt += 1
+            delay = self._backoff(attempt - 1, retry_after)
+            elapsed = time.monotonic() - started
+            if attempt >= self.max_attempts or elapsed + delay >= self.deadline:
+                self.failed += 1
+                self.breaker.record_failure()
+                raise UpstreamError(f"图像生成服务请求失败（已尝试 {attempt} 次）: {error}", status)
+
+            self.retries += 1
+            print(f"上游请求失败，{delay:.2f} 秒后重试（第 {attempt} 次）: {error}")
+            await asyncio.sleep(delay)
+
+    def metrics(self) -> Dict[str, Any]:
+        ordered = sorted(self._wait_ms)
+        n = len(ordered)
+        return {
+            "max_concurrency": self.max_concurrency,
+            "active": self.active,
+            "waiting": self.waiting,
+            "calls": self.calls,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "retries": self.retries,
+            "queue_timeouts": self.queue_timeouts,
+            "queue_wait_ms": {
+                "avg": round(sum(ordered) / n, 2) if n else 0.0,
+                "p95": round(ordered[min(n - 1, int(n * 0.95))], 2) if n else 0.0,
+                "max": round(ordered[-1], 2) if n else 0.0,
+            },
+            "breaker": self.breaker.metrics(),
+        }
+
+
+def guard_from_env() -> UpstreamGuard:
+    """
+    从环境变量创建上游保护层：
+        ARK_MAX_CONCURRENCY     同时访问上游的最大请求数（默认 4）
+        ARK_QUEUE_TIMEOUT       排队等待并发名额的最长秒数（默认 10）
+        ARK_MAX_ATTEMPTS        每次调用的最大尝试次数（默认 3）
+        ARK_BACKOFF_BASE        退避基准秒数（默认 0.5）
+        ARK_BACKOFF_MAX         单次退避最长秒数（默认 8）
+        ARK_DEADLINE            单次调用含重试的总时限秒数（默认 150）
+        ARK_BREAKER_THRESHOLD   连续失败多少次后熔断（默认 5）
+        ARK_BREAKER_RESET       熔断后多少秒尝试恢复（默认 30）
+    """
+    env = os.environ.get
+    return UpstreamGuard(
+        max_concurrency=int(env("ARK_MAX_CONCURRENCY", 4)),
+        queue_timeout=float(env("ARK_QUEUE_TIMEOUT", 10)),
+        max_attempts=int(env("ARK_MAX_ATTEMPTS", 3)),
+        backoff_base=float(env("ARK_BACKOFF_BASE", 0.5)),
+        backoff_max=float(env("ARK_BACKOFF_MAX", 8)),
+        deadline=float(env("ARK_DEADLINE", 150)),
+        breaker=CircuitBreaker(
+            failure_threshold=int(env("ARK_BREAKER_THRESHOLD", 5)),
+            reset_timeout=float(env("ARK_BREAKER_RESET", 30)),
+        ),
+    )
@@ -0,0 +1,200 @@
+import asyncio
+import importlib
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+# BLAS / OpenMP 线程数相关的环境变量（scikit-learn / numpy / scipy 使用）
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+)
+
+
+class PoolFullError(Exception):
+    """等待队列已满，请求被快速拒绝。"""
+
+
+def _init_worker(threads: int, preload: Sequence[str]) -> None:
+    """
+    工作进程初始化：限制每个进程的 BLAS/OpenMP 线程数，
+    避免 N 个进程 × M 个线程超额占用 CPU 核心；然后预先导入任务模块。
+    """
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(threads)
+    for module in preload:
+        importlib.import_module(module)
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=threads)
+    except ImportError:
+        pass
+
+
+def _timed_call(fn: Callable, args: Tuple) -> Tuple[Any, float, float]:
+    """在工作进程中执行任务，并返回开始/结束的时间戳用于统计排队时间。"""
+    started = time.time()
+    result = fn(*args)
+    return result, started, time.time()
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+class WorkerPool:
+    """
+    CPU 密集任务的有界进程池。
+
+    - 任务在独立进程中运行，不阻塞 asyncio 事件循环（/health、/generate 等照常响应）
+    - 进行中的任务数（运行中 + 排队中）超过 workers + queue_size 时立即抛出 PoolFullError
+    - 记录排队深度、排队等待时间和运行时间等指标
+    """
+
+    def __init__(self, workers: int, threads_per_worker: int = 1, queue_size: int = 8,
+                 preload: Sequence[str] = (), start_method: str = "spawn"):
+        self.workers = max(1, workers)
+        self.threads_per_worker = max(1, threads_per_worker)
+        self.queue_size = max(0, queue_size)
+        self.preload = tuple(preload)
+        self.start_method = start_method
+
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        # 已提交且尚未在进程池中结束的任务数；任务结束的回调在执行器的管理线程中执行
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._wait_ms = deque(maxlen=1000)
+        self._run_ms = deque(maxlen=1000)
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.queue_size
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context(self.start_method),
+                    initializer=_init_worker,
+                    initargs=(self.threads_per_worker, self.preload),
+                )
+            return self._executor
+
+    def _reset_executor(self) -> None:
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    async def warm_up(self) -> None:
+        """启动所有工作进程并完成模块导入，避免首个请求承担进程启动开销。"""
+        executor = self._get_executor()
+        await asyncio.gather(*[
+            asyncio.wrap_future(executor.submit(_ping)) for _ in range(self.workers)
+        ])
+
+    async def run(self, fn: Callable, *args) -> Any:
+        """
+        在进程池中执行 fn(*args)。fn 和参数必须可以被 pickle。
+        队列已满时立即抛出 PoolFullError。
+        调用方被取消（如客户端断开）时，已开始执行的任务仍占用进程，
+        直到它在进程池中真正结束才释放名额。
+        """
+        with self._in_flight_lock:
+            if self._in_flight >= self.capacity:
+                self.rejected += 1
+                raise PoolFullError(
+                    f"像素化队列已满（{self._in_flight}/{self.capacity}），请稍后重试"
+                )
+            self._in_flight += 1
+
+        self.submitted += 1
+        submitted_at = time.time()
+        try:
+            try:
+                future = self._get_executor().submit(_timed_call, fn, args)
+            except BaseException:
+                self._release()
+                raise
+            future.add_done_callback(self._release)
+            result, started, finished = await asyncio.wrap_future(future)
+        except BrokenProcessPool:
+            # 工作进程异常退出（例如被 OOM killer 杀死），重建进程池
+            self.failed += 1
+            self._reset_executor()
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+
+        self.completed += 1
+        self._wait_ms.append(max(0.0, started - submitted_at) * 1000.0)
+        self._run_ms.append((finished - started) * 1000.0)
+        return result
+
+    def _release(self, _future: Optional[Future] = None) -> None:
+        with self._in_flight_lock:
+            self._in_flight -= 1
+
+    def shutdown(self) -> None:
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
+
+    @staticmethod
+    def _summary(values) -> Dict[str, float]:
+        if not values:
+            return {"avg": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+        ordered = sorted(values)
+        n = len(ordered)
+        return {
+            "avg": round(sum(ordered) / n, 2),
+            "p50": round(ordered[n // 2], 2),
+            "p95": round(ordered[min(n - 1, int(n * 0.95))], 2),
+            "max": round(ordered[-1], 2),
+        }
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "threads_per_worker": self.threads_per_worker,
+            "capacity": self.capacity,
+            "in_flight": self._in_flight,
+            "queue_depth": max(0, self._in_flight - self.workers),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_ms": self._summary(self._wait_ms),
+            "run_ms": self._summary(self._run_ms),
+        }
+
+
+def pool_from_env(preload: Sequence[str] = ()) -> WorkerPool:
+    """
+    从环境变量创建进程池：
+        PIXEL_WORKERS            工作进程数（默认 CPU 核数）
+        PIXEL_THREADS_PER_WORKER 每个进程的 BLAS/OpenMP 线程数（默认 1）
+        PIXEL_QUEUE_SIZE         允许排队等待的任务数（默认 workers * 4）
+    """
+    workers = int(os.environ.get("PIXEL_WORKERS", os.cpu_count() or 1))
+    threads = int(os.environ.get("PIXEL_THREADS_PER_WORKER", 1))
+    queue_size = int(os.environ.get("PIXEL_QUEUE_SIZE", workers * 4))
+    return WorkerPool(workers, threads_per_worker=threads, queue_size=queue_size,
+                      preload=preload)
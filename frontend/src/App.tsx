@@ -5,21 +5,15 @@ import { Loader2, Wand2, Grid, RotateCcw, ChevronRight, Layout, Crop as CropIcon
 import { clsx } from 'clsx';
 import Cropper from 'react-easy-crop';
 import { getCroppedImg } from './utils/canvasUtils';
-
-// Helper to convert RGB array to Hex string
-const rgbToHex = (r: number, g: number, b: number) => {
-  return "#" + [r, g, b].map(x => {
-    const hex = x.toString(16);
-    return hex.length === 1 ? '0' + hex : hex;
-  }).join('');
-};
+import { decodeGrid, GRID_MEDIA_TYPE, GridPaletteEntry } from './utils/gridCodec';
 
 interface PixelResult {
-  gridData: string[][];
-  usedPalette: string[];
+  // Decoded PDG1 grid: palette indices per cell, passed to the viewer as-is
+  indices: Uint8Array;
+  palette: GridPaletteEntry[];
   width: number;
   height: number;
-  preview: string;
+  preview?: string;
 }
 
 function App() {
@@ -31,6 +25,9 @@ function App() {
   const [originalPreview, setOriginalPreview] = useState<string>('');
   const [generatedImage, setGeneratedImage] = useState<string>(''); // URL or Base64
   
+  // Server-side image session: the source image is uploaded once, then pixelated by id
+  const [imageSession, setImageSession] = useState<{ source: string; id: string } | null>(null);
+
   // Store the full pixelation result
   const [pixelResult, setPixelResult] = useState<PixelResult | null>(null);
   const [gridSize, setGridSize] = useState(64);
@@ -112,15 +109,15 @@ function App() {
         throw new Error(`生成失败: ${response.statusText}`);
       }
 
-      // Return base64 for frontend display
-      // b64_img = base64.b64encode(generated_bytes).decode('utf-8')
-      // return JSONResponse(content={"image": f"data:image/png;base64,{b64_img}"})
-      
-      // Frontend receives { image: "data:..." }
+      // The generated image stays on the server as an image session:
+      // { image_id, image_url } where image_url is a display-size copy
       const data = await response.json();
       
-      if (data.image) {
-        setGeneratedImage(data.image);
+      if (data.image_id && data.image_url) {
+        const displayUrl = `${apiUrl}${data.image_url}`;
+        setGeneratedImage(displayUrl);
+        // Pixelation requests reuse this id instead of re-uploading the image
+        setImageSession({ source: displayUrl, id: data.image_id });
       } else {
         throw new Error("Invalid response format from server");
       }
@@ -140,47 +137,63 @@ function App() {
     setError(null);
 
     try {
-      const fetchResponse = await fetch(sourceImage);
-      const blob = await fetchResponse.blob();
-      const file = new File([blob], "image.png", { type: "image/png" });
+      const uploadSource = async (): Promise<string> => {
+        const fetchResponse = await fetch(sourceImage);
+        if (!fetchResponse.ok) {
+          throw new Error('图像已在服务器上过期，请重新生成');
+        }
+        const blob = await fetchResponse.blob();
+        const file = new File([blob], "image.png", { type: "image/png" });
+
+        const uploadData = new FormData();
+        uploadData.append('file', file);
+        const uploadResponse = await fetch(`${apiUrl}/images`, {
+          method: 'POST',
+          body: uploadData,
+        });
+        if (!uploadResponse.ok) {
+          throw new Error(`上传失败: ${uploadResponse.status} ${uploadResponse.statusText}`);
+        }
+        const uploaded = await uploadResponse.json();
+        setImageSession({ source: sourceImage, id: uploaded.image_id });
+        return uploaded.image_id;
+      };
+
+      const requestPixelate = (imageId: string) => {
+        const formData = new FormData();
+        formData.append('image_id', imageId);
+        formData.append('grid_size', targetGridSize.toString());
+        formData.append('max_colors', targetMaxColors.toString());
+        formData.append('rle', 'true');
+
+        // Compact binary grid instead of JSON; the viewer redraws from the grid
+        return fetch(`${apiUrl}/pixelate`, {
+          method: 'POST',
+          headers: { Accept: GRID_MEDIA_TYPE },
+          body: formData,
+        });
+      };
 
-      const formData = new FormData();
-      formData.append('file', file);
-      formData.append('grid_size', targetGridSize.toString());
-      formData.append('max_colors', targetMaxColors.toString());
+      // Only upload when the source image changed; parameter changes reuse the session
+      let imageId = imageSession?.source === sourceImage ? imageSession.id : await uploadSource();
+      let response = await requestPixelate(imageId);
 
-      const response = await fetch(`${apiUrl}/pixelate`, {
-        method: 'POST',
-        body: formData,
-      });
+      // Session expired on the server: upload again and retry once
+      if (response.status === 404) {
+        imageId = await uploadSource();
+        response = await requestPixelate(imageId);
+      }
 
       if (!response.ok) {
         throw new Error(`像素化失败: ${response.status} ${response.statusText}`);
       }
 
-      const data = await response.json();
-      
-      const paletteMap = new Map<string, string>();
-      const paletteHexList: string[] = [];
-
-      if (Array.isArray(data.used_palette)) {
-        data.used_palette.forEach((p: any) => {
-          const hex = rgbToHex(p.rgb[0], p.rgb[1], p.rgb[2]);
-          paletteMap.set(p.id, hex);
-          paletteHexList.push(hex);
-        });
-      }
-
-      const gridHex = data.grid_data.map((row: string[]) => 
-        row.map((id: string) => paletteMap.get(id) || '#000000')
-      );
-
+      const grid = decodeGrid(await response.arrayBuffer());
       setPixelResult({
-        gridData: gridHex,
-        usedPalette: paletteHexList,
-        width: data.width,
-        height: data.height,
-        preview: data.preview
+        indices: grid.indices,
+        palette: grid.palette,
+        width: grid.width,
+        height: grid.height
       });
       
       // Update states
@@ -210,6 +223,7 @@ function App() {
     setOriginalPreview('');
     setGeneratedImage('');
     setPixelResult(null);
+    setImageSession(null);
     setError(null);
     setCroppedImageBlob(null);
     setCroppedImagePreview('');
@@ -467,8 +481,8 @@ function App() {
             </div>
             
             <PixelViewer 
-              gridData={pixelResult.gridData}
-              usedPalette={pixelResult.usedPalette}
+              indices={pixelResult.indices}
+              palette={pixelResult.palette}
               previewImage={pixelResult.preview}
               width={pixelResult.width}
               height={pixelResult.height}
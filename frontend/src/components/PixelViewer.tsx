@@ -1,49 +1,68 @@
-import { useEffect, useRef, useState } from 'react';
+import { useEffect, useMemo, useRef, useState } from 'react';
 import { Eye, EyeOff, Download, ZoomIn, ZoomOut, Grid as GridIcon } from 'lucide-react';
 import { clsx } from 'clsx';
 import { twMerge } from 'tailwind-merge';
+import type { GridPaletteEntry } from '../utils/gridCodec';
 
 interface PixelViewerProps {
-  gridData: string[][];
-  usedPalette: string[];
+  // Row-major indices into `palette`, length width * height (PDG1 grid as decoded)
+  indices: Uint8Array;
+  palette: GridPaletteEntry[];
   previewImage?: string;
   width: number;
   height: number;
   className?: string;
 }
 
+// Helper to convert RGB array to Hex string
+const rgbToHex = (r: number, g: number, b: number) => {
+  return "#" + [r, g, b].map(x => {
+    const hex = x.toString(16);
+    return hex.length === 1 ? '0' + hex : hex;
+  }).join('');
+};
+
+const allLayers = (palette: GridPaletteEntry[]) => new Set(palette.map((_, index) => index));
+
 export function PixelViewer({ 
-  gridData, 
-  usedPalette, 
+  indices, 
+  palette, 
   width, 
   height,
   className 
 }: PixelViewerProps) {
   const canvasRef = useRef<HTMLCanvasElement>(null);
-  const [visibleColors, setVisibleColors] = useState<Set<string>>(new Set(usedPalette));
+  // Layers are palette indices, so the grid never has to be expanded into per-cell strings
+  const [visibleColors, setVisibleColors] = useState<Set<number>>(() => allLayers(palette));
   const [scale, setScale] = useState(10);
   const [showGrid, setShowGrid] = useState(false);
   const [addPadding, setAddPadding] = useState(true);
 
+  // Hex labels for the layer list only
+  const usedPalette = useMemo(
+    () => palette.map(p => rgbToHex(p.rgb[0], p.rgb[1], p.rgb[2])),
+    [palette]
+  );
+
   useEffect(() => {
-    setVisibleColors(new Set(usedPalette));
-  }, [usedPalette]);
+    setVisibleColors(allLayers(palette));
+  }, [palette]);
 
-  const toggleColorVisibility = (color: string) => {
+  const toggleColorVisibility = (index: number) => {
     const newVisible = new Set(visibleColors);
-    if (newVisible.has(color)) {
-      newVisible.delete(color);
+    if (newVisible.has(index)) {
+      newVisible.delete(index);
     } else {
-      newVisible.add(color);
+      newVisible.add(index);
     }
     setVisibleColors(newVisible);
   };
 
   const toggleAllColors = () => {
-    if (visibleColors.size === usedPalette.length) {
+    if (visibleColors.size === palette.length) {
       setVisibleColors(new Set());
     } else {
-      setVisibleColors(new Set(usedPalette));
+      setVisibleColors(allLayers(palette));
     }
   };
 
@@ -80,14 +99,29 @@ export function PixelViewer({
       }
     }
 
-    gridData.forEach((row, y) => {
-      row.forEach((color, x) => {
-        if (visibleColors.has(color)) {
-          ctx.fillStyle = color;
-          ctx.fillRect(x * scale, y * scale, scale, scale);
-        }
+    // One RGBA pixel per cell straight from the index buffer, then scaled up without smoothing;
+    // hidden layers stay transparent so the checkerboard shows through
+    if (width > 0 && height > 0) {
+      const lookup = new Uint8Array(palette.length * 4);
+      palette.forEach((p, index) => {
+        lookup.set([p.rgb[0], p.rgb[1], p.rgb[2], visibleColors.has(index) ? 255 : 0], index * 4);
       });
-    });
+      const cells = new ImageData(width, height);
+      const data = cells.data;
+      for (let i = 0; i < indices.length; i++) {
+        const p = indices[i] * 4;
+        data[i * 4] = lookup[p];
+        data[i * 4 + 1] = lookup[p + 1];
+        data[i * 4 + 2] = lookup[p + 2];
+        data[i * 4 + 3] = lookup[p + 3];
+      }
+      const layer = document.createElement('canvas');
+      layer.width = width;
+      layer.height = height;
+      layer.getContext('2d')?.putImageData(cells, 0, 0);
+      ctx.imageSmoothingEnabled = false;
+      ctx.drawImage(layer, 0, 0, width * scale, height * scale);
+    }
 
     if (showGrid && scale > 4) {
       ctx.strokeStyle = 'rgba(0, 0, 0, 0.1)';
@@ -110,7 +144,7 @@ export function PixelViewer({
     // Restore context
     ctx.restore();
 
-  }, [gridData, visibleColors, scale, showGrid, width, height, addPadding]);
+  }, [indices, palette, visibleColors, scale, showGrid, width, height, addPadding]);
 
   const handleDownload = () => {
     const canvas = canvasRef.current;
@@ -205,7 +239,7 @@ export function PixelViewer({
             onClick={toggleAllColors}
             className="text-xs font-medium text-primary-600 hover:text-primary-700 transition-colors"
           >
-            {visibleColors.size === usedPalette.length ? '隐藏全部' : '显示全部'}
+            {visibleColors.size === palette.length ? '隐藏全部' : '显示全部'}
           </button>
         </div>
         
@@ -227,15 +261,15 @@ export function PixelViewer({
               </div>
               
               <button
-                onClick={() => toggleColorVisibility(color)}
+                onClick={() => toggleColorVisibility(index)}
                 className={clsx(
                   "p-1.5 rounded-md transition-colors",
-                  visibleColors.has(color) 
+                  visibleColors.has(index) 
                     ? "text-slate-400 hover:text-primary-600 hover:bg-primary-50" 
                     : "text-slate-300 hover:text-slate-500"
                 )}
               >
-                {visibleColors.has(color) ? (
+                {visibleColors.has(index) ? (
                   <Eye className="w-4 h-4" />
                 ) : (
                   <EyeOff className="w-4 h-4" />
@@ -0,0 +1,68 @@
+// Decoder for the compact PDG1 grid format returned by /pixelate
+// (Accept: application/octet-stream or format=binary). Layout, little-endian:
+//   header   "PDG1" | version u8 | flags u8 | width u16 | height u16 | palette_count u16
+//   palette  palette_count x (r u8 | g u8 | b u8 | id_len u8 | id | name_len u8 | name)
+//   grid     width * height u8 palette indices, or (length u16, value u8) runs when flags & 1
+
+export const GRID_MEDIA_TYPE = 'application/octet-stream';
+
+const FLAG_RLE = 0x01;
+const HEADER_SIZE = 12;
+
+export interface GridPaletteEntry {
+  id: string;
+  name: string;
+  rgb: [number, number, number];
+}
+
+export interface DecodedGrid {
+  width: number;
+  height: number;
+  palette: GridPaletteEntry[];
+  // Row-major indices into `palette`, length width * height
+  indices: Uint8Array;
+}
+
+export function decodeGrid(buffer: ArrayBuffer): DecodedGrid {
+  const view = new DataView(buffer);
+  const bytes = new Uint8Array(buffer);
+  const magic = String.fromCharCode(bytes[0], bytes[1], bytes[2], bytes[3]);
+  if (magic !== 'PDG1') {
+    throw new Error('Invalid grid payload');
+  }
+
+  const flags = view.getUint8(5);
+  const width = view.getUint16(6, true);
+  const height = view.getUint16(8, true);
+  const paletteCount = view.getUint16(10, true);
+
+  const decoder = new TextDecoder();
+  const palette: GridPaletteEntry[] = [];
+  let offset = HEADER_SIZE;
+  for (let i = 0; i < paletteCount; i++) {
+    const rgb: [number, number, number] = [bytes[offset], bytes[offset + 1], bytes[offset + 2]];
+    offset += 3;
+    const idLength = bytes[offset++];
+    const id = decoder.decode(bytes.subarray(offset, offset + idLength));
+    offset += idLength;
+    const nameLength = bytes[offset++];
+    const name = decoder.decode(bytes.subarray(offset, offset + nameLength));
+    offset += nameLength;
+    palette.push({ id, name, rgb });
+  }
+
+  let indices: Uint8Array;
+  if (flags & FLAG_RLE) {
+    indices = new Uint8Array(width * height);
+    let position = 0;
+    for (; offset + 3 <= bytes.length; offset += 3) {
+      const length = view.getUint16(offset, true);
+      indices.fill(bytes[offset + 2], position, position + length);
+      position += length;
+    }
+  } else {
+    indices = bytes.slice(offset, offset + width * height);
+  }
+
+  return { width, height, palette, indices };
+}